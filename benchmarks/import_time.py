@@ -0,0 +1,64 @@
+from __future__ import annotations
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+
+# Every module is imported by a new interpreter, -X importtime gives the time spent on it with
+# everything it imports. The run fails when a module loads one of the heavy dependencies, which
+# must be imported only on first use
+MODULES = (
+    "botovod",
+    "botovod.agents",
+    "botovod.agents.telegram",
+    "botovod.dbdrivers",
+    "botovod.utils.handlers",
+)
+HEAVY_MODULES = ("aiohttp", "requests")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE = "import sys, {module}; print(','.join(name for name in {heavy} if name in sys.modules))"
+
+
+def measure(module: str) -> Tuple[int, List[str]]:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    code = CODE.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                            capture_output=True, text=True, check=True)
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    microseconds = 0
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            microseconds = int(parts[1])
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return microseconds, loaded
+
+
+def run(modules: List[str], repeat: int) -> Dict[str, Tuple[int, List[str]]]:
+    results = {}
+    for module in modules:
+        measures = [measure(module) for _ in range(repeat)]
+        results[module] = (min(microseconds for microseconds, _ in measures), measures[0][1])
+    return results
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure import time of botovod modules")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(args)
+
+    failed = False
+    for module, (microseconds, loaded) in run(args.modules, args.repeat).items():
+        line = f"{module:<32}{microseconds / 1000:>8.1f} ms"
+        if loaded:
+            line += "  loads " + ", ".join(loaded)
+            failed = True
+        print(line)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,18 @@
-from .botovod import Botovod
+from typing import TYPE_CHECKING
+from .utils.imports import lazy_attributes
+
+if TYPE_CHECKING:
+    from .botovod import AsyncHandlerGroup, Botovod, HandlerGroup
+    from .context import Context
+
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__,
+    {
+        "AsyncHandlerGroup": ".botovod",
+        "Botovod": ".botovod",
+        "Context": ".context",
+        "HandlerGroup": ".botovod",
+    },
+    ("agents", "context", "dbdrivers", "dialogs", "exceptions", "extensions", "migrate", "utils"),
+)
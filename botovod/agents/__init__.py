@@ -1,2 +1,21 @@
-from .common import Agent
-from .types import Attachment, Chat, Keyboard, KeyboardButton, Location, Message
+from typing import TYPE_CHECKING
+from botovod.utils.imports import lazy_attributes
+
+if TYPE_CHECKING:
+    from .common import Agent
+    from .types import Attachment, Chat, Keyboard, KeyboardButton, Location, Message
+
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__,
+    {
+        "Agent": ".common",
+        "Attachment": ".types",
+        "Chat": ".types",
+        "Keyboard": ".types",
+        "KeyboardButton": ".types",
+        "Location": ".types",
+        "Message": ".types",
+    },
+    ("common", "telegram", "types", "vk"),
+)
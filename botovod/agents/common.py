@@ -1,8 +1,9 @@
 from __future__ import annotations
 import logging
-from typing import Dict, Iterator, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from botovod.exceptions import HandlerNotPassed
+from botovod.context import Context
+from botovod.exceptions import FollowerConflictException, HandlerNotPassed
 from .types import Attachment, Chat, Keyboard, Location, Message
 
 
@@ -20,17 +21,25 @@ class Agent:
     def listen(self, headers: Dict[str, str], body: str, **scope) -> Tuple[int, Dict[str, str], str]:
         self.logger.debug("Get request")
 
+        # Items of Botovod are handed to handlers as they are, scope given here replaces them
+        scope = scope or self.botovod.items
         messages = self.parser(headers, body)
-        for chat, message in messages:
-            follower = None
-            if self.botovod.dbdriver:
-                follower = self.botovod.dbdriver.get_follower(self, chat)
-                if not follower:
-                    follower = self.botovod.dbdriver.add_follower(self, chat)
-            for handler in self.botovod.handlers:
+        prepared = [None] * len(messages)
+        if len(messages) > 1:
+            prepared = self.botovod.prepare_handlers(messages)
+        for (chat, message), results in zip(messages, prepared):
+            # Nothing is written for a follower changed by another update since it was read, the
+            # update is handled again with the follower read again
+            for attempt in range(self.botovod.conflict_retries + 1):
                 try:
-                    handler(self, chat, message, follower, **scope)
-                except HandlerNotPassed:
+                    self.handle(chat, message, scope, history=attempt == 0,
+                                prepared=results)
+                except FollowerConflictException:
+                    if attempt >= self.botovod.conflict_retries:
+                        raise
+                    # Messages sent by handlers before the conflict are sent again
+                    self.logger.warning("Follower of chat %s was changed, handle again "
+                                        "(retry %d)", chat.id, attempt + 1)
                     continue
                 break
 
@@ -39,23 +48,84 @@ class Agent:
     async def a_listen(self, headers: Dict[str, str], body: str, **scope) -> Tuple[int, Dict[str, str], str]:
         self.logger.debug("Get updates")
 
+        scope = scope or self.botovod.items
         messages = await self.a_parser(headers, body)
-        for chat, message in messages:
-            if self.botovod.dbdriver is not None:
-                follower = await self.botovod.dbdriver.a_get_follower(self, chat)
-                if follower is None:
-                    follower = await self.botovod.dbdriver.a_add_follower(self, chat)
-            else:
-                follower = None
-            for handler in self.botovod.handlers:
+        prepared = [None] * len(messages)
+        if len(messages) > 1:
+            prepared = self.botovod.prepare_handlers(messages)
+        for (chat, message), results in zip(messages, prepared):
+            for attempt in range(self.botovod.conflict_retries + 1):
                 try:
-                    await handler(self, chat, message, follower, **scope)
-                except HandlerNotPassed:
+                    await self.a_handle(chat, message, scope, history=attempt == 0,
+                                        prepared=results)
+                except FollowerConflictException:
+                    if attempt >= self.botovod.conflict_retries:
+                        raise
+                    # Messages sent by handlers before the conflict are sent again
+                    self.logger.warning("Follower of chat %s was changed, handle again "
+                                        "(retry %d)", chat.id, attempt + 1)
                     continue
                 break
 
         return await self.a_responser(headers, body)
 
+    def handle(self, chat: Chat, message: Message, scope: Dict[str, Any], history: bool = True,
+               prepared: Optional[Dict[Callable, Any]] = None):
+        dbdriver = self.botovod.dbdriver
+        follower = None
+        if dbdriver:
+            follower = dbdriver.get_or_create_follower(self, chat)
+            if history and self.botovod.history:
+                follower.add_history(message, input=True)
+        context = Context(self, chat, message, follower, items=scope, prepared=prepared)
+        # Changes are written only when the update is handled, those of a handler which failed
+        # are dropped, so its own exception is raised and not a conflict of writing them
+        try:
+            for handler in self.get_handlers(message):
+                try:
+                    handler(context)
+                except HandlerNotPassed:
+                    continue
+                break
+        except BaseException:
+            if dbdriver:
+                dbdriver.discard(follower)
+            raise
+        if dbdriver:
+            dbdriver.finish(follower)
+
+    async def a_handle(self, chat: Chat, message: Message, scope: Dict[str, Any],
+                       history: bool = True, prepared: Optional[Dict[Callable, Any]] = None):
+        dbdriver = self.botovod.dbdriver
+        if dbdriver is not None:
+            follower = await dbdriver.a_get_or_create_follower(self, chat)
+            if history and self.botovod.history:
+                await follower.a_add_history(message, input=True)
+        else:
+            follower = None
+        context = Context(self, chat, message, follower, items=scope, prepared=prepared)
+        try:
+            for handler in self.get_handlers(message):
+                try:
+                    await handler(context)
+                except HandlerNotPassed:
+                    continue
+                break
+        except BaseException:
+            if dbdriver is not None:
+                await dbdriver.a_discard(follower)
+            raise
+        if dbdriver is not None:
+            await dbdriver.a_finish(follower)
+
+    def get_handlers(self, message: Message) -> Tuple[Callable, ...]:
+        # Handler of a pressed button goes first, other handlers are tried if it doesn't pass
+        handlers = self.botovod.get_handlers(self.name)
+        button_handler = self.botovod.get_button_handler(message)
+        if button_handler is not None:
+            handlers = (button_handler,) + handlers
+        return handlers
+
     def start(self):
         raise NotImplementedError
 
@@ -1,19 +1,19 @@
 from __future__ import annotations
 import asyncio
 import io
-import json
 import time
 from threading import Thread
 from typing import Dict, IO, Iterator, List, Optional, Tuple
 
-import aiohttp
-import requests
-
 from botovod.agents import Agent, Attachment, Chat, Keyboard, Location, Message
-from .types import (TelegramAttachment, TelegramCallback, TelegramChat, TelegramInlineKeyboard,
-                    TelegramKeyboard, TelegramMessage, TelegramUser)
+from botovod.utils import codec
+from .types import (TelegramAttachment, TelegramCallback, TelegramChatView,
+                    TelegramInlineKeyboard, TelegramKeyboard, TelegramMessage, TelegramMessageView,
+                    TelegramUser, TelegramUserView)
 
 
+# requests and aiohttp are imported by the first call which needs them, so a sync bot doesn't load
+# aiohttp, an async one doesn't load requests and neither is loaded before the first request
 class Requester:
     BASE_URL = "https://api.telegram.org/bot{token}/{method}"
     FILE_URL = "https://api.telegram.org/file/bot{token}/{path}"
@@ -23,26 +23,32 @@ class Requester:
 
     def do_method(self, token: str, method: str, payload: Optional[dict] = None,
                   files: Optional[Dict[str, IO]] = None):
+        import requests
+
         url = self.BASE_URL.format(token=token, method=method)
 
         response = requests.post(url, data=payload, files=files)
-        data = response.json()
+        data = codec.loads(response.content)
         if data["ok"]:
             return data["result"]
 
     async def a_do_method(self, token: str, method: str, payload: Optional[dict] = None,
                           files: Optional[Dict[str, IO]] = None):
+        import aiohttp
+
         url = self.BASE_URL.format(token=token, method=method)
 
         if payload is not None and files is not None:
             payload.update(files)
         async with aiohttp.ClientSession() as session:
             async with session.post(url, data=payload) as response:
-                data = await response.json()
+                data = codec.loads(await response.read())
         if data["ok"]:
             return data["result"]
 
     def get_file(self, token: str, path: str):
+        import requests
+
         url = self.FILE_URL.format(token=token, path=path)
 
         response = requests.get(url)
@@ -50,6 +56,8 @@ class Requester:
         return response.content
 
     async def a_get_file(self, token: str, path: str):
+        import aiohttp
+
         url = self.FILE_URL.format(token=token, path=path)
 
         async with aiohttp.ClientSession(raist_for_status=True) as session:
@@ -112,7 +120,7 @@ class TelegramAgent(Agent):
 
     def parser(self, headers: Dict[str, str],
                body: str) -> List[Tuple[Chat, Message]]:
-        update = json.loads(body)
+        update = codec.loads(body)
         messages = []
         if update["update_id"] <= self.last_update:
             return messages
@@ -120,16 +128,16 @@ class TelegramAgent(Agent):
         self.last_update = update["update_id"]
 
         if "message" in update:
-            chat = TelegramChat.parse(agent=self, data=update["message"]["chat"])
-            message = TelegramMessage.parse(data=update["message"], agent=self)
+            chat = TelegramChatView(agent=self, data=update["message"]["chat"])
+            message = TelegramMessageView.parse(data=update["message"], agent=self)
             messages.append((chat, message))
 
         if "callback_query" in update:
             data = update["callback_query"]
             if "message" in data:
-                chat = TelegramChat.parse(agent=self, data=data["message"]["chat"])
+                chat = TelegramChatView(agent=self, data=data["message"]["chat"])
             else:
-                chat = TelegramUser.parse(agent=self, data=data["from"])
+                chat = TelegramUserView(agent=self, data=data["from"])
             message = TelegramCallback.parse(data=update["callback_query"])
             messages.append((chat, message))
 
@@ -137,7 +145,7 @@ class TelegramAgent(Agent):
 
     async def a_parser(self, headers: Dict[str, str],
                        body: str) -> List[Tuple[Chat, Agent]]:
-        update = json.loads(body)
+        update = codec.loads(body)
         messages = []
         if update["update_id"] <= self.last_update:
             return messages
@@ -145,16 +153,16 @@ class TelegramAgent(Agent):
         self.last_update = update["update_id"]
 
         if "message" in update:
-            chat = TelegramChat.parse(agent=self, data=update["message"]["chat"])
-            message = await TelegramMessage.a_parse(data=update["message"], agent=self)
+            chat = TelegramChatView(agent=self, data=update["message"]["chat"])
+            message = await TelegramMessageView.a_parse(data=update["message"], agent=self)
             messages.append((chat, message))
 
         if "callback_query" in update:
             data = update["callback_query"]
             if "message" in data:
-                chat = TelegramChat.parse(agent=self, data=data["message"]["chat"])
+                chat = TelegramChatView(agent=self, data=data["message"]["chat"])
             else:
-                chat = TelegramUser.parse(agent=self, data=data["from"])
+                chat = TelegramUserView(agent=self, data=data["from"])
             message = TelegramCallback.parse(data=update["callback_query"])
             messages.append((chat, message))
 
@@ -167,6 +175,18 @@ class TelegramAgent(Agent):
                           body: str) -> Tuple[int, Dict[str, str], str]:
         return self.responser(headers=headers, body=body)
 
+    def render_keyboard(self, keyboard: Keyboard) -> str:
+        # Buttons carrying handlers are registered when sent, Botovod keeps the max_buttons
+        # latest of them. Buttons sent before a restart should be registered at start by
+        # Botovod.add_keyboard
+        if hasattr(keyboard, "render"):
+            data = keyboard.render()
+        else:
+            data = TelegramKeyboard.default_render(keyboard)
+        if self.botovod is not None:
+            self.botovod.add_keyboard(keyboard)
+        return data
+
     def polling(self):
         while self.running:
             try:
@@ -174,7 +194,7 @@ class TelegramAgent(Agent):
                 updates = self.requester.do_method(token=self.token, method="getUpdates",
                                                    payload=payload)
                 for update in updates:
-                    self.listen(headers={}, body=json.dumps(update), **self.botovod._items)
+                    self.listen(headers={}, body=codec.dumpb(update))
             except Exception:
                 self.logger.exception("Got exception")
             finally:
@@ -187,7 +207,7 @@ class TelegramAgent(Agent):
                 updates = await self.requester.a_do_method(token=self.token, method="getUpdates",
                                                            payload=payload)
                 for update in updates:
-                    await self.a_listen(headers={}, body=json.dumps(update), **self.botovod._items)
+                    await self.a_listen(headers={}, body=codec.dumpb(update))
             except Exception:
                 self.logger.exception("Got exception")
             finally:
@@ -257,10 +277,7 @@ class TelegramAgent(Agent):
                 "disable_notification": not notification, 
             }
             if keyboard is not None:
-                if hasattr(keyboard, "render"):
-                    payload["reply_markup"] = keyboard.render()
-                else:
-                    payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+                payload["reply_markup"] = self.render_keyboard(keyboard)
             elif remove_keyboard:
                 payload["reply_markup"] = '{"remove_keyboard": true}'
             if html:
@@ -316,10 +333,7 @@ class TelegramAgent(Agent):
                 "disable_notification": not notification, 
             }
             if keyboard is not None:
-                if hasattr(keyboard, "render"):
-                    payload["reply_markup"] = keyboard.render()
-                else:
-                    payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+                payload["reply_markup"] = self.render_keyboard(keyboard)
             elif remove_keyboard:
                 payload["reply_markup"] = '{"remove_keyboard": true}'
             if html:
@@ -372,10 +386,7 @@ class TelegramAgent(Agent):
             payload[type] = attachment_data
 
         if keyboard is not None:
-            if hasattr(keyboard, "render"):
-                payload["reply_markup"] = keyboard.render()
-            else:
-                payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         elif remove_keyboard:
             payload["reply_markup"] = '{"remove_keyboard": true}'
 
@@ -396,10 +407,7 @@ class TelegramAgent(Agent):
             payload[type] = attachment_data
 
         if keyboard is not None:
-            if hasattr(keyboard, "render"):
-                payload["reply_markup"] = keyboard.render()
-            else:
-                payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         elif remove_keyboard:
             payload["reply_markup"] = '{"remove_keyboard": true}'
 
@@ -496,10 +504,7 @@ class TelegramAgent(Agent):
             "latitude": location.latitude,
         }
         if keyboard is not None:
-            if hasattr(keyboard, "render"):
-                payload["reply_markup"] = keyboard.render()
-            else:
-                payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         elif remove_keyboard:
             payload["reply_markup"] = '{"remove_keyboard": true}'
         data = self.requester.do_method(token=self.token, method="sendLocation", payload=payload)
@@ -514,10 +519,7 @@ class TelegramAgent(Agent):
             "latitude": location.latitude,
         }
         if keyboard is not None:
-            if hasattr(keyboard, "render"):
-                payload["reply_markup"] = keyboard.render()
-            else:
-                payload["reply_markup"] = TelegramKeyboard.default_render(keyboard)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         elif remove_keyboard:
             payload["reply_markup"] = '{"remove_keyboard": true}'
         data = await self.requester.a_do_method(token=self.token, method="sendLocation",
@@ -551,7 +553,7 @@ class TelegramAgent(Agent):
             "disable_web_page_preview": not web_preview,
         }
         if keyboard is not None:
-            payload["reply_markup"] = keyboard.render()
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         if html:
             payload["parse_mode"] = "HTML"
         elif markdown:
@@ -569,7 +571,7 @@ class TelegramAgent(Agent):
             "disable_web_page_preview": not web_preview,
         }
         if keyboard is not None:
-            payload["reply_markup"] = keyboard.render()
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         if html:
             payload["parse_mode"] = "HTML"
         elif markdown:
@@ -585,7 +587,7 @@ class TelegramAgent(Agent):
                              markdown: bool = False):
         payload = {"chat_id": chat.id, "message_id": message.raw["id"], "caption": caption}
         if keyboard is not None:
-            payload["reply_markup"] = keyboard.render()
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         if html:
             payload["parse_mode"] = "HTML"
         elif markdown:
@@ -597,7 +599,7 @@ class TelegramAgent(Agent):
                                      html: bool = False, markdown: bool = False):
         payload = {"chat_id": chat.id, "message_id": message.raw["id"], "caption": caption}
         if keyboard is not None:
-            payload["reply_markup"] = keyboard.render()
+            payload["reply_markup"] = self.render_keyboard(keyboard)
         if html:
             payload["parse_mode"] = "HTML"
         elif markdown:
@@ -632,8 +634,8 @@ class TelegramAgent(Agent):
             media_payload["parse_mode"] = "HTML"
         media_payload.update(raw)
         if keyboard is not None:
-            payload["reply_markup"] = keyboard.render()
-        payload["media"] = json.dumps(media_payload)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
+        payload["media"] = codec.dumps(media_payload)
 
         self.requester.do_method(token=self.token, method="editMessageMedia", payload=payload,
                                  files=files)
@@ -665,8 +667,8 @@ class TelegramAgent(Agent):
             media_payload["parse_mode"] = "HTML"
         media_payload.update(raw)
         if keyboard:
-            payload["reply_markup"] = keyboard.render()
-        payload["media"] = json.dumps(media_payload)
+            payload["reply_markup"] = self.render_keyboard(keyboard)
+        payload["media"] = codec.dumps(media_payload)
         await self.requester.a_do_method(token=self.token, method="edtMessageMedia",
                                          payload=payload, files=files)
 
@@ -817,7 +819,7 @@ class TelegramAgent(Agent):
         payload = {
             "chat_id": chat.id,
             "message_id": message.raw["id"],
-            "reply_markup": keyboard.render(),
+            "reply_markup": self.render_keyboard(keyboard),
         }
         self.requester.do_method(token=self.token, method="editMessageReplyMarkup", payload=payload)
 
@@ -826,7 +828,7 @@ class TelegramAgent(Agent):
         payload = {
             "chat_id": chat.id,
             "message_id": message.raw["id"],
-            "reply_markup": keyboard.render(),
+            "reply_markup": self.render_keyboard(keyboard),
         }
         await self.requester.a_do_method(token=self.token, method="editMessageReplyMarkup",
                                          payload=payload)
@@ -1,12 +1,15 @@
 from __future__ import annotations
 from datetime import datetime
-import json
-from typing import Iterator, Optional, Union
+from typing import Callable, Hashable, Iterator, Optional, Union
 
-from botovod.agents.types import Attachment, Chat, Keyboard, KeyboardButton, Location, Message
+from botovod.agents.types import (Attachment, Chat, Keyboard, KeyboardButton, Location, Message,
+                                  lazy)
+from botovod.utils import codec
 
 
 class TelegramUser(Chat):
+    __slots__ = ()
+
     def __init__(self, agent, id: int, is_bot: bool, first_name: str,
                  last_name: Optional[str] = None, username: Optional[str] = None,
                  language: Optional[str] = None):
@@ -38,6 +41,8 @@ class TelegramUser(Chat):
 
 
 class TelegramChat(Chat):
+    __slots__ = ()
+
     def __init__(self, agent, id: int, type: str, title: Optional[str] = None,
                  username: Optional[str] = None, first_name: Optional[str] = None,
                  last_name: Optional[str] = None, photo: Optional[dict] = None,
@@ -103,6 +108,8 @@ class TelegramChat(Chat):
 
 # Нужны остальные необязательные поля
 class TelegramMessage(Message):
+    __slots__ = ()
+
     def __init__(self, id: int, datetime: int, chat: dict, text: Optional[str] = None,
                  images: Iterator[Attachment] = (), audios: Iterator[Attachment] = (),
                  videos: Iterator[Attachment] = (), documents: Iterator[Attachment] = (),
@@ -113,21 +120,18 @@ class TelegramMessage(Message):
 
     @classmethod
     def parse(cls, data: dict, agent=None):
-        images = []
-        audios = []
-        videos = []
-        documents = []
-        locations = []
+        # Messages without attachments share the empty tuple instead of five empty lists
+        images = audios = videos = documents = locations = ()
         if "photo" in data:
-            images.append(TelegramAttachment.parse(data=data["photo"][-1], agent=agent))
+            images = (TelegramAttachment.parse(data=data["photo"][-1], agent=agent),)
         if "audio" in data:
-            audios.append(TelegramAttachment.parse(data=data["audio"], agent=agent))
+            audios = (TelegramAttachment.parse(data=data["audio"], agent=agent),)
         if "video" in data:
-            videos.append(TelegramAttachment.parse(data=data["video"], agent=agent))
+            videos = (TelegramAttachment.parse(data=data["video"], agent=agent),)
         if "document" in data:
-            documents.append(TelegramAttachment.parse(data=data["document"], agent=agent))
+            documents = (TelegramAttachment.parse(data=data["document"], agent=agent),)
         if "location" in data:
-            locations.append(TelegramLocation.parse(data=data["location"]))
+            locations = (TelegramLocation.parse(data=data["location"]),)
         raw = {"contact": data.get("contact")}
         return cls(
             id=data["message_id"],
@@ -144,21 +148,17 @@ class TelegramMessage(Message):
 
     @classmethod
     async def a_parse(cls, data: dict, agent=None):
-        images = []
-        audios = []
-        videos = []
-        documents = []
-        locations = []
+        images = audios = videos = documents = locations = ()
         if "photo" in data:
-            images.append(await TelegramAttachment.a_parse(data=data["photo"][-1], agent=agent))
+            images = (await TelegramAttachment.a_parse(data=data["photo"][-1], agent=agent),)
         if "audio" in data:
-            audios.append(await TelegramAttachment.a_parse(data=data["audio"], agent=agent))
+            audios = (await TelegramAttachment.a_parse(data=data["audio"], agent=agent),)
         if "video" in data:
-            videos.append(await TelegramAttachment.a_parse(data=data["video"], agent=agent))
+            videos = (await TelegramAttachment.a_parse(data=data["video"], agent=agent),)
         if "document" in data:
-            documents.append(await TelegramAttachment.a_parse(data=data["document"], agent=agent))
+            documents = (await TelegramAttachment.a_parse(data=data["document"], agent=agent),)
         if "location" in data:
-            locations.append(TelegramLocation.parse(data=data["location"]))
+            locations = (TelegramLocation.parse(data=data["location"]),)
         raw = {"contact": data.get("contact")}
         return cls(
             id=data["message_id"],
@@ -193,11 +193,13 @@ class TelegramMessage(Message):
 
     @property
     def contact(self):
-        if "contact" in self.raw:
+        if self.raw.get("contact") is not None:
             return TelegramContact.parse(self.raw["contact"])
 
 
 class TelegramCallback(Message):
+    __slots__ = ()
+
     def __init__(self, id: str, user: dict, message: Optional[dict] = None,
                  inline_message_id: Optional[str] = None, chat_instance: Optional[str] = None,
                  data: Optional[str] = None, game_short_name: Optional[str] = None):
@@ -235,8 +237,14 @@ class TelegramCallback(Message):
         if self.raw.get("message") is not None:
             return TelegramMessage.parse(data=self.raw["message"])
 
+    def get_button_key(self) -> Optional[Hashable]:
+        # Callback data lives apart from texts, so a typed text doesn't press an inline button
+        return None if self.text is None else ("callback", self.text)
+
 
 class TelegramAttachment(Attachment):
+    __slots__ = ()
+
     def __init__(self, url: Optional[str] = None, filepath: Optional[str] = None,
                  id: Optional[str] = None, size: Optional[int] = None):
         super().__init__(url=url, filepath=filepath, id=id, size=size)
@@ -281,6 +289,8 @@ class TelegramAttachment(Attachment):
 
 
 class TelegramLocation(Location):
+    __slots__ = ()
+
     def __init__(self, latitude: float, longitude: float):
         super().__init__(latitude=latitude, longitude=longitude)
 
@@ -293,6 +303,8 @@ class TelegramLocation(Location):
 
 
 class TelegramContact:
+    __slots__ = ("phone", "first_name", "last_name", "user_id", "vcard")
+
     def __init__(self, phone: str, first_name: str, last_name: Optional[str] = None,
                  user_id: Optional[int] = None, vcard: Optional[str] = None):
         self.phone = phone
@@ -323,6 +335,8 @@ class TelegramContact:
 
 
 class TelegramVenue(Location):
+    __slots__ = ()
+
     def __init__(self, latitude: float, longitude: float):
         super().__init__(latitude=latitude, longitude=longitude)
 
@@ -332,6 +346,8 @@ class TelegramVenue(Location):
 
 
 class TelegramKeyboard(Keyboard):
+    __slots__ = ()
+
     def __init__(self, buttons: Iterator[Iterator[Union[KeyboardButton, str]]],
                  resize: bool = False, one_time: bool = False, selective: bool = False):
         super().__init__(buttons=buttons, resize=resize, one_time=one_time, selective=selective)
@@ -353,7 +369,7 @@ class TelegramKeyboard(Keyboard):
                     line_data.append(button.render())
                 else:
                     line_data.append(button.text)
-        return json.dumps(data)
+        return codec.dumps(data)
 
     @staticmethod
     def default_render(keyboard: Keyboard):
@@ -363,10 +379,12 @@ class TelegramKeyboard(Keyboard):
             data["keyboard"].append(line_data)
             for button in line:
                 line_data.append(button.text)
-        return json.dumps(data)
+        return codec.dumps(data)
 
 
 class TelegramInlineKeyboard(Keyboard):
+    __slots__ = ()
+
     def __init__(self, buttons: Iterator[Iterator[TelegramInlineKeyboardButton]]):
         super().__init__(buttons=buttons)
 
@@ -377,12 +395,21 @@ class TelegramInlineKeyboard(Keyboard):
             data["inline_keyboard"].append(line_data)
             for button in line:
                 line_data.append(button.render())
-        return json.dumps(data)
+        return codec.dumps(data)
 
 
 class TelegramKeyboardButton(KeyboardButton):
-    def __init__(self, text: str, contact: bool = False, location: bool = False):
-        super().__init__(text=text, contact=contact, location=location)
+    __slots__ = ()
+
+    def __init__(self, text: str, contact: bool = False, location: bool = False,
+                 handler: Optional[Callable] = None):
+        super().__init__(text=text, handler=handler, contact=contact, location=location)
+
+    def get_key(self) -> Optional[Hashable]:
+        # Contact and location buttons send no text
+        if self.raw["contact"] or self.raw["location"]:
+            return None
+        return self.text
 
     def render(self):
         return {
@@ -393,11 +420,16 @@ class TelegramKeyboardButton(KeyboardButton):
 
 
 class TelegramInlineKeyboardButton(KeyboardButton):
+    __slots__ = ()
+
     def __init__(self, text: str, url: Optional[str] = None, data: Optional[str] = None,
                  inline_query: Optional[str] = None, inline_chat: Optional[str] = None,
-                 game: Optional[dict] = None):
-        super().__init__(text=text, url=url, data=data, inline_query=inline_query,
-                         inline_chat=inline_chat, game=game)
+                 game: Optional[dict] = None, handler: Optional[Callable] = None):
+        super().__init__(text=text, handler=handler, url=url, data=data,
+                         inline_query=inline_query, inline_chat=inline_chat, game=game)
+
+    def get_key(self) -> Optional[Hashable]:
+        return None if self.raw.get("data") is None else ("callback", self.raw["data"])
 
     def render(self):
         data = {"text": self.text}
@@ -412,3 +444,148 @@ class TelegramInlineKeyboardButton(KeyboardButton):
         if self.raw.get("game") is not None:
             data["callback_game"] = self.raw["game"]
         return data
+
+
+# Views wrap the decoded update and build fields and sub-objects on the first access, so an update
+# which is only matched by its text doesn't build the rest. They are instances of the entity types
+# above and behave the same way
+class TelegramUserView(TelegramUser):
+    __slots__ = ("data", "_raw")
+
+    FIELDS = {
+        "is_bot": "is_bot",
+        "first_name": "first_name",
+        "last_name": "last_name",
+        "username": "username",
+        "language": "language_code",
+    }
+
+    def __init__(self, agent, data: dict):
+        self.agent = agent
+        self.id = str(data["id"])
+        self.data = data
+
+    def __getattr__(self, item):
+        if item in self.FIELDS:
+            return self.data.get(self.FIELDS[item])
+        return super().__getattr__(item)
+
+    @lazy
+    def raw(self) -> dict:
+        return {name: self.data.get(key) for name, key in self.FIELDS.items()}
+
+
+class TelegramChatView(TelegramChat):
+    __slots__ = ("data", "_raw")
+
+    FIELDS = {
+        "type": "type",
+        "title": "title",
+        "username": "username",
+        "first_name": "first_name",
+        "last_name": "last_name",
+        "photo": "photo",
+        "description": "description",
+        "invite_link": "invite_link",
+        "pinned_message": "pinned_message",
+        "permissions": "permissions",
+        "sticker_set": "sticker_set_name",
+        "can_set_sticker": "can_set_sticker_set",
+    }
+
+    def __init__(self, agent, data: dict):
+        self.agent = agent
+        self.id = str(data["id"])
+        self.data = data
+
+    def __getattr__(self, item):
+        if item in self.FIELDS:
+            return self.data.get(self.FIELDS[item])
+        return super().__getattr__(item)
+
+    @lazy
+    def raw(self) -> dict:
+        return {name: self.data.get(key) for name, key in self.FIELDS.items()}
+
+
+class TelegramMessageView(TelegramMessage):
+    __slots__ = ("data", "agent", "_raw", "_text", "_images", "_audios", "_videos", "_documents",
+                 "_locations", "_chat")
+
+    def __init__(self, data: dict, agent=None):
+        self.data = data
+        self.agent = agent
+
+    @classmethod
+    def parse(cls, data: dict, agent=None):
+        return cls(data=data, agent=agent)
+
+    @classmethod
+    async def a_parse(cls, data: dict, agent=None):
+        # Files without a path are asked from Telegram, that can't be done lazily in async code,
+        # so attachments the message has are built here, the rest stays lazy
+        view = cls(data=data, agent=agent)
+        if "photo" in data:
+            view.images = (await TelegramAttachment.a_parse(data=data["photo"][-1], agent=agent),)
+        if "audio" in data:
+            view.audios = (await TelegramAttachment.a_parse(data=data["audio"], agent=agent),)
+        if "video" in data:
+            view.videos = (await TelegramAttachment.a_parse(data=data["video"], agent=agent),)
+        if "document" in data:
+            view.documents = (await TelegramAttachment.a_parse(data=data["document"],
+                                                               agent=agent),)
+        return view
+
+    def get_attachments(self, key: str) -> tuple:
+        if key not in self.data:
+            return ()
+        data = self.data[key][-1] if key == "photo" else self.data[key]
+        return (TelegramAttachment.parse(data=data, agent=self.agent),)
+
+    @lazy
+    def raw(self) -> dict:
+        return {
+            "id": self.data["message_id"],
+            "datetime": self.data["date"],
+            "chat": self.data.get("chat"),
+            "contact": self.data.get("contact"),
+        }
+
+    @lazy
+    def text(self) -> Optional[str]:
+        return self.data.get("text")
+
+    @lazy
+    def images(self) -> tuple:
+        return self.get_attachments("photo")
+
+    @lazy
+    def audios(self) -> tuple:
+        return self.get_attachments("audio")
+
+    @lazy
+    def videos(self) -> tuple:
+        return self.get_attachments("video")
+
+    @lazy
+    def documents(self) -> tuple:
+        return self.get_attachments("document")
+
+    @lazy
+    def locations(self) -> tuple:
+        if "location" not in self.data:
+            return ()
+        return (TelegramLocation.parse(data=self.data["location"]),)
+
+    @property
+    def datetime(self) -> datetime:
+        return datetime.utcfromtimestamp(self.data["date"])
+
+    @lazy
+    def chat(self) -> Chat:
+        return TelegramChatView(agent=self.agent, data=self.data["chat"])
+
+    @property
+    def contact(self):
+        if self.data.get("contact") is not None:
+            return TelegramContact.parse(self.data["contact"])
@@ -1,18 +1,51 @@
 from __future__ import annotations
-from typing import Iterator, Optional
+from typing import Callable, Hashable, Iterator, Optional
 
 
+# Field computed on the first access and kept in the slot named after it with a leading underscore,
+# assigning the field sets the slot
+class lazy:
+    def __init__(self, function: Callable):
+        self.function = function
+        self.slot = None
+
+    def __set_name__(self, owner, name: str):
+        self.slot = owner.__dict__["_" + name]
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            value = self.function(instance)
+            self.slot.__set__(instance, value)
+            return value
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+
+# Entities keep their fields in slots. Subclasses declare __slots__ too (an empty tuple if they
+# add no fields). __dict__ stays for attributes set by user code, Python creates it only when the
+# first of them is set, so entities without such attributes don't pay for it
 class Entity:
+    __slots__ = ("raw", "__dict__")
+
     def __init__(self, **raw):
         self.raw = raw
 
     def __getattr__(self, item):
-        if item in self.raw:
+        # raw is missing until __init__ runs (e.g. while unpickling), so neither raw itself nor
+        # special names looked up by pickle and copy are searched in it
+        if item != "raw" and not item.startswith("__") and item in self.raw:
             return self.raw[item]
         return super().__getattribute__(item)
 
 
 class Chat(Entity):
+    __slots__ = ("agent", "id")
+
     def __init__(self, agent, id: str, **raw):
         super().__init__(**raw)
         self.agent = agent
@@ -20,6 +53,8 @@ class Chat(Entity):
 
 
 class Message(Entity):
+    __slots__ = ("text", "images", "audios", "videos", "documents", "locations")
+
     def __init__(self, text: Optional[str] = None, images: Iterator[Attachment] = (),
                  audios: Iterator[Attachment] = (), videos: Iterator[Attachment] = (),
                  documents: Iterator[Attachment] = (), locations: Iterator[Location] = (), **raw):
@@ -31,8 +66,14 @@ class Message(Entity):
         self.documents = documents
         self.locations = locations
 
+    def get_button_key(self) -> Optional[Hashable]:
+        # Key of the button whose press sent the message, see KeyboardButton.get_key
+        return self.text
+
 
 class Attachment(Entity):
+    __slots__ = ("url", "filepath")
+
     def __init__(self, url: Optional[str] = None, filepath: Optional[str] = None, **raw):
         super().__init__(**raw)
         self.url = url
@@ -40,6 +81,8 @@ class Attachment(Entity):
 
 
 class Location(Entity):
+    __slots__ = ("latitude", "longitude")
+
     def __init__(self, latitude: float, longitude: float, **raw):
         super().__init__(**raw)
         self.latitude = latitude
@@ -47,12 +90,22 @@ class Location(Entity):
 
 
 class Keyboard(Entity):
+    __slots__ = ("buttons",)
+
     def __init__(self, buttons: Iterator[Iterator[KeyboardButton]], **raw):
         super().__init__(**raw)
         self.buttons = buttons
 
 
 class KeyboardButton(Entity):
-    def __init__(self, text: str, **raw):
+    __slots__ = ("text", "handler")
+
+    def __init__(self, text: str, handler: Optional[Callable] = None, **raw):
         super().__init__(**raw)
         self.text = text
+        self.handler = handler
+
+    def get_key(self) -> Optional[Hashable]:
+        # Botovod routes a message to the handler of the button whose key equals the
+        # get_button_key of the message, None means presses can't be told apart
+        return self.text
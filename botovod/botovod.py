@@ -1,15 +1,108 @@
-from typing import Callable, Dict, Iterable, Optional, Tuple
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-from .agents import Agent
+from .agents import Agent, Chat, Keyboard, KeyboardButton, Message
+from .context import Context, adapt_handler
 from .dbdrivers import DBDriver 
-from .exceptions import AgentNotExistException
+from .exceptions import AgentNotExistException, HandlerNotPassed
 
 
+class HandlerSnapshot:
+    # Handlers are never changed in place, a change builds a new snapshot and swaps it in, so an
+    # update goes through the handlers it started with. Handlers tagged by only_agent are left out
+    # of the handlers of other agents. Indexes keep handlers adapted to take the context
+    __slots__ = ("handlers", "common", "agents", "preparers")
+
+    def __init__(self, handlers: Tuple[Callable, ...] = ()):
+        self.handlers = handlers
+        adapted = [(getattr(handler, "botovod_agent", None), adapt_handler(handler))
+                   for handler in handlers]
+        self.common = tuple(handler for name, handler in adapted if name is None)
+        # Handlers scoring all messages of a request at once before they are handled one by one
+        self.preparers = tuple(handler for handler in handlers
+                               if hasattr(handler, "botovod_prepare"))
+        self.agents = {}
+        for agent_name in {name for name, _ in adapted if name is not None}:
+            self.agents[agent_name] = tuple(handler for name, handler in adapted
+                                            if name is None or name == agent_name)
+
+    def get(self, agent_name: Optional[str]) -> Tuple[Callable, ...]:
+        return self.agents.get(agent_name, self.common)
+
+
+class HandlerGroup:
+    # Handlers of a group exclude each other, so they are tried in any order. Hits are counted and
+    # every reorder_every hits the handlers matching most often are moved first and the counts are
+    # halved, so the order follows the traffic. For Botovod the group is one handler, registration
+    # order still applies across groups
+    botovod_context = True
+
+    def __init__(self, *handlers: Callable, reorder_every: int = 100):
+        self.handlers = handlers
+        self.reorder_every = reorder_every
+        self.order = tuple(enumerate(adapt_handler(handler) for handler in handlers))
+        self.hits = [0] * len(handlers)
+        self.count = 0
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}{self.handlers!r}"
+
+    def __call__(self, context: Context):
+        for index, handler in self.order:
+            try:
+                result = handler(context)
+            except HandlerNotPassed:
+                continue
+            self.hit(index)
+            return result
+        raise HandlerNotPassed
+
+    def hit(self, index: int):
+        # Counts aren't locked, a lost hit only makes the order a bit less exact
+        self.hits[index] += 1
+        self.count += 1
+        if self.count >= self.reorder_every:
+            self.reorder()
+
+    def reorder(self):
+        self.count = 0
+        hits = self.hits
+        # Order is swapped in, so a call going through the old one isn't disturbed
+        self.order = tuple(sorted(self.order, key=lambda item: (-hits[item[0]], item[0])))
+        self.hits = [count // 2 for count in hits]
+
+
+class AsyncHandlerGroup(HandlerGroup):
+    async def __call__(self, context: Context):
+        for index, handler in self.order:
+            try:
+                result = await handler(context)
+            except HandlerNotPassed:
+                continue
+            self.hit(index)
+            return result
+        raise HandlerNotPassed
+
+
+# A follower changed by another update while an update was handled raises
+# FollowerConflictException, the agent then handles the update again from the start, up to
+# conflict_retries times. Everything handlers did before the conflict is done again, so they must
+# be idempotent: a reply sent before a follower write is sent once more on every retry
 class Botovod:
-    def __init__(self, dbdriver: Optional[DBDriver] = None):
+    def __init__(self, dbdriver: Optional[DBDriver] = None, history: bool = False,
+                 conflict_retries: int = 3, max_buttons: int = 10000):
+        if history and dbdriver is not None and not dbdriver.keeps_history:
+            raise ValueError(f"{type(dbdriver).__module__}.DBDriver doesn't keep history")
         self._dbdriver = dbdriver
+        self.history = history
+        self.conflict_retries = conflict_retries
         self._agents = {}
-        self._handlers = []
+        self._handlers = HandlerSnapshot()
+        self._handlers_lock = Lock()
+        self._buttons = OrderedDict()
+        self._buttons_lock = Lock()
+        self.max_buttons = max_buttons
         self._items = {}
 
     def __setitem__(self, name: str, value):
@@ -26,26 +119,89 @@ class Botovod:
         return self._dbdriver
 
     @property
-    def handlers(self):
-        return self._handlers.copy()
+    def items(self) -> Dict[str, Any]:
+        return self._items
+
+    @property
+    def handlers(self) -> List[Callable]:
+        # A copy, handlers are changed by the methods below
+        return list(self._handlers.handlers)
 
     def get(self, name: str, default=None):
         return self._items.get(name, default)
 
+    def get_handlers(self, agent_name: Optional[str] = None) -> Tuple[Callable, ...]:
+        return self._handlers.get(agent_name)
+
+    def prepare_handlers(self, messages: List[Tuple[Chat, Message]]) -> List[Dict[Callable, Any]]:
+        # Preparers return a result for every message, results of a message go to its context by
+        # handler, so requests handled at the same time don't share them
+        prepared = [{} for _ in messages]
+        for handler in self._handlers.preparers:
+            for results, result in zip(prepared, handler.botovod_prepare(messages)):
+                results[handler] = result
+        return prepared
+
+    def set_handlers(self, handlers: Iterable[Callable]):
+        with self._handlers_lock:
+            self._handlers = HandlerSnapshot(tuple(handlers))
+
     def add_handlers(self, *handlers: Iterable[Callable]):
-        self._handlers.extend(handlers)
+        with self._handlers_lock:
+            self._handlers = HandlerSnapshot(self._handlers.handlers + handlers)
 
     def add_handler(self, handler: Callable):
-        self._handlers.append(handler)
+        self.add_handlers(handler)
 
     def remove_handler(self, handler: Callable):
-        for index in range(len(self._handlers)):
-            if self._handlers[index] is handler:
-                del self._handlers[index]
-                break
+        with self._handlers_lock:
+            handlers = self._handlers.handlers
+            for index in range(len(handlers)):
+                if handlers[index] is handler:
+                    self._handlers = HandlerSnapshot(handlers[:index] + handlers[index + 1:])
+                    break
 
     def clear_handlers(self):
-        self._handlers.clear()
+        self.set_handlers(())
+
+    def add_buttons(self, *buttons: KeyboardButton):
+        # Handlers of buttons are found by the key of the pressed button in one lookup, a button
+        # with the same key replaces the old one. Agents add the buttons of every keyboard they
+        # send, so keys made for one message (item ids, pages) come and go: only max_buttons
+        # keys are kept and the one least recently added or pressed is dropped first
+        with self._buttons_lock:
+            for button in buttons:
+                handler = getattr(button, "handler", None)
+                if handler is None:
+                    continue
+                key = button.get_key()
+                if key is None:
+                    continue
+                if self._buttons.get(key, (None,))[0] is not handler:
+                    self._buttons[key] = (handler, adapt_handler(handler))
+                self._buttons.move_to_end(key)
+            while len(self._buttons) > self.max_buttons:
+                self._buttons.popitem(last=False)
+
+    def add_keyboard(self, keyboard: Keyboard):
+        self.add_buttons(*(button for line in keyboard.buttons for button in line))
+
+    def remove_buttons(self, *buttons: KeyboardButton):
+        with self._buttons_lock:
+            for button in buttons:
+                if hasattr(button, "get_key"):
+                    self._buttons.pop(button.get_key(), None)
+
+    def get_button_handler(self, message: Message) -> Optional[Callable]:
+        if not self._buttons:
+            return None
+        key = message.get_button_key()
+        with self._buttons_lock:
+            button = self._buttons.get(key)
+            if button is None:
+                return None
+            self._buttons.move_to_end(key)
+        return button[1]
 
     @property
     def agents(self):
@@ -102,11 +258,11 @@ class Botovod:
         if name not in self._agents:
             raise AgentNotExistException(name)
 
-        return self._agents[name].listen(headers, body, **self._items)
+        return self._agents[name].listen(headers, body)
 
     async def a_listen(self, name: str, headers: Dict[str, str],
                        body: str) -> (Tuple[int, Dict[str, str], str], None):
         if name not in self._agents:
             raise AgentNotExistException(name)
 
-        return await self._agents[name].a_listen(headers, body, **self._items)
+        return await self._agents[name].a_listen(headers, body)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+from functools import wraps
+import inspect
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from botovod import Botovod
+    from botovod.agents import Agent, Chat, Message
+    from botovod.dbdrivers import Follower
+
+
+class Context:
+    # One object for an update, passed by reference to every handler and dialog trying it. Items
+    # are the items of Botovod (not copied), locals live only while the update is handled.
+    # Prepared keeps what handlers computed for this update while preparing the whole request,
+    # by handler
+    __slots__ = ("agent", "chat", "message", "follower", "items", "locals", "prepared")
+
+    def __init__(self, agent: Agent, chat: Chat, message: Message,
+                 follower: Optional[Follower] = None, items: Optional[Dict[str, Any]] = None,
+                 prepared: Optional[Dict[Callable, Any]] = None):
+        self.agent = agent
+        self.chat = chat
+        self.message = message
+        self.follower = follower
+        self.items = {} if items is None else items
+        self.locals = {}
+        self.prepared = {} if prepared is None else prepared
+
+    def __repr__(self) -> str:
+        return f"Context(agent={self.agent!r}, chat={self.chat!r})"
+
+    def __getitem__(self, name: str) -> Any:
+        if name in self.locals:
+            return self.locals[name]
+        return self.items[name]
+
+    def __setitem__(self, name: str, value: Any):
+        self.locals[name] = value
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.locals or name in self.items
+
+    @property
+    def botovod(self) -> Optional[Botovod]:
+        return self.agent.botovod
+
+    def get(self, name: str, default: Any = None) -> Any:
+        if name in self.locals:
+            return self.locals[name]
+        return self.items.get(name, default)
+
+
+def takes_context(handler: Callable) -> bool:
+    # Handler takes the context when it's marked (dialogs are) or its first parameter is named
+    # "context", other handlers take agent, chat, message, follower and items as keywords
+    if getattr(handler, "botovod_context", False):
+        return True
+    try:
+        parameters = inspect.signature(handler, follow_wrapped=False).parameters
+    except (TypeError, ValueError):
+        return False
+    return next(iter(parameters), None) == "context"
+
+
+def adapt_handler(handler: Callable) -> Callable[[Context], Any]:
+    if takes_context(handler):
+        return handler
+
+    @wraps(handler)
+    def adapter(context: Context):
+        return handler(context.agent, context.chat, context.message, context.follower,
+                       **context.items)
+
+    return adapter
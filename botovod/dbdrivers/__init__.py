@@ -1 +1,2 @@
-from .dbdrivers import DBDriver, Follower
+from .dbdrivers import (INDEX_VALUE_LENGTH, DBDriver, Follower, check_filter, check_values,
+                        make_index_value)
@@ -1,6 +1,43 @@
 from __future__ import annotations
-from botovod.agents import Agent, Chat
-from typing import Dict, Optional
+from botovod.agents import Agent, Chat, Message
+from datetime import datetime
+import json
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+FILTER_FIELDS = ("dialog", "next_step")
+INDEX_VALUE_LENGTH = 255
+ImportRow = Tuple[Chat, Optional[str], Optional[str], Dict[str, Any]]
+
+
+def check_filter(filter: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, Optional[str]]:
+    if filter is None:
+        return {}
+    for name in filter:
+        if name not in FILTER_FIELDS:
+            raise ValueError(f"Cannot filter followers by '{name}'")
+    return filter
+
+
+# Indexed values are kept as json, the same way as values themselves, values longer than
+# INDEX_VALUE_LENGTH are not indexed
+def make_index_value(value: Any) -> Optional[str]:
+    value = json.dumps(value)
+    return value if len(value) <= INDEX_VALUE_LENGTH else None
+
+
+def check_values(indexed_values: Iterable[str],
+                 values: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    if values is None:
+        return {}
+    index_values = {}
+    for name, value in values.items():
+        if name not in indexed_values:
+            raise ValueError(f"Value '{name}' is not indexed")
+        index_values[name] = make_index_value(value)
+        if index_values[name] is None:
+            raise ValueError(f"Value of '{name}' is too long to be indexed")
+    return index_values
 
 
 class Follower:
@@ -64,8 +101,45 @@ class Follower:
     async def a_clear_values(self):
         raise NotImplementedError
 
+    def add_history(self, message: Message, input: bool = True):
+        raise NotImplementedError
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        raise NotImplementedError
+
+    def get_history(self, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        raise NotImplementedError
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        raise NotImplementedError
+
+    def clear_history(self, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None):
+        raise NotImplementedError
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        raise NotImplementedError
+
+    def search_history(self, query: str, after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        raise NotImplementedError
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        raise NotImplementedError
+
 
 class DBDriver:
+    # Drivers which implement history of followers set it, Botovod(history=True) needs one
+    keeps_history = False
+
     def connect(self, **settings):
         raise NotImplementedError
 
@@ -78,6 +152,28 @@ class DBDriver:
     async def a_close(self):
         raise NotImplementedError
 
+    def finish(self, follower: Optional[Follower] = None):
+        pass
+
+    async def a_finish(self, follower: Optional[Follower] = None):
+        pass
+
+    # Called instead of finish when handling the update failed. Drivers writing changes on finish
+    # drop them here, for others it is the same as finish
+    def discard(self, follower: Optional[Follower] = None):
+        self.finish(follower)
+
+    async def a_discard(self, follower: Optional[Follower] = None):
+        await self.a_finish(follower)
+
+    # Loads values of many followers by one query, so get_values of them doesn't query. Drivers
+    # keeping values with the follower have nothing to load
+    def prefetch_values(self, followers: List[Follower]):
+        pass
+
+    async def a_prefetch_values(self, followers: List[Follower]):
+        pass
+
     def get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
         raise NotImplementedError
 
@@ -90,8 +186,100 @@ class DBDriver:
     async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
         raise NotImplementedError
 
+    def get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = self.get_follower(agent, chat)
+        if follower is None:
+            follower = self.add_follower(agent, chat)
+        return follower
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = await self.a_get_follower(agent, chat)
+        if follower is None:
+            follower = await self.a_add_follower(agent, chat)
+        return follower
+
+    def get_followers(self, agent: Agent, chats: Iterable[Chat]) -> List[Optional[Follower]]:
+        return [self.get_follower(agent, chat) for chat in chats]
+
+    async def a_get_followers(self, agent: Agent,
+                              chats: Iterable[Chat]) -> List[Optional[Follower]]:
+        return [await self.a_get_follower(agent, chat) for chat in chats]
+
+    def add_followers(self, agent: Agent, chats: Iterable[Chat]) -> List[Follower]:
+        return [self.add_follower(agent, chat) for chat in chats]
+
+    async def a_add_followers(self, agent: Agent, chats: Iterable[Chat]) -> List[Follower]:
+        return [await self.a_add_follower(agent, chat) for chat in chats]
+
+    def get_or_create_followers(self, agent: Agent, chats: Iterable[Chat]) -> List[Follower]:
+        return [self.get_or_create_follower(agent, chat) for chat in chats]
+
+    async def a_get_or_create_followers(self, agent: Agent,
+                                        chats: Iterable[Chat]) -> List[Follower]:
+        return [await self.a_get_or_create_follower(agent, chat) for chat in chats]
+
+    # Rows are (chat, dialog, next_step, values). A follower of a row is created or, if it exists,
+    # overwritten with the row, values it had before are removed
+    def import_followers(self, agent: Agent, rows: Iterable[ImportRow]):
+        rows = list(rows)
+        followers = self.get_or_create_followers(agent, [chat for chat, _, _, _ in rows])
+        for (_, dialog, next_step, values), follower in zip(rows, followers):
+            follower.set_dialog(dialog)
+            follower.set_next_step(next_step)
+            follower.clear_values()
+            for name, value in values.items():
+                follower.set_value(name, value)
+            self.finish(follower)
+
+    async def a_import_followers(self, agent: Agent, rows: Iterable[ImportRow]):
+        rows = list(rows)
+        followers = await self.a_get_or_create_followers(agent, [chat for chat, _, _, _ in rows])
+        for (_, dialog, next_step, values), follower in zip(rows, followers):
+            await follower.a_set_dialog(dialog)
+            await follower.a_set_next_step(next_step)
+            await follower.a_clear_values()
+            for name, value in values.items():
+                await follower.a_set_value(name, value)
+            await self.a_finish(follower)
+
+    def iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None,
+                       after_id: int = 0) -> Iterator[Follower]:
+        raise NotImplementedError
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        raise NotImplementedError
+
+    def reindex_values(self):
+        pass
+
+    async def a_reindex_values(self):
+        pass
+
     def delete(self, follower: Follower):
         raise NotImplementedError
 
     async def a_delete(self, follower: Follower):
         raise NotImplementedError
+
+    def clear_history(self, before_date: datetime):
+        raise NotImplementedError
+
+    async def a_clear_history(self, before_date: datetime):
+        raise NotImplementedError
+
+    def search_history(self, query: str, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        raise NotImplementedError
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        raise NotImplementedError
@@ -1,130 +1,443 @@
-# from __future__ import annotations
-# from botovod import dbdrivers
-# from botovod.agents import Agent, Chat
-# from botovod.extensions.djangoapp.botovod import models
-# import json
-# from json import JSONDecodeError
-# import logging
-#
-#
-# class DBDriver(dbdrivers.DBDriver):
-#     @classmethod
-#     def connect(cls, **settings):
-#         pass
-#
-#     @classmethod
-#     def get_follower(cls, agent: Agent, chat: Chat) -> models.Follower:
-#         try:
-#             obj = models.Follower.objects.get(bot__name=agent.name, chat=chat.id)
-#         except models.Follower.DoesNotExist:
-#             return None
-#         return Follower(obj)
-#
-#     @classmethod
-#     def add_follower(cls, agent, chat):
-#         bot = models.Bot.objects.get(name=agent.name)
-#         obj = models.Follower(
-#             chat=chat.id,
-#             bot=bot,
-#         )
-#         obj.save()
-#         return Follower(obj)
-#
-#     @classmethod
-#     def delete_follower(cls, agent, chat):
-#         follower = models.Follower.objects.get(agent=agent.__class__.__name__, chat=chat.id)
-#         follower.delete()
-#
-#
-# class Follower(dbdrivers.Follower):
-#     def __init__(self, obj):
-#         self.obj = obj
-#
-#     def get_chat(self):
-#         return Chat(self.obj.bot.agent, self.obj.chat)
-#
-#     def get_dialog_name(self):
-#         return self.obj.dialog
-#
-#     def set_dialog_name(self, name):
-#         self.obj.dialog = name
-#         self.obj.save()
-#
-#     def get_next_step(self):
-#         return self.obj.next_step
-#
-#     def set_next_step(self, next_step):
-#         self.obj.next_step = next_step
-#         self.obj.save()
-#
-#     def get_history(self, after_date=None, before_date=None, input=None, text=None):
-#         messages = models.Message.objects.filter(follower=self.obj)
-#         if not after_date is None:
-#             messages = messages.filter(date__gt=after_date)
-#         if not before_date is None:
-#             messages = messages.filter(date__lt=before_date)
-#         if not input is None:
-#             messages = messages.filter(input=input)
-#         if not text is None:
-#             messages = messages.filter(text__iregex=text)
-#         return [message.to_object() for message in messages]
-#
-#     def add_history(self, message, input=True):
-#         message = models.Message(
-#             follower = self.obj,
-#             input = input,
-#             text = message.text,
-#             images = json.loads([models.attachment_render(image) for image in message.images]),
-#             audios = json.loads([models.attachment_render(audio) for audio in message.audios]),
-#             videos = json.loads([models.attachment_render(video) for video in message.videos]),
-#             documents = json.loads([
-#                 models.attachment_render(document) for document in message.documents
-#             ]),
-#             locations = json.loads([
-#                 models.location_render(location) for location in message.locations
-#             ]),
-#             raw = json.loads(message.raw),
-#             date = message.date,
-#         )
-#         message.save()
-#
-#     def clear_history(self, after_date=None, before_date=None, input=None, text=None):
-#         messages = models.Message.objects.filter(follower=self.obj)
-#         if not after_date is None:
-#             messages = messages.filter(date__gt=after_date)
-#         if not before_date is None:
-#             messages = messages.filter(date__lt=before_date)
-#         if not input is None:
-#             messages = messages.filter(input=input)
-#         messages.delete()
-#
-#     def get_value(self, name):
-#         try:
-#             return json.loads(self.obj.data)[name]
-#         except KeyError:
-#             logging.warning("Value '%s' doesn't exist for follower %s %s", name,
-#                             self.obj.bot.agent, self.obj.chat)
-#         except JSONDecodeError:
-#             logging.error("Cannot get value '%s' for follower %s %s - incorrect json",
-#                           name, self.obj.bot.agent, self.obj.chat)
-#
-#     def set_value(self, name, value):
-#         try:
-#             data = json.loads(self.obj.data)
-#         except JSONDecodeError:
-#             logging.error("Incorrect json structure for follower %s %s",
-#                             self.obj.bot.agent, self.obj.chat)
-#             data = dict()
-#         data[name] = value
-#         self.obj.data = json.dumps(data)
-#         self.obj.save()
-#
-#     def delete_value(self, name):
-#         data = json.loads(self.obj.data)
-#         try:
-#             del data[name]
-#         except KeyError:
-#             logging.warning("Cannot delete value '%s' for follower %s %s - doesn't exist",
-#                             name, self.obj.bot.agent, self.obj.chat)
-#         self.obj.data = json.dumps(data)
-#         self.obj.save()
+from __future__ import annotations
+from asgiref.sync import sync_to_async
+from botovod import dbdrivers
+from botovod.agents import Agent, Chat, Message
+from botovod.exceptions import FollowerConflictException
+from botovod.extensions.djangoapp.botovod import models
+from datetime import datetime
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+import logging
+from threading import Lock
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .history import (SEARCH_CONFIG, HistoryWriter, Record, make_record,
+                      make_sqlite_search_query, parse_record)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Search uses the full-text index made by the migration of the database vendor, other databases
+# look for every word in every message
+def get_search_query(query: str, follower_id: Optional[int] = None,
+                     after_date: Optional[datetime] = None,
+                     before_date: Optional[datetime] = None, cursor: Optional[str] = None):
+    messages = models.Message.objects.all()
+    table = models.Message._meta.db_table
+    vendor = connections[router.db_for_read(models.Message)].vendor
+    if vendor == "sqlite":
+        query = make_sqlite_search_query(query)
+        if not query:
+            return None
+        messages = messages.extra(
+            where=[f"{table}.id IN (SELECT rowid FROM {table}_search "
+                   f"WHERE {table}_search MATCH %s)"],
+            params=[query],
+        )
+    elif vendor == "postgresql":
+        messages = messages.extra(
+            where=[f"to_tsvector('{SEARCH_CONFIG}'::regconfig, {table}.text) @@ "
+                   f"plainto_tsquery('{SEARCH_CONFIG}'::regconfig, %s)"],
+            params=[query],
+        )
+    elif vendor == "mysql":
+        messages = messages.extra(where=[f"MATCH ({table}.text) AGAINST (%s)"], params=[query])
+    else:
+        words = query.split()
+        if not words:
+            return None
+        for word in words:
+            messages = messages.filter(text__icontains=word)
+    if follower_id is not None:
+        messages = messages.filter(follower_id=follower_id)
+    if after_date is not None:
+        messages = messages.filter(created_at__gt=after_date)
+    if before_date is not None:
+        messages = messages.filter(created_at__lt=before_date)
+    if cursor is not None:
+        messages = messages.filter(id__lt=int(cursor))
+    return messages.order_by("-id").values_list("id", "follower_id", "text", "data", "input",
+                                                "created_at")
+
+
+def make_search_page(rows: list, limit: int) -> Tuple[List[Message], Optional[str]]:
+    messages = [parse_record(text, data, input, created_at, follower_id=follower_id)
+                for _, follower_id, text, data, input, created_at in rows]
+    return messages, str(rows[-1][0]) if len(rows) >= limit else None
+
+
+# Every setter writes the columns it changed by filter(id, version).update() which also sets the
+# next version, so a follower changed by another update since it was read is not overwritten and
+# the setter raises FollowerConflictException
+class Follower(dbdrivers.Follower):
+    def __init__(self, dbdriver: DBDriver, obj: models.Follower):
+        self.dbdriver = dbdriver
+        self.obj = obj
+
+    @property
+    def id(self) -> int:
+        return self.obj.id
+
+    def get_chat(self) -> Chat:
+        return Chat(self.obj.bot, self.obj.chat)
+
+    async def a_get_chat(self) -> Chat:
+        return self.get_chat()
+
+    def save(self, *fields: str):
+        updated = models.Follower.objects.filter(id=self.obj.id, version=self.obj.version).update(
+            version=F("version") + 1, **{field: getattr(self.obj, field) for field in fields},
+        )
+        if not updated:
+            raise FollowerConflictException()
+        self.obj.version += 1
+
+    async def a_save(self, *fields: str):
+        updated = await models.Follower.objects.filter(
+            id=self.obj.id,
+            version=self.obj.version,
+        ).aupdate(version=F("version") + 1, **{field: getattr(self.obj, field) for field in fields})
+        if not updated:
+            raise FollowerConflictException()
+        self.obj.version += 1
+
+    def get_dialog(self) -> Optional[str]:
+        return self.obj.dialog
+
+    async def a_get_dialog(self) -> Optional[str]:
+        return self.obj.dialog
+
+    def set_dialog(self, name: Optional[str] = None):
+        self.obj.dialog = name
+        self.obj.next_step = None if name is None else "start"
+        self.save("dialog", "next_step")
+
+    async def a_set_dialog(self, name: Optional[str] = None):
+        self.obj.dialog = name
+        self.obj.next_step = None if name is None else "start"
+        await self.a_save("dialog", "next_step")
+
+    def get_next_step(self) -> Optional[str]:
+        return self.obj.next_step
+
+    async def a_get_next_step(self) -> Optional[str]:
+        return self.obj.next_step
+
+    def set_next_step(self, next_step: Optional[str] = None):
+        self.obj.next_step = next_step
+        self.save("next_step")
+
+    async def a_set_next_step(self, next_step: Optional[str] = None):
+        self.obj.next_step = next_step
+        await self.a_save("next_step")
+
+    def get_values(self) -> Dict[str, str]:
+        return self.obj.data.copy()
+
+    async def a_get_values(self) -> Dict[str, str]:
+        return self.obj.data.copy()
+
+    def get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.obj.data.get(name, default)
+
+    async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.obj.data.get(name, default)
+
+    # Values and their index are written in one transaction. Django has no async transactions,
+    # so the async setters run it in a thread, but only when an indexed value is changed, other
+    # values are written by one async update
+    def save_values(self, *names: str):
+        with transaction.atomic():
+            self.save("data")
+            self.dbdriver.update_index(self.obj, *names)
+
+    async def a_save_values(self, *names: str):
+        if any(name in self.dbdriver.indexed_values for name in names):
+            await sync_to_async(self.save_values)(*names)
+        else:
+            await self.a_save("data")
+
+    def set_value(self, name: str, value: str):
+        self.obj.data[name] = value
+        self.save_values(name)
+
+    async def a_set_value(self, name: str, value: str):
+        self.obj.data[name] = value
+        await self.a_save_values(name)
+
+    def delete_value(self, name: str):
+        if name in self.obj.data:
+            del self.obj.data[name]
+            self.save_values(name)
+
+    async def a_delete_value(self, name: str):
+        if name in self.obj.data:
+            del self.obj.data[name]
+            await self.a_save_values(name)
+
+    def clear_values(self):
+        names = list(self.obj.data)
+        self.obj.data = {}
+        self.save_values(*names)
+
+    async def a_clear_values(self):
+        names = list(self.obj.data)
+        self.obj.data = {}
+        await self.a_save_values(*names)
+
+    def get_history_query(self, after_date: Optional[datetime] = None,
+                          before_date: Optional[datetime] = None, input: Optional[bool] = None):
+        query = models.Message.objects.filter(follower_id=self.obj.id)
+        if after_date is not None:
+            query = query.filter(created_at__gt=after_date)
+        if before_date is not None:
+            query = query.filter(created_at__lt=before_date)
+        if input is not None:
+            query = query.filter(input=input)
+        return query
+
+    def add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    def get_history(self, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        self.dbdriver.flush_history()
+        query = self.get_history_query(after_date, before_date, input)
+        query = query.order_by("-created_at", "-id").values_list("text", "data", "input",
+                                                                 "created_at")
+        if limit is not None:
+            query = query[:limit]
+        return [parse_record(*row) for row in reversed(query)]
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        await sync_to_async(self.dbdriver.flush_history)()
+        query = self.get_history_query(after_date, before_date, input)
+        query = query.order_by("-created_at", "-id").values_list("text", "data", "input",
+                                                                 "created_at")
+        if limit is not None:
+            query = query[:limit]
+        rows = [row async for row in query]
+        return [parse_record(*row) for row in reversed(rows)]
+
+    def clear_history(self, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None):
+        self.dbdriver.flush_history()
+        self.get_history_query(after_date, before_date).delete()
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        await sync_to_async(self.dbdriver.flush_history)()
+        await self.get_history_query(after_date, before_date).adelete()
+
+    def search_history(self, query: str, after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self.dbdriver.search_history(query, follower=self, after_date=after_date,
+                                            before_date=before_date, limit=limit, cursor=cursor)
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return await self.dbdriver.a_search_history(query, follower=self, after_date=after_date,
+                                                    before_date=before_date, limit=limit,
+                                                    cursor=cursor)
+
+
+# Django is configured by the settings of the project, botovod.extensions.djangoapp.botovod has
+# to be in INSTALLED_APPS and migrated
+class DBDriver(dbdrivers.DBDriver):
+    keeps_history = True
+
+    def __init__(self):
+        self.history_batch_size = 500
+        self.history_interval = 1.0
+        self.history_lock = Lock()
+        self.history_writer = None
+        self.indexed_values = frozenset()
+
+    def connect(self, history_batch_size: int = 500, history_interval: float = 1.0,
+                indexed_values: Iterable[str] = ()):
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.indexed_values = frozenset(indexed_values)
+
+    async def a_connect(self, history_batch_size: int = 500, history_interval: float = 1.0,
+                        indexed_values: Iterable[str] = ()):
+        self.connect(history_batch_size=history_batch_size, history_interval=history_interval,
+                     indexed_values=indexed_values)
+
+    def close(self):
+        if self.history_writer is not None:
+            self.history_writer.stop()
+            self.history_writer = None
+
+    async def a_close(self):
+        await sync_to_async(self.close)()
+
+    # History is one table here, Django has no way to manage tables per month
+    @staticmethod
+    def write_history(records: List[Record]):
+        models.Message.objects.bulk_create([
+            models.Message(follower_id=follower_id, input=input, text=text, data=data,
+                           created_at=created_at)
+            for follower_id, input, text, data, created_at in records
+        ])
+
+    def flush_history(self):
+        if self.history_writer is not None:
+            self.history_writer.flush()
+
+    def add_history(self, follower: Follower, message: Message, input: bool = True):
+        if self.history_writer is None:
+            with self.history_lock:
+                if self.history_writer is None:
+                    writer = HistoryWriter(write=self.write_history,
+                                           batch_size=self.history_batch_size,
+                                           interval=self.history_interval)
+                    writer.start()
+                    self.history_writer = writer
+        self.history_writer.add(make_record(follower.obj.id, message, input, timezone.now()))
+
+    def clear_history(self, before_date: datetime):
+        self.flush_history()
+        models.Message.objects.filter(created_at__lt=before_date).delete()
+
+    async def a_clear_history(self, before_date: datetime):
+        await sync_to_async(self.flush_history)()
+        await models.Message.objects.filter(created_at__lt=before_date).adelete()
+
+    def search_history(self, query: str, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        self.flush_history()
+        follower_id = None if follower is None else follower.obj.id
+        messages = get_search_query(query, follower_id=follower_id, after_date=after_date,
+                                    before_date=before_date, cursor=cursor)
+        if messages is None:
+            return [], None
+        return make_search_page(list(messages[:limit]), limit)
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        await sync_to_async(self.flush_history)()
+        follower_id = None if follower is None else follower.obj.id
+        messages = get_search_query(query, follower_id=follower_id, after_date=after_date,
+                                    before_date=before_date, cursor=cursor)
+        if messages is None:
+            return [], None
+        return make_search_page([row async for row in messages[:limit]], limit)
+
+    def get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        obj = models.Follower.objects.filter(bot=agent.name, chat=chat.id).first()
+        return None if obj is None else Follower(self, obj)
+
+    async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        obj = await models.Follower.objects.filter(bot=agent.name, chat=chat.id).afirst()
+        return None if obj is None else Follower(self, obj)
+
+    def add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return Follower(self, models.Follower.objects.create(bot=agent.name, chat=chat.id))
+
+    async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        obj = await models.Follower.objects.acreate(bot=agent.name, chat=chat.id)
+        return Follower(self, obj)
+
+    def get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        obj, _ = models.Follower.objects.get_or_create(bot=agent.name, chat=chat.id)
+        return Follower(self, obj)
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        obj, _ = await models.Follower.objects.aget_or_create(bot=agent.name, chat=chat.id)
+        return Follower(self, obj)
+
+    # Values of keys declared as indexed are copied to botovod_follower_index, whose unique
+    # (name, value, follower) index serves lookups by value
+    def make_index_values(self, obj: models.Follower,
+                          names: Iterable[str]) -> List[models.FollowerIndexValue]:
+        index_values = []
+        for name in names:
+            if name in self.indexed_values and name in obj.data:
+                value = dbdrivers.make_index_value(obj.data[name])
+                if value is not None:
+                    index_values.append(models.FollowerIndexValue(follower=obj, name=name,
+                                                                  value=value))
+        return index_values
+
+    def update_index(self, obj: models.Follower, *names: str):
+        names = [name for name in names if name in self.indexed_values]
+        if names:
+            models.FollowerIndexValue.objects.filter(follower=obj, name__in=names).delete()
+            models.FollowerIndexValue.objects.bulk_create(self.make_index_values(obj, names))
+
+    def reindex_values(self, batch_size: int = 1000):
+        # Index is built again from values, so keys can be declared for existing followers
+        with transaction.atomic():
+            models.FollowerIndexValue.objects.all().delete()
+            index_values = []
+            for follower in self.iter_followers(batch_size=batch_size):
+                index_values.extend(self.make_index_values(follower.obj, self.indexed_values))
+                if len(index_values) >= batch_size:
+                    models.FollowerIndexValue.objects.bulk_create(index_values)
+                    index_values = []
+            models.FollowerIndexValue.objects.bulk_create(index_values)
+
+    async def a_reindex_values(self, batch_size: int = 1000):
+        await sync_to_async(self.reindex_values)(batch_size)
+
+    # Batches are taken after the last id of the previous one, so every batch is as fast as the
+    # first one and only one batch is in memory
+    def get_iter_query(self, agent: Optional[Agent] = None,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None):
+        query = models.Follower.objects.filter(**dbdrivers.check_filter(filter))
+        for name, value in dbdrivers.check_values(self.indexed_values, values).items():
+            # Every filter call makes its own join, one per value
+            query = query.filter(index_values__name=name, index_values__value=value)
+        if agent is not None:
+            query = query.filter(bot=agent.name)
+        return query.order_by("id")
+
+    def iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None,
+                       after_id: int = 0) -> Iterator[Follower]:
+        query = self.get_iter_query(agent, filter, values)
+        last_id = after_id
+        while True:
+            objs = list(query.filter(id__gt=last_id)[:batch_size])
+            for obj in objs:
+                yield Follower(self, obj)
+            if len(objs) < batch_size:
+                break
+            last_id = objs[-1].id
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        query = self.get_iter_query(agent, filter, values)
+        last_id = after_id
+        while True:
+            objs = [obj async for obj in query.filter(id__gt=last_id)[:batch_size]]
+            for obj in objs:
+                yield Follower(self, obj)
+            if len(objs) < batch_size:
+                break
+            last_id = objs[-1].id
+
+    def delete(self, follower: Follower):
+        follower.obj.delete()
+
+    async def a_delete(self, follower: Follower):
+        await follower.obj.adelete()
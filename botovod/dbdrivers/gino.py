@@ -1,14 +1,35 @@
 from botovod import dbdrivers
-from botovod.agents import Agent, Chat
+from botovod.agents import Agent, Chat, Message
+from botovod.exceptions import FollowerConflictException
+from botovod.utils import codec
 from datetime import datetime
 import gino
 import json
 import logging
-from typing import Dict, Optional, Union
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, Table, Text, and_
+from sqlalchemy.dialects.postgresql import insert
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .history import (SEARCH_CONFIG, AsyncHistoryWriter, Record, get_partition, get_partitions,
+                      make_cursor, make_record, parse_cursor, parse_record)
 
 
 db = gino.Gino()
 logger = logging.getLogger(__name__)
+NOTHING = object()
+# History has the tables of the SQLAlchemy driver: one per month, with a GIN full-text index
+HISTORY_PREFIX = "botovod_messages_"
+history_metadata = MetaData()
+CREATE_HISTORY = (
+    "CREATE TABLE IF NOT EXISTS {table} (id SERIAL PRIMARY KEY, follower_id INTEGER NOT NULL, "
+    "input BOOLEAN NOT NULL, text TEXT, data TEXT NOT NULL, created_at TIMESTAMP NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS {table}_follower_created ON {table} (follower_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS {table}_search ON {table} USING gin "
+    f"(to_tsvector('{SEARCH_CONFIG}'::regconfig, text))",
+)
+SELECT_TABLES = "SELECT tablename FROM pg_tables WHERE schemaname = current_schema()"
+SEARCH_CONDITION = (f"to_tsvector('{SEARCH_CONFIG}'::regconfig, text) @@ "
+                    f"plainto_tsquery('{SEARCH_CONFIG}'::regconfig, :query)")
 
 
 class Common:
@@ -25,6 +46,75 @@ class Follower(dbdrivers.Follower, Common, db.Model):
     dialog = db.Column(db.Unicode(length=64), nullable=True)
     next_step = db.Column(db.Unicode(length=64), nullable=True)
     data = db.Column(db.Text, nullable=False, default="{}")
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    _bot_chat_idx = db.Index("botovod_followers_bot_chat", "bot", "chat", unique=True)
+
+    _values = None
+    _values_complete = False
+    # Writes of one update are kept here and sent by a_flush (called by the driver when the update
+    # is handled): columns in one UPDATE, values in one upsert and one DELETE. The UPDATE compares
+    # and sets the version, so nothing is written for a follower changed by another update since
+    # it was read
+    _changes = None
+    _pending_values = None
+    _clear_pending = False
+
+    def mark_changed(self, **columns: Any):
+        if self._changes is None:
+            self._changes = {}
+        self._changes.update(columns)
+
+    def mark_value(self, name: str, value: Any):
+        if self._pending_values is None:
+            self._pending_values = {}
+        self._pending_values[name] = value
+
+    def has_changes(self) -> bool:
+        return bool(self._changes or self._pending_values or self._clear_pending)
+
+    def discard_changes(self):
+        self._changes = None
+        self._pending_values = None
+        self._clear_pending = False
+
+    async def a_flush(self, indexed_values: Iterable[str] = ()):
+        changes, self._changes = self._changes, None
+        pending, self._pending_values = self._pending_values or {}, None
+        clear, self._clear_pending = self._clear_pending, False
+        if not changes and not pending and not clear:
+            return
+
+        saved = [{"follower_id": self.id, "name": name, "value": json.dumps(value)}
+                 for name, value in pending.items() if value is not NOTHING]
+        deleted = [name for name, value in pending.items() if value is NOTHING]
+        indexed = [name for name in pending if name in indexed_values]
+        index_values = []
+        for name in indexed:
+            value = pending[name]
+            if value is not NOTHING:
+                value = dbdrivers.make_index_value(value)
+                if value is not None:
+                    index_values.append({"follower_id": self.id, "name": name, "value": value})
+        async with db.transaction():
+            status, _ = await Follower.update.values(
+                version=Follower.version + 1,
+                **(changes or {}),
+            ).where(and_(Follower.id == self.id, Follower.version == self.version)).gino.status()
+            if int(status.split()[-1]) != 1:
+                raise FollowerConflictException()
+            if clear:
+                await FollowerValue.remove(self)
+                await FollowerIndexValue.remove(self)
+            elif deleted:
+                await FollowerValue.remove(self, *deleted)
+            if saved:
+                await save_values_query.status(saved)
+            if indexed and not clear:
+                await FollowerIndexValue.remove(self, *indexed)
+            if index_values:
+                await FollowerIndexValue.insert().gino.all(index_values)
+        self.version += 1
 
     async def a_get_chat(self) -> Chat:
         return Chat(self.bot, self.chat)
@@ -33,40 +123,256 @@ class Follower(dbdrivers.Follower, Common, db.Model):
         return self.dialog
 
     async def a_set_dialog(self, name: Optional[str] = None):
-        await self.update(dialog=name).apply()
+        self.dialog = name
+        self.mark_changed(dialog=name)
 
     async def a_get_next_step(self) -> Optional[str]:
         return self.next_step
 
     async def a_set_next_step(self, next_step: Optional[str] = None):
-        await self.update(next_step=next_step).apply()
+        self.next_step = next_step
+        self.mark_changed(next_step=next_step)
 
     async def a_get_values(self) -> Dict[str, str]:
-        return json.loads(self.data)
+        if not self._values_complete:
+            values = {} if self._clear_pending else await FollowerValue.load_all(self)
+            if self.data != "{}":
+                # Followers created by older versions keep values in the data column
+                legacy = {name: value for name, value in codec.loads(self.data).items()
+                          if name not in values}
+                for name, value in legacy.items():
+                    await FollowerValue.save(self, name, value)
+                values.update(legacy)
+                await self.update(data="{}").apply()
+            for name, value in (self._pending_values or {}).items():
+                if value is NOTHING:
+                    values.pop(name, None)
+                else:
+                    values[name] = value
+            self._values = values
+            self._values_complete = True
+        return self._values.copy()
 
     async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
-        return json.loads(self.data).get(name, default)
+        if self.data != "{}":
+            await self.a_get_values()
+        if self._values is None:
+            self._values = {}
+        if name not in self._values and not self._values_complete:
+            self._values[name] = await FollowerValue.load(self, name)
+        value = self._values.get(name, NOTHING)
+        return default if value is NOTHING else value
 
     async def a_set_value(self, name: str, value: str):
-        data = json.loads(self.data)
-        data[name] = value
-        await self.update(data=data).apply()
+        if self.data != "{}":
+            await self.a_get_values()
+        self.mark_value(name, value)
+        if self._values is None:
+            self._values = {}
+        self._values[name] = value
 
     async def a_delete_value(self, name: str):
-        data = json.loads(self.data)
-        if name in data:
-            del data[name]
-        await self.update(data=data).apply()
+        if self.data != "{}":
+            await self.a_get_values()
+        self.mark_value(name, NOTHING)
+        if self._values is None:
+            self._values = {}
+        # Not complete cache keeps the miss, so the value isn't loaded again before the flush
+        if self._values_complete:
+            self._values.pop(name, None)
+        else:
+            self._values[name] = NOTHING
 
     async def a_clear_values(self):
-        await self.update(data="{}").apply()
+        if self.data != "{}":
+            self.data = "{}"
+            self.mark_changed(data="{}")
+        self._pending_values = None
+        self._clear_pending = True
+        self._values = {}
+        self._values_complete = True
+
+    def set_dbdriver(self, dbdriver: DBDriver):
+        self._dbdriver = dbdriver
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        await self._dbdriver.a_add_history(self, message, input)
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        return await self._dbdriver.a_get_history(self, after_date=after_date,
+                                                  before_date=before_date, input=input,
+                                                  limit=limit)
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        await self._dbdriver.a_remove_history(follower=self, after_date=after_date,
+                                              before_date=before_date)
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return await self._dbdriver.a_search_history(query, follower=self, after_date=after_date,
+                                                     before_date=before_date, limit=limit,
+                                                     cursor=cursor)
+
+
+class FollowerValue(db.Model):
+    __tablename__ = "botovod_follower_values"
+
+    follower_id = db.Column(db.Integer, db.ForeignKey("botovod_followers.id", ondelete="CASCADE"),
+                            nullable=False, primary_key=True)
+    name = db.Column(db.Unicode(length=64), nullable=False, primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    async def load_all(cls, follower: Follower) -> Dict[str, Any]:
+        rows = await load_values_query.all(follower_id=follower.id)
+        return {name: codec.loads(value) for name, value in rows}
+
+    @classmethod
+    async def load_batch(cls, follower_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        values = {follower_id: {} for follower_id in follower_ids}
+        rows = await db.select([cls.follower_id, cls.name, cls.value]).where(
+            cls.follower_id.in_(follower_ids),
+        ).gino.all()
+        for follower_id, name, value in rows:
+            values[follower_id][name] = codec.loads(value)
+        return values
+
+    @classmethod
+    async def load(cls, follower: Follower, name: str) -> Any:
+        value = await load_value_query.scalar(follower_id=follower.id, name=name)
+        return NOTHING if value is None else codec.loads(value)
+
+    @classmethod
+    async def save(cls, follower: Follower, name: str, value: Any):
+        await save_values_query.status(follower_id=follower.id, name=name,
+                                       value=json.dumps(value))
+
+    @classmethod
+    async def remove(cls, follower: Follower, *names: str):
+        query = cls.delete.where(cls.follower_id == follower.id)
+        if names:
+            query = query.where(cls.name.in_(names))
+        await query.gino.status()
+
+
+# Values of keys declared as indexed are copied here, the primary key (name, value, follower_id)
+# serves lookups by value. Values moved from the data column of older followers are indexed by
+# reindex_values
+class FollowerIndexValue(db.Model):
+    __tablename__ = "botovod_follower_index"
+
+    name = db.Column(db.Unicode(length=64), nullable=False, primary_key=True)
+    value = db.Column(db.Unicode(length=dbdrivers.INDEX_VALUE_LENGTH), nullable=False,
+                      primary_key=True)
+    follower_id = db.Column(db.Integer, db.ForeignKey("botovod_followers.id", ondelete="CASCADE"),
+                            nullable=False, primary_key=True)
+
+    _follower_idx = db.Index("botovod_follower_index_follower", "follower_id", "name")
+
+    @classmethod
+    async def remove(cls, follower: Follower, *names: str):
+        query = cls.delete.where(cls.follower_id == follower.id)
+        if names:
+            query = query.where(cls.name.in_(names))
+        await query.gino.status()
+
+
+# Hot queries are baked: Gino compiles them once when the engine is created and asyncpg keeps
+# them prepared on every connection, so only parameters are sent for each update
+def make_get_or_create_query():
+    statement = insert(Follower.__table__).values(
+        bot=db.bindparam("bot"),
+        chat=db.bindparam("chat"),
+        data="{}",
+        created_at=db.bindparam("created_at"),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[Follower.bot, Follower.chat],
+        set_={"bot": statement.excluded.bot},
+    )
+    return statement.returning(*Follower.__table__.columns).execution_options(loader=Follower)
+
+
+def make_save_values_query():
+    statement = insert(FollowerValue.__table__).values(
+        follower_id=db.bindparam("follower_id"),
+        name=db.bindparam("name"),
+        value=db.bindparam("value"),
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[FollowerValue.follower_id, FollowerValue.name],
+        set_={"value": statement.excluded.value},
+    )
+
+
+# Bot of a follower is the agent class name, as it always was in this driver, so rows written
+# before stay found
+get_follower_query = db.bake(Follower.query.where(
+    and_(Follower.bot == db.bindparam("bot"), Follower.chat == db.bindparam("chat")),
+))
+get_or_create_query = db.bake(make_get_or_create_query())
+load_values_query = db.bake(db.select([FollowerValue.name, FollowerValue.value]).where(
+    FollowerValue.follower_id == db.bindparam("follower_id"),
+))
+load_value_query = db.bake(db.select([FollowerValue.value]).where(
+    and_(FollowerValue.follower_id == db.bindparam("follower_id"),
+         FollowerValue.name == db.bindparam("name")),
+))
+save_values_query = db.bake(make_save_values_query())
+
+
+def get_history_table(partition: str) -> Table:
+    name = HISTORY_PREFIX + partition
+    table = history_metadata.tables.get(name)
+    if table is None:
+        table = Table(
+            name,
+            history_metadata,
+            Column("id", Integer, primary_key=True),
+            Column("follower_id", Integer, nullable=False),
+            Column("input", Boolean, nullable=False),
+            Column("text", Text, nullable=True),
+            Column("data", Text, nullable=False),
+            Column("created_at", DateTime, nullable=False),
+        )
+    return table
 
 
 class DBDriver(dbdrivers.DBDriver):
     db = db
+    keeps_history = True
+
+    def __init__(self):
+        self.acquire_timeout = None
+        self.indexed_values = frozenset()
+        self.history_batch_size = 500
+        self.history_interval = 1.0
+        self.history_partitions = None
+        self.history_writer = None
+
+    @staticmethod
+    def make_pool_settings(min_size: Optional[int] = None, max_size: Optional[int] = None,
+                           statement_cache_size: Optional[int] = None) -> Dict[str, int]:
+        settings = {}
+        if min_size is not None:
+            settings["min_size"] = min_size
+        if max_size is not None:
+            settings["max_size"] = max_size
+        if statement_cache_size is not None:
+            settings["statement_cache_size"] = statement_cache_size
+        return settings
 
     async def a_connect(self, engine: str, database: str, host: Optional[Union[str, int]]=None,
-                        username: Optional[str]=None, password: Optional[str]=None):
+                        username: Optional[str]=None, password: Optional[str]=None,
+                        min_size: Optional[int] = None, max_size: Optional[int] = None,
+                        statement_cache_size: Optional[int] = None,
+                        acquire_timeout: Optional[float] = None,
+                        indexed_values: Iterable[str] = (), history_batch_size: int = 500,
+                        history_interval: float = 1.0):
         await self.a_close()
         dsn = f"{engine}://"
         if username is not None and password is not None:
@@ -74,21 +380,301 @@ class DBDriver(dbdrivers.DBDriver):
         if host is not None:
             dsn += f"{host}/"
         dsn += database
-        await self.db.set_bind(dsn)
+        self.acquire_timeout = acquire_timeout
+        self.indexed_values = frozenset(indexed_values)
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.history_partitions = None
+        await self.db.set_bind(dsn, **self.make_pool_settings(
+            min_size=min_size, max_size=max_size, statement_cache_size=statement_cache_size,
+        ))
 
     async def a_close(self):
+        if self.history_writer is not None:
+            await self.history_writer.stop()
+            self.history_writer = None
         try:
             await self.db.pop_bind().close()
         except gino.exceptions.UninitializedError:
             pass
 
+    def acquire(self):
+        # Queries inside reuse the acquired connection, so the timeout bounds the wait for the pool
+        return self.db.acquire(timeout=self.acquire_timeout, reuse=True)
+
+    async def a_finish(self, follower: Optional[Follower] = None):
+        # Updates which changed nothing don't take a connection from the pool
+        if follower is not None and follower.has_changes():
+            async with self.acquire():
+                await follower.a_flush(self.indexed_values)
+
+    async def a_discard(self, follower: Optional[Follower] = None):
+        if follower is not None:
+            follower.discard_changes()
+
+    async def a_prefetch_values(self, followers: List[Follower]):
+        # Followers with pending writes or values in the data column load them by a_get_values
+        followers = [follower for follower in followers if not follower._values_complete
+                     and follower.data == "{}" and not follower.has_changes()]
+        if followers:
+            async with self.acquire():
+                values = await FollowerValue.load_batch([follower.id for follower in followers])
+            for follower in followers:
+                follower._values = values[follower.id]
+                follower._values_complete = True
+
+    def make_follower(self, follower: Optional[Follower]) -> Optional[Follower]:
+        if follower is not None:
+            follower.set_dbdriver(self)
+        return follower
+
     async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
-        return await Follower.query.where(Follower.bot == agent.__class__.__name__).where(
-            Follower.chat == chat.id
-        ).gino.first()
+        async with self.acquire():
+            return self.make_follower(
+                await get_follower_query.first(bot=agent.__class__.__name__, chat=chat.id),
+            )
 
     async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
-        return await Follower.create(bot=agent.__class__.__name__, chat=chat.id)
+        async with self.acquire():
+            return self.make_follower(
+                await Follower.create(bot=agent.__class__.__name__, chat=chat.id),
+            )
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        # Known followers are found by the unique index without writing anything, new ones are
+        # created by an upsert which closes the race between two first messages
+        async with self.acquire():
+            follower = await get_follower_query.first(bot=agent.__class__.__name__,
+                                                      chat=chat.id)
+            if follower is None:
+                follower = await get_or_create_query.first(bot=agent.__class__.__name__,
+                                                           chat=chat.id,
+                                                           created_at=datetime.now())
+            return self.make_follower(follower)
+
+    async def a_import_followers(self, agent: Agent, rows: Iterable[dbdrivers.ImportRow]):
+        # Followers of a batch are written by one upsert, their old values are removed and the
+        # new ones inserted by one statement per table, all in one transaction. A follower which
+        # exists gets the next version, so updates which read it before fail with a conflict
+        followers = {chat.id: (dialog, next_step, values)
+                     for chat, dialog, next_step, values in rows}
+        if not followers:
+            return
+        now = datetime.now()
+        statement = insert(Follower.__table__).values([
+            {"bot": agent.__class__.__name__, "chat": chat, "dialog": dialog,
+             "next_step": next_step, "data": "{}", "version": 0, "created_at": now}
+            for chat, (dialog, next_step, _) in followers.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[Follower.bot, Follower.chat],
+            set_={"dialog": statement.excluded.dialog, "next_step": statement.excluded.next_step,
+                  "data": "{}", "version": Follower.version + 1},
+        ).returning(Follower.chat, Follower.id)
+        async with self.acquire():
+            async with db.transaction():
+                ids = dict(await db.all(statement))
+                await FollowerValue.delete.where(
+                    FollowerValue.follower_id.in_(ids.values()),
+                ).gino.status()
+                await FollowerIndexValue.delete.where(
+                    FollowerIndexValue.follower_id.in_(ids.values()),
+                ).gino.status()
+                value_rows = []
+                index_rows = []
+                for chat, (_, _, values) in followers.items():
+                    for name, value in values.items():
+                        value_rows.append({"follower_id": ids[chat], "name": name,
+                                           "value": json.dumps(value)})
+                        index_value = (dbdrivers.make_index_value(value)
+                                       if name in self.indexed_values else None)
+                        if index_value is not None:
+                            index_rows.append({"follower_id": ids[chat], "name": name,
+                                               "value": index_value})
+                if value_rows:
+                    await FollowerValue.insert().gino.status(value_rows)
+                if index_rows:
+                    await FollowerIndexValue.insert().gino.status(index_rows)
+
+    async def a_reindex_values(self):
+        # Index is built again from values in one statement, so keys can be declared for existing
+        # followers
+        async with self.acquire():
+            # Values of followers created by older versions are moved from the data column first
+            for follower in await Follower.query.where(Follower.data != "{}").gino.all():
+                await follower.a_get_values()
+        values = FollowerValue.__table__
+        select = db.select([values.c.name, values.c.value, values.c.follower_id]).where(and_(
+            values.c.name.in_(self.indexed_values),
+            db.func.length(values.c.value) <= dbdrivers.INDEX_VALUE_LENGTH,
+        ))
+        async with self.acquire():
+            async with db.transaction():
+                await FollowerIndexValue.delete.gino.status()
+                await FollowerIndexValue.insert().from_select(
+                    ["name", "value", "follower_id"], select,
+                ).gino.status()
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        # Batches are taken after the last id of the previous one, so every batch is as fast as
+        # the first one and only one batch is in memory
+        query = Follower.query
+        if agent is not None:
+            query = query.where(Follower.bot == agent.__class__.__name__)
+        for name, value in dbdrivers.check_filter(filter).items():
+            query = query.where(getattr(Follower, name) == value)
+        for name, value in dbdrivers.check_values(self.indexed_values, values).items():
+            query = query.where(Follower.id.in_(db.select([FollowerIndexValue.follower_id]).where(
+                and_(FollowerIndexValue.name == name, FollowerIndexValue.value == value),
+            )))
+        last_id = after_id
+        while True:
+            async with self.acquire():
+                followers = await query.where(Follower.id > last_id).order_by(
+                    Follower.id,
+                ).limit(batch_size).gino.all()
+            for follower in followers:
+                yield self.make_follower(follower)
+            if len(followers) < batch_size:
+                break
+            last_id = followers[-1].id
 
     async def a_delete(self, follower: Follower):
-        await follower.delete()
+        follower.discard_changes()
+        async with self.acquire():
+            await FollowerValue.remove(follower)
+            await follower.delete()
+
+    async def a_get_history_partitions(self) -> Set[str]:
+        if self.history_partitions is None:
+            names = {name for name, in await db.all(db.text(SELECT_TABLES))}
+            self.history_partitions = {name[len(HISTORY_PREFIX):] for name in names
+                                       if name.startswith(HISTORY_PREFIX) and
+                                       name[len(HISTORY_PREFIX):].isdigit()}
+        return self.history_partitions
+
+    async def a_write_history(self, records: List[Record]):
+        partitions = {}
+        for follower_id, input, text, data, created_at in records:
+            partitions.setdefault(get_partition(created_at), []).append({
+                "follower_id": follower_id,
+                "input": input,
+                "text": text,
+                "data": data,
+                "created_at": created_at,
+            })
+        async with self.acquire():
+            for partition, rows in partitions.items():
+                table = get_history_table(partition)
+                existing = await self.a_get_history_partitions()
+                if partition not in existing:
+                    for statement in CREATE_HISTORY:
+                        await db.status(db.text(statement.format(table=table.name)))
+                    # The set is replaced instead of changed, readers may iterate over the old one
+                    self.history_partitions = existing | {partition}
+                await db.status(table.insert(), rows)
+
+    async def a_add_history(self, follower: Follower, message: Message, input: bool = True):
+        if self.history_writer is None:
+            self.history_writer = AsyncHistoryWriter(write=self.a_write_history,
+                                                     batch_size=self.history_batch_size,
+                                                     interval=self.history_interval)
+        self.history_writer.add(make_record(follower.id, message, input))
+
+    async def a_get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        # Partitions are read from the newest one, so the last messages need only the last months
+        if self.history_writer is not None:
+            await self.history_writer.flush()
+        messages = []
+        async with self.acquire():
+            partitions = get_partitions(await self.a_get_history_partitions(), after_date,
+                                        before_date)
+            for partition in reversed(partitions):
+                table = get_history_table(partition)
+                query = db.select([table.c.text, table.c.data, table.c.input,
+                                   table.c.created_at]).where(table.c.follower_id == follower.id)
+                if after_date is not None:
+                    query = query.where(table.c.created_at > after_date)
+                if before_date is not None:
+                    query = query.where(table.c.created_at < before_date)
+                if input is not None:
+                    query = query.where(table.c.input == input)
+                query = query.order_by(table.c.created_at.desc(), table.c.id.desc())
+                if limit is not None:
+                    query = query.limit(limit - len(messages))
+                messages.extend(parse_record(*row) for row in await db.all(query))
+                if limit is not None and len(messages) >= limit:
+                    break
+        messages.reverse()
+        return messages
+
+    async def a_remove_history(self, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None):
+        if self.history_writer is not None:
+            await self.history_writer.flush()
+        async with self.acquire():
+            existing = await self.a_get_history_partitions()
+            for partition in get_partitions(existing, after_date, before_date):
+                table = get_history_table(partition)
+                if (follower is None and after_date is None and before_date is not None and
+                        partition < get_partition(before_date)):
+                    await db.status(db.text(f"DROP TABLE IF EXISTS {table.name}"))
+                    self.history_partitions = self.history_partitions - {partition}
+                    continue
+                query = table.delete()
+                if follower is not None:
+                    query = query.where(table.c.follower_id == follower.id)
+                if after_date is not None:
+                    query = query.where(table.c.created_at > after_date)
+                if before_date is not None:
+                    query = query.where(table.c.created_at < before_date)
+                await db.status(query)
+
+    async def a_clear_history(self, before_date: datetime):
+        await self.a_remove_history(before_date=before_date)
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        # Pages are taken by cursor from the newest message, see history.py
+        if self.history_writer is not None:
+            await self.history_writer.flush()
+        messages = []
+        last = None
+        cursor_partition, cursor_id = parse_cursor(cursor)
+        async with self.acquire():
+            partitions = get_partitions(await self.a_get_history_partitions(), after_date,
+                                        before_date)
+            for partition in reversed(partitions):
+                if cursor_partition is not None and partition > cursor_partition:
+                    continue
+                table = get_history_table(partition)
+                statement = db.select([table.c.id, table.c.follower_id, table.c.text,
+                                       table.c.data, table.c.input, table.c.created_at]).where(
+                    db.text(SEARCH_CONDITION).bindparams(query=query),
+                )
+                if follower is not None:
+                    statement = statement.where(table.c.follower_id == follower.id)
+                if after_date is not None:
+                    statement = statement.where(table.c.created_at > after_date)
+                if before_date is not None:
+                    statement = statement.where(table.c.created_at < before_date)
+                if partition == cursor_partition:
+                    statement = statement.where(table.c.id < cursor_id)
+                statement = statement.order_by(table.c.id.desc()).limit(limit - len(messages))
+                for id, message_follower_id, text, data, input, created_at in await db.all(
+                    statement,
+                ):
+                    messages.append(parse_record(text, data, input, created_at,
+                                                 follower_id=message_follower_id))
+                    last = make_cursor(partition, id)
+                if len(messages) >= limit:
+                    return messages, last
+        return messages, None
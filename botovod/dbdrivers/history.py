@@ -0,0 +1,218 @@
+from __future__ import annotations
+import asyncio
+from botovod.agents import Attachment, Location, Message
+from botovod.utils import codec
+from datetime import datetime
+import logging
+from threading import Condition, Lock, Thread
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+ATTACHMENTS = ("images", "audios", "videos", "documents")
+
+# Record is one row of history: (follower_id, input, text, data, created_at), where data is json
+# with attachments, locations and raw fields of the message
+Record = Tuple[int, bool, Optional[str], str, datetime]
+
+
+def make_record(follower_id: int, message: Message, input: bool = True,
+                created_at: Optional[datetime] = None) -> Record:
+    data = {}
+    for name in ATTACHMENTS:
+        attachments = getattr(message, name, None)
+        if attachments:
+            data[name] = [
+                {"url": attachment.url, "filepath": attachment.filepath, "raw": attachment.raw}
+                for attachment in attachments
+            ]
+    if message.locations:
+        data["locations"] = [
+            {"latitude": location.latitude, "longitude": location.longitude,
+             "raw": location.raw}
+            for location in message.locations
+        ]
+    if message.raw:
+        data["raw"] = message.raw
+    return (follower_id, input, message.text, codec.dumps(data, default=str),
+            datetime.now() if created_at is None else created_at)
+
+
+def parse_record(text: Optional[str], data: str, input: bool, created_at: datetime,
+                 follower_id: Optional[int] = None) -> Message:
+    data = codec.loads(data)
+    attachments = {
+        name: [Attachment(url=attachment["url"], filepath=attachment["filepath"],
+                          **attachment["raw"])
+               for attachment in data.get(name, ())]
+        for name in ATTACHMENTS
+    }
+    locations = [
+        Location(latitude=location["latitude"], longitude=location["longitude"],
+                 **location["raw"])
+        for location in data.get("locations", ())
+    ]
+    raw = data.get("raw", {})
+    raw["input"] = input
+    raw["date"] = created_at
+    if follower_id is not None:
+        raw["follower_id"] = follower_id
+    return Message(text=text, locations=locations, **attachments, **raw)
+
+
+# History is stored in a table per month, so range queries only touch the months they ask for
+# and retention drops whole tables instead of deleting rows one by one
+def get_partition(date: datetime) -> str:
+    return date.strftime("%Y%m")
+
+
+def get_partitions(partitions: Iterable[str], after_date: Optional[datetime] = None,
+                   before_date: Optional[datetime] = None) -> List[str]:
+    first = None if after_date is None else get_partition(after_date)
+    last = None if before_date is None else get_partition(before_date)
+    return sorted(
+        partition for partition in partitions
+        if (first is None or partition >= first) and (last is None or partition <= last)
+    )
+
+
+# Search uses the full-text index of the database. For SQLite it is an FTS5 table over the text of
+# the messages table, kept up to date by triggers, so every recorded message is indexed in the
+# same transaction it is inserted in. Pages are taken by cursor (the id of the last message of the
+# previous page), newest first, so a page costs the same however deep it is
+SEARCH_CONFIG = "simple"
+SQLITE_SEARCH = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table}_search USING fts5(text, content='{table}', "
+    "content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_search (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_search ({table}_search, rowid, text) VALUES ('delete', old.id, old.text); "
+    "END",
+)
+SQLITE_SEARCH_REBUILD = "INSERT INTO {table}_search ({table}_search) VALUES ('rebuild')"
+SQLITE_SEARCH_DROP = "DROP TABLE IF EXISTS {table}_search"
+
+
+def make_sqlite_search_query(query: str) -> str:
+    # Every word is quoted, so user input can't be read as FTS5 syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def make_cursor(partition: str, id: int) -> str:
+    return f"{partition}:{id}"
+
+
+def parse_cursor(cursor: Optional[str]) -> Tuple[Optional[str], Optional[int]]:
+    if cursor is None:
+        return None, None
+    partition, id = cursor.split(":")
+    return partition, int(id)
+
+
+# Writers keep records in memory and insert them in batches of batch_size, or whatever has been
+# collected in interval seconds, so recording a message never waits for the database. Records of a
+# failed write go back to the front of the buffer, so they are written by the next flush, which
+# comes after interval seconds
+class HistoryWriter(Thread):
+    def __init__(self, write: Callable[[List[Record]], None], batch_size: int = 500,
+                 interval: float = 1.0):
+        super().__init__(name="botovod-history", daemon=True)
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.condition = Condition()
+        self.io_lock = Lock()
+        self.buffer = []
+        self.running = True
+
+    def add(self, record: Record):
+        with self.condition:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch_size:
+                self.condition.notify()
+
+    def flush(self):
+        with self.io_lock:
+            with self.condition:
+                records, self.buffer = self.buffer, []
+            if not records:
+                return
+            try:
+                self.write(records)
+            except Exception:
+                with self.condition:
+                    self.buffer[:0] = records
+                raise
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join()
+        self.flush()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.buffer) >= self.batch_size or not self.running,
+                    timeout=self.interval,
+                )
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Cannot write history")
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running, timeout=self.interval)
+
+
+class AsyncHistoryWriter:
+    def __init__(self, write: Callable[[List[Record]], Awaitable[None]], batch_size: int = 500,
+                 interval: float = 1.0):
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.event = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.buffer = []
+        self.task = None
+        self.running = True
+
+    def add(self, record: Record):
+        self.buffer.append(record)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        if len(self.buffer) >= self.batch_size:
+            self.event.set()
+
+    async def flush(self):
+        async with self.lock:
+            records, self.buffer = self.buffer, []
+            if not records:
+                return
+            try:
+                await self.write(records)
+            except Exception:
+                self.buffer[:0] = records
+                raise
+
+    async def stop(self):
+        self.running = False
+        self.event.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Cannot write history")
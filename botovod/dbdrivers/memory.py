@@ -0,0 +1,597 @@
+from __future__ import annotations
+import asyncio
+from botovod import dbdrivers
+from botovod.agents import Agent, Chat, Message
+from botovod.utils import codec
+from concurrent.futures import Future
+from datetime import datetime
+import heapq
+import json
+import logging
+from operator import itemgetter
+import os
+from threading import Condition, Lock, Thread
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .history import Record, make_record, parse_record
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_journal_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, f"{generation:010d}.log")
+
+
+class Follower(dbdrivers.Follower):
+    def __init__(self, dbdriver: DBDriver, id: int, bot: str, chat: str,
+                 dialog: Optional[str] = None, next_step: Optional[str] = None,
+                 values: Optional[dict] = None):
+        self.dbdriver = dbdriver
+        self.id = id
+        self.bot = bot
+        self.chat = chat
+        self.dialog = dialog
+        self.next_step = next_step
+        self.values = {} if values is None else values
+
+    def get_chat(self) -> Chat:
+        return Chat(self.bot, self.chat)
+
+    async def a_get_chat(self) -> Chat:
+        return self.get_chat()
+
+    def get_dialog(self) -> Optional[str]:
+        return self.dialog
+
+    async def a_get_dialog(self) -> Optional[str]:
+        return self.dialog
+
+    def set_dialog(self, name: Optional[str] = None):
+        self.dbdriver.write(["dialog", self.id, name, None if name is None else "start"])
+
+    async def a_set_dialog(self, name: Optional[str] = None):
+        self.set_dialog(name)
+
+    def get_next_step(self) -> Optional[str]:
+        return self.next_step
+
+    async def a_get_next_step(self) -> Optional[str]:
+        return self.next_step
+
+    def set_next_step(self, next_step: Optional[str] = None):
+        self.dbdriver.write(["next_step", self.id, next_step])
+
+    async def a_set_next_step(self, next_step: Optional[str] = None):
+        self.set_next_step(next_step)
+
+    def get_values(self) -> Dict[str, str]:
+        return self.values.copy()
+
+    async def a_get_values(self) -> Dict[str, str]:
+        return self.values.copy()
+
+    def get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.values.get(name, default)
+
+    async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.values.get(name, default)
+
+    def set_value(self, name: str, value: str):
+        self.dbdriver.write(["set_value", self.id, name, value])
+
+    async def a_set_value(self, name: str, value: str):
+        self.set_value(name, value)
+
+    def delete_value(self, name: str):
+        self.dbdriver.write(["delete_value", self.id, name])
+
+    async def a_delete_value(self, name: str):
+        self.delete_value(name)
+
+    def clear_values(self):
+        self.dbdriver.write(["clear_values", self.id])
+
+    async def a_clear_values(self):
+        self.clear_values()
+
+    def add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    def get_history(self, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        return self.dbdriver.get_history(self, after_date=after_date, before_date=before_date,
+                                         input=input, limit=limit)
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        return self.get_history(after_date=after_date, before_date=before_date, input=input,
+                                limit=limit)
+
+    def clear_history(self, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None):
+        self.dbdriver.remove_history(follower=self, after_date=after_date,
+                                     before_date=before_date)
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        self.clear_history(after_date=after_date, before_date=before_date)
+
+    def search_history(self, query: str, after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self.dbdriver.search_history(query, follower=self, after_date=after_date,
+                                            before_date=before_date, limit=limit, cursor=cursor)
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self.search_history(query, after_date=after_date, before_date=before_date,
+                                   limit=limit, cursor=cursor)
+
+
+# Journal appends changes to the log file of the current generation. Records are buffered in
+# memory and written by one thread, which fsyncs every fsync_interval seconds or as soon as
+# somebody waits for durability, so all updates finished at the same time share one fsync
+class Journal(Thread):
+    def __init__(self, directory: str, generation: int, fsync_interval: float = 1.0):
+        super().__init__(name="botovod-journal", daemon=True)
+        self.directory = directory
+        self.generation = generation
+        self.fsync_interval = fsync_interval
+
+        self.condition = Condition()
+        self.io_lock = Lock()
+        self.buffer = []
+        self.waiters = []
+        self.size = 0
+        self.running = True
+        self.file = open(get_journal_path(directory, generation), "ab")
+
+    def append(self, record: list):
+        line = codec.dumpb(record) + b"\n"
+        with self.condition:
+            self.buffer.append(line)
+
+    def sync(self) -> Future:
+        future = Future()
+        with self.condition:
+            self.waiters.append(future)
+            self.condition.notify()
+        return future
+
+    def flush(self):
+        with self.io_lock:
+            with self.condition:
+                buffer, self.buffer = self.buffer, []
+                waiters, self.waiters = self.waiters, []
+            try:
+                if buffer:
+                    data = b"".join(buffer)
+                    self.file.write(data)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.size += len(data)
+            except Exception as exception:
+                for future in waiters:
+                    future.set_exception(exception)
+                raise
+            for future in waiters:
+                future.set_result(None)
+
+    def rotate(self, generation: int):
+        with self.io_lock:
+            with self.condition:
+                buffer, self.buffer = self.buffer, []
+            self.file.write(b"".join(buffer))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.generation = generation
+            self.file = open(get_journal_path(self.directory, generation), "ab")
+            self.size = 0
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join()
+        self.flush()
+        self.file.close()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait_for(lambda: self.waiters or not self.running,
+                                        timeout=self.fsync_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Cannot write journal")
+
+
+# Every update gets the same Follower object of a chat and every write is applied to it at once
+# under the lock, so updates always see the latest state. There are no versions and no
+# FollowerConflictException: of two updates writing the same field concurrently the last one wins
+class DBDriver(dbdrivers.DBDriver):
+    keeps_history = True
+
+    def __init__(self):
+        self.lock = Lock()
+        self.followers = {}
+        self.index = {}
+        self.last_id = 0
+        self.directory = None
+        self.generation = 0
+        self.journal = None
+        self.snapshot_size = None
+        self.snapshot_thread = None
+        self.durable = True
+        self.indexed_values = frozenset()
+        self.value_index = {}
+        self.history = {}
+        self.last_message_id = 0
+
+    def connect(self, directory: Optional[str] = None, fsync_interval: float = 1.0,
+                snapshot_size: int = 64 * 1024 * 1024, durable: bool = True,
+                indexed_values: Iterable[str] = ()):
+        # Without directory nothing is persisted and state lives only as long as the process
+        self.close()
+        self.followers = {}
+        self.index = {}
+        self.last_id = 0
+        # Index of values is not persisted, it is built while the journal is read
+        self.indexed_values = frozenset(indexed_values)
+        self.value_index = {}
+        self.history = {}
+        self.last_message_id = 0
+        self.directory = directory
+        self.snapshot_size = snapshot_size
+        self.durable = durable
+        if directory is None:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        self.generation = self.recover()
+        self.journal = Journal(directory=directory, generation=self.generation,
+                               fsync_interval=fsync_interval)
+        self.journal.start()
+
+    async def a_connect(self, directory: Optional[str] = None, fsync_interval: float = 1.0,
+                        snapshot_size: int = 64 * 1024 * 1024, durable: bool = True,
+                        indexed_values: Iterable[str] = ()):
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: self.connect(directory=directory, fsync_interval=fsync_interval,
+                                 snapshot_size=snapshot_size, durable=durable,
+                                 indexed_values=indexed_values),
+        )
+
+    def close(self):
+        if self.journal is None:
+            return
+        # Compacting on close makes the next start read one snapshot instead of the whole log. The
+        # thread clears snapshot_thread when it ends, so it is taken under the lock
+        with self.lock:
+            snapshot_thread = self.snapshot_thread
+        if snapshot_thread is not None:
+            snapshot_thread.join()
+        self.snapshot()
+        self.journal.stop()
+        self.journal = None
+
+    async def a_close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def finish(self, follower: Optional[Follower] = None):
+        if self.journal is not None and self.durable:
+            self.journal.sync().result()
+
+    async def a_finish(self, follower: Optional[Follower] = None):
+        if self.journal is not None and self.durable:
+            await asyncio.wrap_future(self.journal.sync())
+
+    def write(self, record: list):
+        with self.lock:
+            self.apply(record)
+            if self.journal is None:
+                return
+            self.journal.append(record)
+            if self.journal.size >= self.snapshot_size and self.snapshot_thread is None:
+                self.snapshot_thread = Thread(target=self.snapshot, name="botovod-snapshot",
+                                              daemon=True)
+                self.snapshot_thread.start()
+
+    def index_value(self, follower: Follower, name: str, add: bool = True):
+        if name not in self.indexed_values or name not in follower.values:
+            return
+        key = (name, dbdrivers.make_index_value(follower.values[name]))
+        if key[1] is None:
+            return
+        if add:
+            self.value_index.setdefault(key, set()).add(follower.id)
+        else:
+            ids = self.value_index.get(key)
+            if ids is not None:
+                ids.discard(follower.id)
+                if not ids:
+                    del self.value_index[key]
+
+    def apply(self, record: list):
+        action, id, *arguments = record
+        if action == "add":
+            bot, chat = arguments
+            self.followers[id] = Follower(dbdriver=self, id=id, bot=bot, chat=chat)
+            self.index[(bot, chat)] = id
+            self.last_id = max(self.last_id, id)
+            return
+        follower = self.followers[id]
+        if action == "dialog":
+            follower.dialog, follower.next_step = arguments
+        elif action == "next_step":
+            follower.next_step, = arguments
+        elif action == "set_value":
+            name, value = arguments
+            self.index_value(follower, name, add=False)
+            follower.values[name] = value
+            self.index_value(follower, name)
+        elif action == "delete_value":
+            self.index_value(follower, arguments[0], add=False)
+            follower.values.pop(arguments[0], None)
+        elif action in ("clear_values", "delete"):
+            for name in self.indexed_values:
+                self.index_value(follower, name, add=False)
+            follower.values = {}
+            if action == "delete":
+                del self.followers[id]
+                del self.index[(follower.bot, follower.chat)]
+
+    def get_generations(self) -> List[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def recover(self) -> int:
+        generation = 0
+        path = os.path.join(self.directory, "snapshot.json")
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                snapshot = json.load(file)
+            generation = snapshot["generation"]
+            self.last_id = snapshot["last_id"]
+            for id, bot, chat, dialog, next_step, values in snapshot["followers"]:
+                follower = Follower(dbdriver=self, id=id, bot=bot, chat=chat, dialog=dialog,
+                                    next_step=next_step, values=values)
+                self.followers[id] = follower
+                self.index[(bot, chat)] = id
+                for name in self.indexed_values:
+                    self.index_value(follower, name)
+
+        for log_generation in self.get_generations():
+            if log_generation < generation:
+                continue
+            generation = log_generation
+            with open(get_journal_path(self.directory, log_generation), "rb+") as file:
+                offset = 0
+                for line in file:
+                    try:
+                        record = codec.loads(line)
+                    except ValueError:
+                        # The process died in the middle of a write, the tail is thrown away so
+                        # new records don't get glued to it
+                        logger.warning("Truncate broken journal %s at %s", file.name, offset)
+                        file.truncate(offset)
+                        break
+                    self.apply(record)
+                    offset += len(line)
+        return generation
+
+    def snapshot(self):
+        if self.journal is None:
+            return
+        try:
+            with self.lock:
+                generation = self.generation + 1
+                self.journal.rotate(generation)
+                self.generation = generation
+                followers = [
+                    (follower.id, follower.bot, follower.chat, follower.dialog,
+                     follower.next_step, follower.values.copy())
+                    for follower in self.followers.values()
+                ]
+                last_id = self.last_id
+
+            path = os.path.join(self.directory, "snapshot.json")
+            with open(path + ".tmp", "w") as file:
+                json.dump({"generation": generation, "last_id": last_id,
+                           "followers": followers}, file, ensure_ascii=False,
+                          separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(path + ".tmp", path)
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+            for log_generation in self.get_generations():
+                if log_generation < generation:
+                    os.remove(get_journal_path(self.directory, log_generation))
+        finally:
+            with self.lock:
+                self.snapshot_thread = None
+
+    def get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        id = self.index.get((agent.name, chat.id))
+        return None if id is None else self.followers.get(id)
+
+    async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        return self.get_follower(agent, chat)
+
+    def add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return self.get_or_create_follower(agent, chat)
+
+    async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return self.get_or_create_follower(agent, chat)
+
+    def get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = self.get_follower(agent, chat)
+        if follower is not None:
+            return follower
+        with self.lock:
+            id = self.index.get((agent.name, chat.id))
+            if id is None:
+                id = self.last_id + 1
+                record = ["add", id, agent.name, chat.id]
+                self.apply(record)
+                if self.journal is not None:
+                    self.journal.append(record)
+            return self.followers[id]
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return self.get_or_create_follower(agent, chat)
+
+    def iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None,
+                       after_id: int = 0) -> Iterator[Follower]:
+        # Everything is in memory already, followers are copied batch by batch, so they can be
+        # changed or deleted while iterating
+        filter = dbdrivers.check_filter(filter)
+        values = dbdrivers.check_values(self.indexed_values, values)
+        last_id = after_id
+        while True:
+            with self.lock:
+                followers = []
+                if values:
+                    ids = set.intersection(*(self.value_index.get(key, set())
+                                             for key in values.items()))
+                    ids = sorted(id for id in ids if id > last_id)
+                else:
+                    ids = range(last_id + 1, self.last_id + 1)
+                for id in ids:
+                    follower = self.followers.get(id)
+                    if follower is None:
+                        continue
+                    if agent is not None and follower.bot != agent.name:
+                        continue
+                    if any(getattr(follower, name) != value for name, value in filter.items()):
+                        continue
+                    followers.append(follower)
+                    if len(followers) >= batch_size:
+                        break
+            yield from followers
+            if len(followers) < batch_size:
+                break
+            last_id = followers[-1].id
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        for follower in self.iter_followers(agent=agent, batch_size=batch_size, filter=filter,
+                                            values=values, after_id=after_id):
+            yield follower
+
+    # History is kept in memory only: it isn't written to the journal and is lost on restart.
+    # Messages of a follower are a list in the order they were added, with ids growing across
+    # all followers, so search pages go by id (the cursor) newest first
+    @staticmethod
+    def match_history(record: Record, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None,
+                      input: Optional[bool] = None) -> bool:
+        _, record_input, _, _, created_at = record
+        return ((after_date is None or created_at > after_date) and
+                (before_date is None or created_at < before_date) and
+                (input is None or record_input == input))
+
+    def add_history(self, follower: Follower, message: Message, input: bool = True):
+        record = make_record(follower.id, message, input)
+        with self.lock:
+            self.last_message_id += 1
+            self.history.setdefault(follower.id, []).append((self.last_message_id, record))
+
+    def get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        with self.lock:
+            records = [record for _, record in self.history.get(follower.id, ())
+                       if self.match_history(record, after_date, before_date, input)]
+        if limit is not None:
+            records = records[max(len(records) - limit, 0):]
+        return [parse_record(text, data, input, created_at)
+                for _, input, text, data, created_at in records]
+
+    def remove_history(self, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None):
+        with self.lock:
+            ids = list(self.history) if follower is None else [follower.id]
+            for id in ids:
+                messages = [(message_id, record) for message_id, record in self.history.get(id, ())
+                            if not self.match_history(record, after_date, before_date)]
+                if messages:
+                    self.history[id] = messages
+                else:
+                    self.history.pop(id, None)
+
+    async def a_remove_history(self, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None):
+        self.remove_history(follower=follower, after_date=after_date, before_date=before_date)
+
+    def clear_history(self, before_date: datetime):
+        self.remove_history(before_date=before_date)
+
+    async def a_clear_history(self, before_date: datetime):
+        self.remove_history(before_date=before_date)
+
+    def search_history(self, query: str, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        # Without a full-text index every word is looked for in every message
+        words = query.lower().split()
+        if not words:
+            return [], None
+        cursor_id = None if cursor is None else int(cursor)
+        with self.lock:
+            if follower is None:
+                lists = [list(messages) for messages in self.history.values()]
+            else:
+                lists = [list(self.history.get(follower.id, ()))]
+        messages = []
+        for id, record in heapq.merge(*(reversed(messages) for messages in lists),
+                                      key=itemgetter(0), reverse=True):
+            follower_id, input, text, data, created_at = record
+            if cursor_id is not None and id >= cursor_id:
+                continue
+            if not text or not self.match_history(record, after_date, before_date):
+                continue
+            lowered = text.lower()
+            if any(word not in lowered for word in words):
+                continue
+            messages.append(parse_record(text, data, input, created_at, follower_id=follower_id))
+            if len(messages) >= limit:
+                return messages, str(id)
+        return messages, None
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self.search_history(query, follower=follower, after_date=after_date,
+                                   before_date=before_date, limit=limit, cursor=cursor)
+
+    def delete(self, follower: Follower):
+        self.write(["delete", follower.id])
+        with self.lock:
+            self.history.pop(follower.id, None)
+
+    async def a_delete(self, follower: Follower):
+        self.delete(follower)
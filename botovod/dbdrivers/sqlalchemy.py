@@ -1,18 +1,40 @@
 from __future__ import annotations
+import asyncio
 from botovod import dbdrivers
-from botovod.agents import Agent, Chat
+from botovod.agents import Agent, Chat, Message
+from botovod.exceptions import FollowerConflictException
+from botovod.utils import codec
 from datetime import datetime
 import json
 import logging
-from sqlalchemy import Column, ForeignKey, create_engine
+from sqlalchemy import (DDL, Column, ForeignKey, Index, MetaData, Table, bindparam, create_engine,
+                        delete, event, func, insert, inspect, literal_column, select, update)
+from sqlalchemy.engine import Connection, Dialect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.types import Boolean, Date, Integer, DateTime, String, Text
-from typing import Dict, Optional, Union
+from sqlalchemy.orm import aliased, scoped_session, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql import ColumnElement, Select
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.expression import TableClause, column
+from sqlalchemy.types import Boolean, Integer, DateTime, String, Text
+from threading import Lock
+from typing import (Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple,
+                    Union)
+
+from .history import (SEARCH_CONFIG, SQLITE_SEARCH, SQLITE_SEARCH_DROP, SQLITE_SEARCH_REBUILD,
+                      AsyncHistoryWriter, HistoryWriter, Record, get_partition, get_partitions,
+                      make_cursor, make_record, make_sqlite_search_query, parse_cursor,
+                      parse_record)
 
 
 Base = declarative_base()
 logger = logging.getLogger(__name__)
+NOTHING = object()
+HISTORY_PREFIX = "botovod_messages_"
+history_metadata = MetaData()
+history_lock = Lock()
 
 
 class Common:
@@ -23,93 +45,1052 @@ class Common:
 
 class Follower(dbdrivers.Follower, Common, Base):
     __tablename__ = "botovod_followers"
+    __table_args__ = (Index("botovod_followers_bot_chat", "bot", "chat", unique=True),)
 
     chat = Column(String(64), nullable=False)
     bot = Column(String(64), nullable=False)
     dialog = Column(String(64), nullable=True)
     next_step = Column(String(64), nullable=True)
+    # Values live in botovod_follower_values, this column is only read to move values of
+    # followers created by older versions there
     data = Column(Text, nullable=False, default="{}")
-    messages = relationship("Message", back_populates="follower", uselist=True)
+    # Every write of the follower sets the next version, the UPDATE only matches the version which
+    # was read, so a follower changed by another update since then is not overwritten
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
+
+    _values = None
+    _values_complete = False
+
+    def set_dbdriver(self, dbdriver: DBDriver):
+        self._dbdriver = dbdriver
 
     def get_chat(self) -> Chat:
         return Chat(self.bot, self.chat)
 
+    async def a_get_chat(self) -> Chat:
+        return self.get_chat()
+
     def get_dialog(self) -> Optional[str]:
         return self.dialog
 
+    async def a_get_dialog(self) -> Optional[str]:
+        return self.dialog
+
     def set_dialog(self, name: Optional[str] = None):
         self.dialog = name
         self.set_next_step(None if name is None else "start")
 
+    async def a_set_dialog(self, name: Optional[str] = None):
+        self.dialog = name
+        await self.a_set_next_step(None if name is None else "start")
+
     def get_next_step(self) -> Optional[str]:
         return self.next_step
 
+    async def a_get_next_step(self) -> Optional[str]:
+        return self.next_step
+
     def set_next_step(self, next_step: Optional[str] = None):
         self.next_step = next_step
-        self._dbdriver.session.add(self)
-        self._dbdriver.session.commit()
+        self._dbdriver.commit(self)
+
+    async def a_set_next_step(self, next_step: Optional[str] = None):
+        self.next_step = next_step
+        await self._dbdriver.a_commit(self)
 
     def get_values(self) -> Dict[str, str]:
-        return json.loads(self.data)
+        if not self._values_complete:
+            self._values = self._dbdriver.load_values(self)
+            self._values_complete = True
+        return self._values.copy()
+
+    async def a_get_values(self) -> Dict[str, str]:
+        if not self._values_complete:
+            self._values = await self._dbdriver.a_load_values(self)
+            self._values_complete = True
+        return self._values.copy()
 
     def get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
-        return json.loads(self.data).get(name, default)
+        if self.data != "{}":
+            self.get_values()
+        if self._values is None:
+            self._values = {}
+        if name not in self._values and not self._values_complete:
+            self._values[name] = self._dbdriver.load_value(self, name)
+        value = self._values.get(name, NOTHING)
+        return default if value is NOTHING else value
+
+    async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        if self.data != "{}":
+            await self.a_get_values()
+        if self._values is None:
+            self._values = {}
+        if name not in self._values and not self._values_complete:
+            self._values[name] = await self._dbdriver.a_load_value(self, name)
+        value = self._values.get(name, NOTHING)
+        return default if value is NOTHING else value
 
     def set_value(self, name: str, value: str):
-        data = json.loads(self.data)
-        data[name] = value
-        self.data = json.dumps(data)
-        self._dbdriver.session.add(self)
-        self._dbdriver.commit()
+        if self.data != "{}":
+            self.get_values()
+        self._dbdriver.save_value(self, name, value)
+        if self._values is None:
+            self._values = {}
+        self._values[name] = value
+
+    async def a_set_value(self, name: str, value: str):
+        if self.data != "{}":
+            await self.a_get_values()
+        await self._dbdriver.a_save_value(self, name, value)
+        if self._values is None:
+            self._values = {}
+        self._values[name] = value
 
     def delete_value(self, name: str):
-        data = json.loads(self.data)
-        if name in data:
-            del data[name]
-        self.data = json.dumps(data)
-        self._dbdriver.session.commit()
+        if self.data != "{}":
+            self.get_values()
+        self._dbdriver.remove_values(self, name)
+        if self._values is not None:
+            self._values.pop(name, None)
+
+    async def a_delete_value(self, name: str):
+        if self.data != "{}":
+            await self.a_get_values()
+        await self._dbdriver.a_remove_values(self, name)
+        if self._values is not None:
+            self._values.pop(name, None)
 
     def clear_values(self):
         self.data = "{}"
-        self._dbdriver.session.commit()
+        self._dbdriver.remove_values(self)
+        self._values = {}
+        self._values_complete = True
+
+    async def a_clear_values(self):
+        self.data = "{}"
+        await self._dbdriver.a_remove_values(self)
+        self._values = {}
+        self._values_complete = True
+
+    def add_history(self, message: Message, input: bool = True):
+        self._dbdriver.add_history(self, message, input)
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        await self._dbdriver.a_add_history(self, message, input)
+
+    def get_history(self, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        return self._dbdriver.get_history(self, after_date=after_date, before_date=before_date,
+                                          input=input, limit=limit)
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        return await self._dbdriver.a_get_history(self, after_date=after_date,
+                                                  before_date=before_date, input=input,
+                                                  limit=limit)
+
+    def clear_history(self, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None):
+        self._dbdriver.remove_history(follower=self, after_date=after_date,
+                                      before_date=before_date)
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        await self._dbdriver.a_remove_history(follower=self, after_date=after_date,
+                                              before_date=before_date)
+
+    def search_history(self, query: str, after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self._dbdriver.search_history(query, follower=self, after_date=after_date,
+                                             before_date=before_date, limit=limit, cursor=cursor)
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return await self._dbdriver.a_search_history(query, follower=self, after_date=after_date,
+                                                     before_date=before_date, limit=limit,
+                                                     cursor=cursor)
+
+
+class FollowerValue(Base):
+    __tablename__ = "botovod_follower_values"
+
+    follower_id = Column(Integer, ForeignKey("botovod_followers.id", ondelete="CASCADE"),
+                         nullable=False, primary_key=True)
+    name = Column(String(64), nullable=False, primary_key=True)
+    value = Column(Text, nullable=False)
+
+
+# Values of keys declared as indexed are copied here, the primary key makes (name, value) lookups
+# an index range scan ordered by follower_id
+class FollowerIndexValue(Base):
+    __tablename__ = "botovod_follower_index"
+    __table_args__ = (Index("botovod_follower_index_follower", "follower_id", "name"),)
+
+    name = Column(String(64), nullable=False, primary_key=True)
+    value = Column(String(dbdrivers.INDEX_VALUE_LENGTH), nullable=False, primary_key=True)
+    follower_id = Column(Integer, ForeignKey("botovod_followers.id", ondelete="CASCADE"),
+                         nullable=False, primary_key=True)
+
+
+def get_history_table(partition: str) -> Table:
+    name = HISTORY_PREFIX + partition
+    with history_lock:
+        table = history_metadata.tables.get(name)
+        if table is None:
+            text = Column("text", Text, nullable=True)
+            # Full-text index of the messages, what it is depends on the database
+            search = {
+                "postgresql": Index(f"{name}_search", get_search_vector(text),
+                                    postgresql_using="gin").ddl_if(dialect="postgresql"),
+                "mysql": Index(f"{name}_search", text,
+                               mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+            }
+            table = Table(
+                name,
+                history_metadata,
+                Column("id", Integer, autoincrement=True, nullable=False, primary_key=True),
+                Column("follower_id", Integer, nullable=False),
+                Column("input", Boolean, nullable=False),
+                text,
+                Column("data", Text, nullable=False),
+                Column("created_at", DateTime, nullable=False),
+                Index(f"{name}_follower_created", "follower_id", "created_at"),
+                *search.values(),
+                info={"search": search},
+            )
+            for statement in SQLITE_SEARCH:
+                event.listen(table, "after_create",
+                             DDL(statement.format(table=name)).execute_if(dialect="sqlite"))
+            event.listen(table, "before_drop",
+                         DDL(SQLITE_SEARCH_DROP.format(table=name)).execute_if(dialect="sqlite"))
+    return table
+
+
+def get_search_vector(text: Column) -> ColumnElement:
+    # The config is written inline, so queries match the expression of the index exactly
+    return func.to_tsvector(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), text)
+
+
+def make_search_statement(dialect: str, table: Table, query: str) -> Optional[Select]:
+    statement = select(table.c.id, table.c.follower_id, table.c.text, table.c.data,
+                       table.c.input, table.c.created_at)
+    if dialect == "postgresql":
+        config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+        return statement.where(
+            get_search_vector(table.c.text).op("@@")(func.plainto_tsquery(config, query)),
+        ).order_by(table.c.id.desc())
+    if dialect == "mysql":
+        return statement.where(table.c.text.match(query)).order_by(table.c.id.desc())
+    if dialect == "sqlite":
+        query = make_sqlite_search_query(query)
+        if not query:
+            return None
+        search = TableClause(table.name + "_search", column("rowid"))
+        return statement.select_from(
+            table.join(search, search.c.rowid == table.c.id),
+        ).where(literal_column(search.name).op("MATCH")(query)).order_by(search.c.rowid.desc())
+    # Without a full-text index every word is looked for in every message
+    words = query.split()
+    if not words:
+        return None
+    return statement.where(
+        *(table.c.text.ilike(f"%{word}%") for word in words),
+    ).order_by(table.c.id.desc())
+
+
+# Values are one row or a list of rows, conflicting rows get columns of update from the new row
+# and expressions of set_ (e.g. a version incremented)
+def upsert(dialect: str, table: Table, values: Union[Dict[str, Any], List[Dict[str, Any]]],
+           keys: Iterable[str], update: Iterable[str],
+           set_: Optional[Dict[str, Any]] = None) -> Optional[Insert]:
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table).values(values)
+        return statement.on_duplicate_key_update(
+            **{name: statement.inserted[name] for name in update}, **(set_ or {}),
+        )
+    else:
+        return None
+    statement = insert(table).values(values)
+    return statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={**{name: statement.excluded[name] for name in update}, **(set_ or {})},
+    )
 
 
 class DBDriver(dbdrivers.DBDriver):
-    def connect(self, engine: str, database: str, host: Optional[Union[str, int]] = None,
-                username: Optional[str] = None, password: Optional[str] = None,
-                debug: bool = False):
+    keeps_history = True
+
+    def __init__(self):
+        self.engine = None
+        self.metadata = Base.metadata
+        self.session = None
+        self.async_engine = None
+        self.async_session = None
+        self.history_batch_size = 500
+        self.history_interval = 1.0
+        self.history_lock = Lock()
+        self.history_partitions = None
+        self.indexed_values = frozenset()
+        self.history_writer = None
+        self.async_history_writer = None
+
+    @staticmethod
+    def make_dsn(engine: str, database: str, host: Optional[Union[str, int]] = None,
+                 username: Optional[str] = None, password: Optional[str] = None) -> str:
         dsn = f"{engine}://"
         if username is not None and password is not None:
             dsn += f"{username}:{password}@"
-        if host is not None:
-            dsn += f"{host}/"
-        dsn += database
-        self.engine = create_engine(dsn, echo=debug)
-        self.metadata = Base.metadata
-        Session = sessionmaker()
-        Session.configure(bind=self.engine)
-        self.session = Session()
+        dsn += "" if host is None else str(host)
+        dsn += f"/{database}"
+        return dsn
+
+    @staticmethod
+    def make_pool_settings(pool_size: Optional[int] = None, max_overflow: Optional[int] = None,
+                           pool_recycle: Optional[int] = None,
+                           pool_pre_ping: bool = True) -> Dict[str, Any]:
+        # Pool sizing is only passed through when set, so engines with pools that don't accept
+        # these arguments (SQLite in-memory databases, for example) keep working with defaults
+        settings = {"pool_pre_ping": pool_pre_ping}
+        if pool_size is not None:
+            settings["pool_size"] = pool_size
+        if max_overflow is not None:
+            settings["max_overflow"] = max_overflow
+        if pool_recycle is not None:
+            settings["pool_recycle"] = pool_recycle
+        return settings
+
+    def connect(self, engine: str, database: str, host: Optional[Union[str, int]] = None,
+                username: Optional[str] = None, password: Optional[str] = None,
+                debug: bool = False, pool_size: Optional[int] = None,
+                max_overflow: Optional[int] = None, pool_recycle: Optional[int] = None,
+                pool_pre_ping: bool = True, history_batch_size: int = 500,
+                history_interval: float = 1.0, indexed_values: Iterable[str] = ()):
+        dsn = self.make_dsn(engine=engine, database=database, host=host, username=username,
+                            password=password)
+        pool_settings = self.make_pool_settings(pool_size=pool_size, max_overflow=max_overflow,
+                                                pool_recycle=pool_recycle,
+                                                pool_pre_ping=pool_pre_ping)
+        self.engine = create_engine(dsn, echo=debug, **pool_settings)
+        # Every thread gets its own session, it lives until the update is finished
+        self.session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.indexed_values = frozenset(indexed_values)
+
+    async def a_connect(self, engine: str, database: str,
+                        host: Optional[Union[str, int]] = None, username: Optional[str] = None,
+                        password: Optional[str] = None, debug: bool = False,
+                        pool_size: Optional[int] = None, max_overflow: Optional[int] = None,
+                        pool_recycle: Optional[int] = None, pool_pre_ping: bool = True,
+                        history_batch_size: int = 500, history_interval: float = 1.0,
+                        indexed_values: Iterable[str] = ()):
+        # Engine must name an asyncio DBAPI, e.g. "postgresql+asyncpg" or "sqlite+aiosqlite"
+        await self.a_close()
+        dsn = self.make_dsn(engine=engine, database=database, host=host, username=username,
+                            password=password)
+        pool_settings = self.make_pool_settings(pool_size=pool_size, max_overflow=max_overflow,
+                                                pool_recycle=pool_recycle,
+                                                pool_pre_ping=pool_pre_ping)
+        self.async_engine = create_async_engine(dsn, echo=debug, **pool_settings)
+        # Same as the sync path, but the session is bound to the running task
+        self.async_session = async_scoped_session(
+            sessionmaker(bind=self.async_engine, class_=AsyncSession, expire_on_commit=False),
+            scopefunc=asyncio.current_task,
+        )
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.indexed_values = frozenset(indexed_values)
 
     def close(self):
-        self.session.close()
+        if self.history_writer is not None:
+            self.history_writer.stop()
+            self.history_writer = None
+        if self.session is not None:
+            self.session.remove()
+        if self.engine is not None:
+            self.engine.dispose()
+
+    async def a_close(self):
+        if self.async_history_writer is not None:
+            await self.async_history_writer.stop()
+            self.async_history_writer = None
+        if self.async_session is not None:
+            await self.async_session.remove()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+    @staticmethod
+    def next_version(follower: Follower):
+        # Writes of values don't change the follower row, the version makes it written anyway
+        if follower.version is not None:
+            follower.version += 1
+
+    def commit(self, follower: Follower):
+        session = self.session()
+        session.add(follower)
+        self.next_version(follower)
+        try:
+            session.commit()
+        except StaleDataError:
+            session.rollback()
+            raise FollowerConflictException()
+        except Exception:
+            session.rollback()
+            raise
+
+    async def a_commit(self, follower: Follower):
+        session = self.async_session()
+        session.add(follower)
+        self.next_version(follower)
+        try:
+            await session.commit()
+        except StaleDataError:
+            await session.rollback()
+            raise FollowerConflictException()
+        except Exception:
+            await session.rollback()
+            raise
+
+    def finish(self, follower: Optional[Follower] = None):
+        self.session.remove()
+
+    async def a_finish(self, follower: Optional[Follower] = None):
+        await self.async_session.remove()
+
+    def make_index_values(self, follower: Follower, name: str,
+                          value: Any) -> List[FollowerIndexValue]:
+        if name not in self.indexed_values:
+            return []
+        value = dbdrivers.make_index_value(value)
+        if value is None:
+            return []
+        return [FollowerIndexValue(follower_id=follower.id, name=name, value=value)]
+
+    @staticmethod
+    def make_remove_index_statement(follower: Follower, *names: str):
+        statement = delete(FollowerIndexValue).where(FollowerIndexValue.follower_id == follower.id)
+        if names:
+            statement = statement.where(FollowerIndexValue.name.in_(names))
+        return statement
+
+    def make_reindex_statements(self) -> tuple:
+        # Index is built again from values, so keys can be declared for existing followers
+        return (
+            delete(FollowerIndexValue),
+            insert(FollowerIndexValue).from_select(
+                ["follower_id", "name", "value"],
+                select(FollowerValue.follower_id, FollowerValue.name, FollowerValue.value).where(
+                    FollowerValue.name.in_(self.indexed_values),
+                    func.length(FollowerValue.value) <= dbdrivers.INDEX_VALUE_LENGTH,
+                ),
+            ),
+        )
+
+    def reindex_values(self):
+        with self.engine.begin() as connection:
+            for statement in self.make_reindex_statements():
+                connection.execute(statement)
+
+    async def a_reindex_values(self):
+        async with self.async_engine.begin() as connection:
+            for statement in self.make_reindex_statements():
+                await connection.execute(statement)
+
+    def load_values(self, follower: Follower) -> Dict[str, Any]:
+        rows = self.session.query(FollowerValue.name, FollowerValue.value).filter(
+            FollowerValue.follower_id == follower.id,
+        )
+        values = {name: codec.loads(value) for name, value in rows}
+        if follower.data != "{}":
+            for name, value in codec.loads(follower.data).items():
+                if name not in values:
+                    values[name] = value
+                    self.session.add(FollowerValue(follower_id=follower.id, name=name,
+                                                   value=json.dumps(value)))
+                    self.session.add_all(self.make_index_values(follower, name, value))
+            follower.data = "{}"
+            self.commit(follower)
+        return values
+
+    async def a_load_values(self, follower: Follower) -> Dict[str, Any]:
+        rows = await self.async_session.execute(
+            select(FollowerValue.name, FollowerValue.value).where(
+                FollowerValue.follower_id == follower.id,
+            ),
+        )
+        values = {name: codec.loads(value) for name, value in rows}
+        if follower.data != "{}":
+            for name, value in codec.loads(follower.data).items():
+                if name not in values:
+                    values[name] = value
+                    self.async_session.add(FollowerValue(follower_id=follower.id, name=name,
+                                                         value=json.dumps(value)))
+                    self.async_session.add_all(self.make_index_values(follower, name, value))
+            follower.data = "{}"
+            await self.a_commit(follower)
+        return values
+
+    # Followers keeping values in the data column are left to load_values, which moves them
+    @staticmethod
+    def make_prefetch_followers(followers: List[Follower]) -> Dict[int, Follower]:
+        return {follower.id: follower for follower in followers
+                if not follower._values_complete and follower.data == "{}"}
+
+    @staticmethod
+    def set_values(followers: Dict[int, Follower], rows: Iterable[tuple]):
+        values = {follower_id: {} for follower_id in followers}
+        for follower_id, name, value in rows:
+            values[follower_id][name] = codec.loads(value)
+        for follower_id, follower in followers.items():
+            follower._values = values[follower_id]
+            follower._values_complete = True
+
+    def prefetch_values(self, followers: List[Follower]):
+        followers = self.make_prefetch_followers(followers)
+        if followers:
+            rows = self.session.query(
+                FollowerValue.follower_id, FollowerValue.name, FollowerValue.value,
+            ).filter(FollowerValue.follower_id.in_(list(followers)))
+            self.set_values(followers, rows)
+
+    async def a_prefetch_values(self, followers: List[Follower]):
+        followers = self.make_prefetch_followers(followers)
+        if followers:
+            rows = await self.async_session.execute(
+                select(FollowerValue.follower_id, FollowerValue.name, FollowerValue.value).where(
+                    FollowerValue.follower_id.in_(list(followers)),
+                ),
+            )
+            self.set_values(followers, rows)
+
+    def load_value(self, follower: Follower, name: str) -> Any:
+        value = self.session.query(FollowerValue.value).filter(
+            FollowerValue.follower_id == follower.id,
+            FollowerValue.name == name,
+        ).scalar()
+        return NOTHING if value is None else codec.loads(value)
+
+    async def a_load_value(self, follower: Follower, name: str) -> Any:
+        value = await self.async_session.scalar(select(FollowerValue.value).where(
+            FollowerValue.follower_id == follower.id,
+            FollowerValue.name == name,
+        ))
+        return NOTHING if value is None else codec.loads(value)
+
+    def save_value(self, follower: Follower, name: str, value: Any):
+        values = {"follower_id": follower.id, "name": name, "value": json.dumps(value)}
+        statement = upsert(dialect=self.engine.dialect.name, table=FollowerValue.__table__,
+                           values=values, keys=("follower_id", "name"), update=("value",))
+        if statement is None:
+            self.session.merge(FollowerValue(**values))
+        else:
+            self.session.execute(statement)
+        if name in self.indexed_values:
+            self.session.execute(self.make_remove_index_statement(follower, name))
+            self.session.add_all(self.make_index_values(follower, name, value))
+        self.commit(follower)
+
+    async def a_save_value(self, follower: Follower, name: str, value: Any):
+        values = {"follower_id": follower.id, "name": name, "value": json.dumps(value)}
+        statement = upsert(dialect=self.async_engine.dialect.name,
+                           table=FollowerValue.__table__, values=values,
+                           keys=("follower_id", "name"), update=("value",))
+        if statement is None:
+            await self.async_session.merge(FollowerValue(**values))
+        else:
+            await self.async_session.execute(statement)
+        if name in self.indexed_values:
+            await self.async_session.execute(self.make_remove_index_statement(follower, name))
+            self.async_session.add_all(self.make_index_values(follower, name, value))
+        await self.a_commit(follower)
+
+    def remove_values(self, follower: Follower, *names: str):
+        query = delete(FollowerValue).where(FollowerValue.follower_id == follower.id)
+        if names:
+            query = query.where(FollowerValue.name.in_(names))
+        self.session.execute(query)
+        if self.indexed_values:
+            self.session.execute(self.make_remove_index_statement(follower, *names))
+        self.commit(follower)
+
+    async def a_remove_values(self, follower: Follower, *names: str):
+        query = delete(FollowerValue).where(FollowerValue.follower_id == follower.id)
+        if names:
+            query = query.where(FollowerValue.name.in_(names))
+        await self.async_session.execute(query)
+        if self.indexed_values:
+            await self.async_session.execute(self.make_remove_index_statement(follower, *names))
+        await self.a_commit(follower)
+
+    def get_history_partitions(self, connection: Connection) -> Set[str]:
+        if self.history_partitions is None:
+            names = set(inspect(connection).get_table_names())
+            partitions = {name[len(HISTORY_PREFIX):] for name in names
+                          if name.startswith(HISTORY_PREFIX) and
+                          name[len(HISTORY_PREFIX):].isdigit()}
+            # Partitions made before search was added get their index built once
+            dialect = connection.dialect.name
+            for partition in partitions:
+                table = get_history_table(partition)
+                if dialect == "sqlite" and table.name + "_search" not in names:
+                    for statement in SQLITE_SEARCH + (SQLITE_SEARCH_REBUILD,):
+                        connection.exec_driver_sql(statement.format(table=table.name))
+                elif dialect in table.info["search"]:
+                    indexes = inspect(connection).get_indexes(table.name)
+                    if table.name + "_search" not in {index["name"] for index in indexes}:
+                        table.info["search"][dialect].create(connection)
+            self.history_partitions = partitions
+        return self.history_partitions
+
+    # Functions below take a sync connection, the async path runs them through run_sync
+    def insert_history(self, connection: Connection, records: List[Record]):
+        partitions = {}
+        for follower_id, input, text, data, created_at in records:
+            partitions.setdefault(get_partition(created_at), []).append({
+                "follower_id": follower_id,
+                "input": input,
+                "text": text,
+                "data": data,
+                "created_at": created_at,
+            })
+        for partition, rows in partitions.items():
+            table = get_history_table(partition)
+            existing = self.get_history_partitions(connection)
+            if partition not in existing:
+                table.create(connection, checkfirst=True)
+                # The set is replaced instead of changed, readers may iterate over the old one
+                self.history_partitions = existing | {partition}
+            connection.execute(table.insert(), rows)
+
+    def select_history(self, connection: Connection, follower_id: int,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                       limit: Optional[int] = None) -> List[Message]:
+        # Partitions are read from the newest one, so the last messages need only the last months
+        messages = []
+        partitions = get_partitions(self.get_history_partitions(connection), after_date,
+                                    before_date)
+        for partition in reversed(partitions):
+            table = get_history_table(partition)
+            query = select(table.c.text, table.c.data, table.c.input, table.c.created_at).where(
+                table.c.follower_id == follower_id,
+            )
+            if after_date is not None:
+                query = query.where(table.c.created_at > after_date)
+            if before_date is not None:
+                query = query.where(table.c.created_at < before_date)
+            if input is not None:
+                query = query.where(table.c.input == input)
+            query = query.order_by(table.c.created_at.desc(), table.c.id.desc())
+            if limit is not None:
+                query = query.limit(limit - len(messages))
+            messages.extend(parse_record(*row) for row in connection.execute(query))
+            if limit is not None and len(messages) >= limit:
+                break
+        messages.reverse()
+        return messages
+
+    def delete_history(self, connection: Connection, follower_id: Optional[int] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None):
+        existing = self.get_history_partitions(connection)
+        for partition in get_partitions(existing, after_date, before_date):
+            table = get_history_table(partition)
+            if (follower_id is None and after_date is None and before_date is not None and
+                    partition < get_partition(before_date)):
+                table.drop(connection, checkfirst=True)
+                self.history_partitions = self.history_partitions - {partition}
+                continue
+            query = delete(table)
+            if follower_id is not None:
+                query = query.where(table.c.follower_id == follower_id)
+            if after_date is not None:
+                query = query.where(table.c.created_at > after_date)
+            if before_date is not None:
+                query = query.where(table.c.created_at < before_date)
+            connection.execute(query)
+
+    def select_search_history(self, connection: Connection, query: str,
+                              follower_id: Optional[int] = None,
+                              after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None, limit: int = 20,
+                              cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        messages = []
+        last = None
+        cursor_partition, cursor_id = parse_cursor(cursor)
+        partitions = get_partitions(self.get_history_partitions(connection), after_date,
+                                    before_date)
+        for partition in reversed(partitions):
+            if cursor_partition is not None and partition > cursor_partition:
+                continue
+            table = get_history_table(partition)
+            statement = make_search_statement(connection.dialect.name, table, query)
+            if statement is None:
+                break
+            if follower_id is not None:
+                statement = statement.where(table.c.follower_id == follower_id)
+            if after_date is not None:
+                statement = statement.where(table.c.created_at > after_date)
+            if before_date is not None:
+                statement = statement.where(table.c.created_at < before_date)
+            if partition == cursor_partition:
+                statement = statement.where(table.c.id < cursor_id)
+            statement = statement.limit(limit - len(messages))
+            for id, message_follower_id, text, data, input, created_at in connection.execute(
+                statement,
+            ):
+                messages.append(parse_record(text, data, input, created_at,
+                                             follower_id=message_follower_id))
+                last = make_cursor(partition, id)
+            if len(messages) >= limit:
+                return messages, last
+        return messages, None
+
+    def write_history(self, records: List[Record]):
+        with self.engine.begin() as connection:
+            self.insert_history(connection, records)
+
+    async def a_write_history(self, records: List[Record]):
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(self.insert_history, records)
+
+    def add_history(self, follower: Follower, message: Message, input: bool = True):
+        if self.history_writer is None:
+            with self.history_lock:
+                if self.history_writer is None:
+                    writer = HistoryWriter(write=self.write_history,
+                                           batch_size=self.history_batch_size,
+                                           interval=self.history_interval)
+                    writer.start()
+                    self.history_writer = writer
+        self.history_writer.add(make_record(follower.id, message, input))
+
+    async def a_add_history(self, follower: Follower, message: Message, input: bool = True):
+        if self.async_history_writer is None:
+            self.async_history_writer = AsyncHistoryWriter(write=self.a_write_history,
+                                                           batch_size=self.history_batch_size,
+                                                           interval=self.history_interval)
+        self.async_history_writer.add(make_record(follower.id, message, input))
+
+    def get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        if self.history_writer is not None:
+            self.history_writer.flush()
+        with self.engine.connect() as connection:
+            return self.select_history(connection, follower.id, after_date=after_date,
+                                       before_date=before_date, input=input, limit=limit)
+
+    async def a_get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        if self.async_history_writer is not None:
+            await self.async_history_writer.flush()
+        async with self.async_engine.connect() as connection:
+            return await connection.run_sync(
+                lambda connection: self.select_history(
+                    connection, follower.id, after_date=after_date, before_date=before_date,
+                    input=input, limit=limit,
+                ),
+            )
+
+    def remove_history(self, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None):
+        if self.history_writer is not None:
+            self.history_writer.flush()
+        with self.engine.begin() as connection:
+            self.delete_history(connection, follower_id=None if follower is None else follower.id,
+                                after_date=after_date, before_date=before_date)
+
+    async def a_remove_history(self, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None):
+        if self.async_history_writer is not None:
+            await self.async_history_writer.flush()
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(
+                lambda connection: self.delete_history(
+                    connection, follower_id=None if follower is None else follower.id,
+                    after_date=after_date, before_date=before_date,
+                ),
+            )
+
+    def clear_history(self, before_date: datetime):
+        self.remove_history(before_date=before_date)
+
+    async def a_clear_history(self, before_date: datetime):
+        await self.a_remove_history(before_date=before_date)
+
+    def search_history(self, query: str, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        if self.history_writer is not None:
+            self.history_writer.flush()
+        with self.engine.connect() as connection:
+            return self.select_search_history(
+                connection, query, follower_id=None if follower is None else follower.id,
+                after_date=after_date, before_date=before_date, limit=limit, cursor=cursor,
+            )
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        if self.async_history_writer is not None:
+            await self.async_history_writer.flush()
+        async with self.async_engine.connect() as connection:
+            return await connection.run_sync(
+                lambda connection: self.select_search_history(
+                    connection, query, follower_id=None if follower is None else follower.id,
+                    after_date=after_date, before_date=before_date, limit=limit,
+                    cursor=cursor,
+                ),
+            )
 
     def get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
-        follower = self.session.query(Follower).filter(Follower.bot == agent.name)
-        follower.set_dbdriver(self)
-        return follower.filter(Follower.chat == chat.id).first()
+        follower = self.session.query(Follower).filter(
+            Follower.bot == agent.name,
+            Follower.chat == chat.id,
+        ).first()
+        if follower is not None:
+            follower.set_dbdriver(self)
+        return follower
+
+    async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        query = select(Follower).where(Follower.bot == agent.name, Follower.chat == chat.id)
+        follower = (await self.async_session.execute(query)).scalars().first()
+        if follower is not None:
+            follower.set_dbdriver(self)
+        return follower
 
     def add_follower(self, agent: Agent, chat: Chat) -> Follower:
         follower = Follower(chat=chat.id, bot=agent.name)
-        self.session.add(follower)
-        self.session.commit()
         follower.set_dbdriver(self)
+        self.commit(follower)
+        return follower
+
+    async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = Follower(chat=chat.id, bot=agent.name)
+        follower.set_dbdriver(self)
+        await self.a_commit(follower)
         return follower
 
+    @staticmethod
+    def make_get_or_create_statement(dialect: Dialect, agent: Agent,
+                                     chat: Chat) -> Optional[Select]:
+        # ON CONFLICT DO NOTHING returns no row for existing followers, so conflicts "update"
+        # bot to itself to get the row back from the same statement
+        if not getattr(dialect, "insert_returning", dialect.name == "postgresql"):
+            return None
+        statement = upsert(dialect=dialect.name, table=Follower.__table__,
+                           values={"bot": agent.name, "chat": chat.id}, keys=("bot", "chat"),
+                           update=("bot",))
+        if statement is None:
+            return None
+        statement = statement.returning(*Follower.__table__.columns)
+        return select(Follower).from_statement(statement).execution_options(
+            populate_existing=True,
+        )
+
+    def get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        # Almost every update comes from a known follower, a plain indexed select doesn't write
+        # anything for them, the upsert only runs for new followers and closes the race between
+        # two first messages
+        follower = self.get_follower(agent, chat)
+        if follower is not None:
+            return follower
+
+        statement = self.make_get_or_create_statement(self.engine.dialect, agent, chat)
+        if statement is None:
+            try:
+                return self.add_follower(agent, chat)
+            except IntegrityError:
+                return self.get_follower(agent, chat)
+
+        session = self.session()
+        follower = session.execute(statement).scalars().one()
+        session.commit()
+        follower.set_dbdriver(self)
+        return follower
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = await self.a_get_follower(agent, chat)
+        if follower is not None:
+            return follower
+
+        statement = self.make_get_or_create_statement(self.async_engine.dialect, agent, chat)
+        if statement is None:
+            try:
+                return await self.a_add_follower(agent, chat)
+            except IntegrityError:
+                return await self.a_get_follower(agent, chat)
+
+        session = self.async_session()
+        follower = (await session.execute(statement)).scalars().one()
+        await session.commit()
+        follower.set_dbdriver(self)
+        return follower
+
+    # Followers of a batch are written by one upsert, their old values are removed and the new
+    # ones inserted by one statement per table, all in one transaction. A follower which exists
+    # gets the next version, so updates which read it before fail with a conflict
+    def insert_followers(self, connection: Connection, agent: Agent,
+                         rows: List[dbdrivers.ImportRow]):
+        followers = {chat.id: (dialog, next_step, values)
+                     for chat, dialog, next_step, values in rows}
+        if not followers:
+            return
+        table = Follower.__table__
+        now = datetime.now()
+        new_rows = [
+            {"bot": agent.name, "chat": chat, "dialog": dialog, "next_step": next_step,
+             "data": "{}", "version": 0, "created_at": now}
+            for chat, (dialog, next_step, _) in followers.items()
+        ]
+        statement = upsert(dialect=connection.dialect.name, table=table, values=new_rows,
+                           keys=("bot", "chat"), update=("dialog", "next_step", "data"),
+                           set_={"version": table.c.version + 1})
+        query = select(table.c.chat, table.c.id).where(
+            table.c.bot == agent.name,
+            table.c.chat.in_(followers),
+        )
+        if statement is None:
+            existing = dict(connection.execute(query).all())
+            missing = [row for row in new_rows if row["chat"] not in existing]
+            if missing:
+                connection.execute(insert(table), missing)
+            if existing:
+                connection.execute(
+                    update(table).where(
+                        table.c.bot == agent.name,
+                        table.c.chat == bindparam("old_chat"),
+                    ).values(dialog=bindparam("dialog"), next_step=bindparam("next_step"),
+                             data="{}", version=table.c.version + 1),
+                    [{"old_chat": row["chat"], "dialog": row["dialog"],
+                      "next_step": row["next_step"]}
+                     for row in new_rows if row["chat"] in existing],
+                )
+        else:
+            connection.execute(statement)
+        ids = dict(connection.execute(query).all())
+
+        connection.execute(
+            delete(FollowerValue).where(FollowerValue.follower_id.in_(ids.values())),
+        )
+        connection.execute(
+            delete(FollowerIndexValue).where(FollowerIndexValue.follower_id.in_(ids.values())),
+        )
+        value_rows = []
+        index_rows = []
+        for chat, (_, _, values) in followers.items():
+            for name, value in values.items():
+                value_rows.append({"follower_id": ids[chat], "name": name,
+                                   "value": json.dumps(value)})
+                index_value = (dbdrivers.make_index_value(value)
+                               if name in self.indexed_values else None)
+                if index_value is not None:
+                    index_rows.append({"follower_id": ids[chat], "name": name,
+                                       "value": index_value})
+        if value_rows:
+            connection.execute(insert(FollowerValue), value_rows)
+        if index_rows:
+            connection.execute(insert(FollowerIndexValue), index_rows)
+
+    def import_followers(self, agent: Agent, rows: Iterable[dbdrivers.ImportRow]):
+        with self.engine.begin() as connection:
+            self.insert_followers(connection, agent, list(rows))
+
+    async def a_import_followers(self, agent: Agent, rows: Iterable[dbdrivers.ImportRow]):
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(self.insert_followers, agent, list(rows))
+
+    # Followers are read in batches ordered by id, each batch starts after the last id of the
+    # previous one, so a batch costs the same at any depth and only one batch is in memory
+    def make_iter_query(self, agent: Optional[Agent], filter: Dict[str, Optional[str]],
+                        values: Dict[str, str], last_id: int, batch_size: int) -> Select:
+        query = select(Follower).where(Follower.id > last_id)
+        if agent is not None:
+            query = query.where(Follower.bot == agent.name)
+        for name, value in filter.items():
+            query = query.where(getattr(Follower, name) == value)
+        for name, value in values.items():
+            index = aliased(FollowerIndexValue)
+            query = query.join(index, index.follower_id == Follower.id).where(
+                index.name == name,
+                index.value == value,
+                index.follower_id > last_id,
+            )
+        return query.order_by(Follower.id).limit(batch_size)
+
+    def iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None,
+                       after_id: int = 0) -> Iterator[Follower]:
+        filter = dbdrivers.check_filter(filter)
+        values = dbdrivers.check_values(self.indexed_values, values)
+        last_id = after_id
+        while True:
+            query = self.make_iter_query(agent, filter, values, last_id, batch_size)
+            followers = self.session.scalars(query).all()
+            for follower in followers:
+                follower.set_dbdriver(self)
+                yield follower
+            if len(followers) < batch_size:
+                break
+            last_id = followers[-1].id
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        filter = dbdrivers.check_filter(filter)
+        values = dbdrivers.check_values(self.indexed_values, values)
+        last_id = after_id
+        while True:
+            query = self.make_iter_query(agent, filter, values, last_id, batch_size)
+            followers = (await self.async_session.scalars(query)).all()
+            for follower in followers:
+                follower.set_dbdriver(self)
+                yield follower
+            if len(followers) < batch_size:
+                break
+            last_id = followers[-1].id
+
+    def delete(self, follower: Follower):
+        session = self.session()
+        session.execute(delete(FollowerValue).where(FollowerValue.follower_id == follower.id))
+        session.execute(self.make_remove_index_statement(follower))
+        session.delete(follower)
+        session.commit()
+
+    async def a_delete(self, follower: Follower):
+        session = self.async_session()
+        await session.execute(
+            delete(FollowerValue).where(FollowerValue.follower_id == follower.id),
+        )
+        await session.execute(self.make_remove_index_statement(follower))
+        await session.delete(follower)
+        await session.commit()
+
     def delete_follower(self, agent: Agent, chat: Chat):
+        follower = self.get_follower(agent, chat)
+        if follower is not None:
+            self.delete(follower)
 
-        follower = self.session.query(Follower).filter(and_(
-            Follower.bot == agent.name,
-            Follower.chat == chat.id,
-        ))
-        self.session.delete(follower)
-        self.session.commit()
+    async def a_delete_follower(self, agent: Agent, chat: Chat):
+        follower = await self.a_get_follower(agent, chat)
+        if follower is not None:
+            await self.a_delete(follower)
@@ -0,0 +1,972 @@
+from __future__ import annotations
+import asyncio
+from botovod import dbdrivers
+from botovod.agents import Agent, Chat, Message
+from botovod.exceptions import FollowerConflictException
+from botovod.utils import codec
+from concurrent.futures import Future
+from datetime import datetime
+import json
+import logging
+import os
+import queue
+import sqlite3
+from threading import Lock, Thread, local
+from urllib.request import pathname2url
+from typing import (Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple)
+
+from .history import (SQLITE_SEARCH, SQLITE_SEARCH_DROP, SQLITE_SEARCH_REBUILD, HistoryWriter,
+                      Record, get_partition, get_partitions, make_cursor, make_record,
+                      make_sqlite_search_query, parse_cursor, parse_record)
+
+
+logger = logging.getLogger(__name__)
+NOTHING = object()
+
+# Tables are the same as in the SQLAlchemy driver, so a database can be moved between them
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS botovod_followers (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        created_at DATETIME NOT NULL,
+        chat VARCHAR(64) NOT NULL,
+        bot VARCHAR(64) NOT NULL,
+        dialog VARCHAR(64),
+        next_step VARCHAR(64),
+        data TEXT NOT NULL DEFAULT '{}',
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS botovod_followers_bot_chat
+    ON botovod_followers (bot, chat)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS botovod_follower_values (
+        follower_id INTEGER NOT NULL REFERENCES botovod_followers (id) ON DELETE CASCADE,
+        name VARCHAR(64) NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (follower_id, name)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS botovod_follower_index (
+        name VARCHAR(64) NOT NULL,
+        value VARCHAR({dbdrivers.INDEX_VALUE_LENGTH}) NOT NULL,
+        follower_id INTEGER NOT NULL REFERENCES botovod_followers (id) ON DELETE CASCADE,
+        PRIMARY KEY (name, value, follower_id)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS botovod_follower_index_follower
+    ON botovod_follower_index (follower_id, name)
+    """,
+)
+
+# Statements are constant strings, so sqlite3 prepares each of them once per connection and
+# takes them from its statement cache afterwards
+SELECT_FOLLOWER = ("SELECT id, bot, chat, dialog, next_step, version FROM botovod_followers "
+                   "WHERE bot = ? AND chat = ?")
+INSERT_FOLLOWER = ("INSERT INTO botovod_followers (created_at, bot, chat) VALUES (?, ?, ?) "
+                   "ON CONFLICT (bot, chat) DO NOTHING")
+IMPORT_FOLLOWER = ("INSERT INTO botovod_followers (created_at, bot, chat, dialog, next_step) "
+                   "VALUES (?, ?, ?, ?, ?) ON CONFLICT (bot, chat) DO UPDATE SET "
+                   "dialog = excluded.dialog, next_step = excluded.next_step, data = '{}', "
+                   "version = version + 1")
+# Writes compare and set the version of the follower, a follower changed by another update since
+# it was read matches no row and nothing is written
+UPDATE_DIALOG = ("UPDATE botovod_followers SET dialog = ?, next_step = ?, version = version + 1 "
+                 "WHERE id = ? AND version = ?")
+UPDATE_NEXT_STEP = ("UPDATE botovod_followers SET next_step = ?, version = version + 1 "
+                    "WHERE id = ? AND version = ?")
+UPDATE_VERSION = ("UPDATE botovod_followers SET version = version + 1 "
+                  "WHERE id = ? AND version = ?")
+SELECT_COLUMNS = "PRAGMA table_info(botovod_followers)"
+ADD_VERSION = "ALTER TABLE botovod_followers ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+DELETE_FOLLOWER = "DELETE FROM botovod_followers WHERE id = ?"
+SELECT_FOLLOWERS = ("SELECT id, bot, chat, dialog, next_step, version FROM botovod_followers "
+                    "WHERE id > ?")
+SELECT_VALUES = "SELECT name, value FROM botovod_follower_values WHERE follower_id = ?"
+SELECT_BATCH_VALUES = ("SELECT follower_id, name, value FROM botovod_follower_values "
+                       "WHERE follower_id IN (SELECT value FROM json_each(?))")
+SELECT_VALUE = "SELECT value FROM botovod_follower_values WHERE follower_id = ? AND name = ?"
+UPSERT_VALUE = ("INSERT INTO botovod_follower_values (follower_id, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (follower_id, name) DO UPDATE SET value = excluded.value")
+DELETE_VALUE = "DELETE FROM botovod_follower_values WHERE follower_id = ? AND name = ?"
+DELETE_VALUES = "DELETE FROM botovod_follower_values WHERE follower_id = ?"
+INSERT_INDEX_VALUE = ("INSERT INTO botovod_follower_index (name, value, follower_id) "
+                      "VALUES (?, ?, ?)")
+DELETE_INDEX_VALUE = "DELETE FROM botovod_follower_index WHERE follower_id = ? AND name = ?"
+DELETE_INDEX_VALUES = "DELETE FROM botovod_follower_index WHERE follower_id = ?"
+CLEAR_INDEX = "DELETE FROM botovod_follower_index"
+REINDEX = ("INSERT INTO botovod_follower_index (name, value, follower_id) "
+           "SELECT name, value, follower_id FROM botovod_follower_values "
+           "WHERE name IN (SELECT value FROM json_each(?)) AND length(value) <= ?")
+HISTORY_PREFIX = "botovod_messages_"
+CREATE_HISTORY = (
+    """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        follower_id INTEGER NOT NULL,
+        input BOOLEAN NOT NULL,
+        text TEXT,
+        data TEXT NOT NULL,
+        created_at DATETIME NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS {table}_follower_created ON {table} (follower_id, created_at)",
+)
+SELECT_HISTORY_PARTITIONS = "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?"
+INSERT_HISTORY = ("INSERT INTO {table} (follower_id, input, text, data, created_at) "
+                  "VALUES (?, ?, ?, ?, ?)")
+SEARCH_HISTORY = ("SELECT m.id, m.follower_id, m.text, m.data, m.input, m.created_at "
+                  "FROM {table}_search JOIN {table} AS m ON m.id = {table}_search.rowid "
+                  "WHERE {table}_search MATCH ?")
+
+
+class Follower(dbdrivers.Follower):
+    def __init__(self, dbdriver: DBDriver, id: int, bot: str, chat: str,
+                 dialog: Optional[str] = None, next_step: Optional[str] = None,
+                 version: int = 0):
+        self.dbdriver = dbdriver
+        self.id = id
+        self.bot = bot
+        self.chat = chat
+        self.dialog = dialog
+        self.next_step = next_step
+        self.version = version
+
+        self._values = {}
+        self._values_complete = False
+
+    def get_chat(self) -> Chat:
+        return Chat(self.bot, self.chat)
+
+    async def a_get_chat(self) -> Chat:
+        return self.get_chat()
+
+    def get_dialog(self) -> Optional[str]:
+        return self.dialog
+
+    async def a_get_dialog(self) -> Optional[str]:
+        return self.dialog
+
+    def set_dialog(self, name: Optional[str] = None):
+        next_step = None if name is None else "start"
+        self.dbdriver.call(lambda connection: self.dbdriver.update_follower(
+            connection, self, UPDATE_DIALOG, (name, next_step),
+        ))
+        self.dialog = name
+        self.next_step = next_step
+
+    async def a_set_dialog(self, name: Optional[str] = None):
+        next_step = None if name is None else "start"
+        await self.dbdriver.a_call(lambda connection: self.dbdriver.update_follower(
+            connection, self, UPDATE_DIALOG, (name, next_step),
+        ))
+        self.dialog = name
+        self.next_step = next_step
+
+    def get_next_step(self) -> Optional[str]:
+        return self.next_step
+
+    async def a_get_next_step(self) -> Optional[str]:
+        return self.next_step
+
+    def set_next_step(self, next_step: Optional[str] = None):
+        self.dbdriver.call(lambda connection: self.dbdriver.update_follower(
+            connection, self, UPDATE_NEXT_STEP, (next_step,),
+        ))
+        self.next_step = next_step
+
+    async def a_set_next_step(self, next_step: Optional[str] = None):
+        await self.dbdriver.a_call(lambda connection: self.dbdriver.update_follower(
+            connection, self, UPDATE_NEXT_STEP, (next_step,),
+        ))
+        self.next_step = next_step
+
+    def get_values(self) -> Dict[str, str]:
+        if not self._values_complete:
+            rows = self.dbdriver.fetch_all(SELECT_VALUES, (self.id,))
+            self._values = {name: codec.loads(value) for name, value in rows}
+            self._values_complete = True
+        return self._values.copy()
+
+    async def a_get_values(self) -> Dict[str, str]:
+        if not self._values_complete:
+            rows = await self.dbdriver.a_fetch_all(SELECT_VALUES, (self.id,))
+            self._values = {name: codec.loads(value) for name, value in rows}
+            self._values_complete = True
+        return self._values.copy()
+
+    def get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        if name not in self._values and not self._values_complete:
+            row = self.dbdriver.fetch_one(SELECT_VALUE, (self.id, name))
+            self._values[name] = NOTHING if row is None else codec.loads(row[0])
+        value = self._values.get(name, NOTHING)
+        return default if value is NOTHING else value
+
+    async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        if name not in self._values and not self._values_complete:
+            row = await self.dbdriver.a_fetch_one(SELECT_VALUE, (self.id, name))
+            self._values[name] = NOTHING if row is None else codec.loads(row[0])
+        value = self._values.get(name, NOTHING)
+        return default if value is NOTHING else value
+
+    def set_value(self, name: str, value: str):
+        self.dbdriver.call(
+            lambda connection: self.dbdriver.save_value(connection, self, name, value),
+        )
+        self._values[name] = value
+
+    async def a_set_value(self, name: str, value: str):
+        await self.dbdriver.a_call(
+            lambda connection: self.dbdriver.save_value(connection, self, name, value),
+        )
+        self._values[name] = value
+
+    def delete_value(self, name: str):
+        self.dbdriver.call(
+            lambda connection: self.dbdriver.remove_values(connection, self, name),
+        )
+        self._values.pop(name, None)
+
+    async def a_delete_value(self, name: str):
+        await self.dbdriver.a_call(
+            lambda connection: self.dbdriver.remove_values(connection, self, name),
+        )
+        self._values.pop(name, None)
+
+    def clear_values(self):
+        self.dbdriver.call(
+            lambda connection: self.dbdriver.remove_values(connection, self),
+        )
+        self._values = {}
+        self._values_complete = True
+
+    async def a_clear_values(self):
+        await self.dbdriver.a_call(
+            lambda connection: self.dbdriver.remove_values(connection, self),
+        )
+        self._values = {}
+        self._values_complete = True
+
+    def add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    async def a_add_history(self, message: Message, input: bool = True):
+        self.dbdriver.add_history(self, message, input)
+
+    def get_history(self, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        return self.dbdriver.get_history(self, after_date=after_date, before_date=before_date,
+                                         input=input, limit=limit)
+
+    async def a_get_history(self, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        return await self.dbdriver.a_get_history(self, after_date=after_date,
+                                                 before_date=before_date, input=input,
+                                                 limit=limit)
+
+    def clear_history(self, after_date: Optional[datetime] = None,
+                      before_date: Optional[datetime] = None):
+        self.dbdriver.remove_history(follower=self, after_date=after_date,
+                                     before_date=before_date)
+
+    async def a_clear_history(self, after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None):
+        await self.dbdriver.a_remove_history(follower=self, after_date=after_date,
+                                             before_date=before_date)
+
+    def search_history(self, query: str, after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return self.dbdriver.search_history(query, follower=self, after_date=after_date,
+                                            before_date=before_date, limit=limit, cursor=cursor)
+
+    async def a_search_history(self, query: str, after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return await self.dbdriver.a_search_history(query, follower=self, after_date=after_date,
+                                                    before_date=before_date, limit=limit,
+                                                    cursor=cursor)
+
+
+# Worker owns the only writing connection to the database and runs every write of the driver.
+# Writes are committed in groups: the transaction stays open while more writes wait in the queue
+# (up to batch_size of them) and is committed once the queue is drained. Every function runs in
+# its own savepoint, so one which fails is rolled back alone and the rest of the group is still
+# committed. Futures are resolved after the commit, so a finished write is always a committed one
+class Worker(Thread):
+    def __init__(self, database: str, batch_size: int = 256, timeout: float = 5.0,
+                 cached_statements: int = 128):
+        super().__init__(name="botovod-sqlite", daemon=True)
+        self.database = database
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.queue = queue.Queue()
+        self.ready = Future()
+
+    def submit(self, function: Callable[[sqlite3.Connection], Any]) -> Future:
+        future = Future()
+        self.queue.put((function, future))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def connect(self) -> sqlite3.Connection:
+        # Transactions are opened and committed by run, not by the sqlite3 module
+        connection = sqlite3.connect(self.database, uri=True, timeout=self.timeout,
+                                     cached_statements=self.cached_statements,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        for statement in SCHEMA:
+            connection.execute(statement)
+        # Tables created by older versions have no version column
+        if "version" not in {row[1] for row in connection.execute(SELECT_COLUMNS)}:
+            connection.execute(ADD_VERSION)
+        return connection
+
+    @staticmethod
+    def apply(connection: sqlite3.Connection,
+              function: Callable[[sqlite3.Connection], Any]) -> Tuple[Any, Optional[Exception]]:
+        connection.execute("SAVEPOINT task")
+        try:
+            result = function(connection)
+        except Exception as exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK TO task")
+                connection.execute("RELEASE task")
+            return None, exception
+        connection.execute("RELEASE task")
+        return result, None
+
+    def run(self):
+        try:
+            connection = self.connect()
+        except Exception as exception:
+            self.ready.set_exception(exception)
+            return
+        self.ready.set_result(None)
+
+        try:
+            running = True
+            while running:
+                done = []
+                task = self.queue.get()
+                if task is None:
+                    break
+                connection.execute("BEGIN")
+                while task is not None:
+                    function, future = task
+                    if future.set_running_or_notify_cancel():
+                        done.append((future, *self.apply(connection, function)))
+                    # Some errors (a full disk, for example) roll back the whole transaction,
+                    # the commit below fails then and fails the whole group
+                    if len(done) >= self.batch_size or not connection.in_transaction:
+                        break
+                    try:
+                        task = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                running = task is not None
+
+                try:
+                    connection.execute("COMMIT")
+                except Exception as exception:
+                    logger.exception("Cannot commit %s queries", len(done))
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+                    done = [(future, None, exception) for future, _, _ in done]
+                for future, result, exception in done:
+                    if exception is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(exception)
+        finally:
+            connection.close()
+
+
+# The worker and the readers open the database with uri=True, so a "file:" name means the same
+# file for both, readers add mode=ro to it. An in-memory database opened again is another
+# database, so it has no read uri and is read by the worker
+def make_read_uri(database: str) -> Optional[str]:
+    if database in ("", ":memory:"):
+        return None
+    if not database.startswith("file:"):
+        return f"file:{pathname2url(os.path.abspath(database))}?mode=ro"
+    path, _, query = database.partition("?")
+    parameters = [parameter for parameter in query.split("&") if parameter]
+    if path == "file::memory:" or "mode=memory" in parameters:
+        return None
+    parameters = [parameter for parameter in parameters if not parameter.startswith("mode=")]
+    return path + "?" + "&".join(parameters + ["mode=ro"])
+
+
+# Reads don't wait in the queue of the worker: every thread reads by its own read-only
+# connection, which WAL lets run while the worker writes. A write is finished only after its
+# commit, so the thread which made it reads it back
+class Readers:
+    def __init__(self, uri: str, timeout: float = 5.0, cached_statements: int = 128):
+        self.uri = uri
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.local = local()
+        self.lock = Lock()
+        self.connections = []
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.uri, uri=True, timeout=self.timeout,
+                                         cached_statements=self.cached_statements,
+                                         check_same_thread=False)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+
+class DBDriver(dbdrivers.DBDriver):
+    keeps_history = True
+
+    def __init__(self):
+        self.worker = None
+        self.readers = None
+        self.history_batch_size = 500
+        self.history_interval = 1.0
+        self.history_lock = Lock()
+        self.history_partitions = None
+        self.history_writer = None
+        self.indexed_values = frozenset()
+
+    def connect(self, database: str, batch_size: int = 256, timeout: float = 5.0,
+                cached_statements: int = 128, history_batch_size: int = 500,
+                history_interval: float = 1.0, indexed_values: Iterable[str] = ()):
+        self.close()
+        self.indexed_values = frozenset(indexed_values)
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.history_partitions = None
+        self.worker = Worker(database=database, batch_size=batch_size, timeout=timeout,
+                             cached_statements=cached_statements)
+        self.worker.start()
+        self.worker.ready.result()
+        self.readers = self.make_readers(database, timeout, cached_statements)
+
+    async def a_connect(self, database: str, batch_size: int = 256, timeout: float = 5.0,
+                        cached_statements: int = 128, history_batch_size: int = 500,
+                        history_interval: float = 1.0, indexed_values: Iterable[str] = ()):
+        await self.a_close()
+        self.indexed_values = frozenset(indexed_values)
+        self.history_batch_size = history_batch_size
+        self.history_interval = history_interval
+        self.history_partitions = None
+        self.worker = Worker(database=database, batch_size=batch_size, timeout=timeout,
+                             cached_statements=cached_statements)
+        self.worker.start()
+        await asyncio.wrap_future(self.worker.ready)
+        self.readers = self.make_readers(database, timeout, cached_statements)
+
+    @staticmethod
+    def make_readers(database: str, timeout: float, cached_statements: int) -> Optional[Readers]:
+        uri = make_read_uri(database)
+        if uri is None:
+            return None
+        return Readers(uri, timeout=timeout, cached_statements=cached_statements)
+
+    def close(self):
+        if self.history_writer is not None:
+            self.history_writer.stop()
+            self.history_writer = None
+        if self.readers is not None:
+            self.readers.close()
+            self.readers = None
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    async def a_close(self):
+        if self.history_writer is not None or self.worker is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def call(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        return self.worker.submit(function).result()
+
+    async def a_call(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        return await asyncio.wrap_future(self.worker.submit(function))
+
+    def read(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        if self.readers is None:
+            return self.call(function)
+        return function(self.readers.get())
+
+    async def a_read(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        if self.readers is None:
+            return await self.a_call(function)
+        readers = self.readers
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: function(readers.get()),
+        )
+
+    def execute(self, query: str, parameters: Tuple = ()) -> int:
+        return self.call(lambda connection: connection.execute(query, parameters).rowcount)
+
+    async def a_execute(self, query: str, parameters: Tuple = ()) -> int:
+        return await self.a_call(
+            lambda connection: connection.execute(query, parameters).rowcount,
+        )
+
+    def fetch_one(self, query: str, parameters: Tuple = ()) -> Optional[tuple]:
+        return self.read(lambda connection: connection.execute(query, parameters).fetchone())
+
+    async def a_fetch_one(self, query: str, parameters: Tuple = ()) -> Optional[tuple]:
+        return await self.a_read(
+            lambda connection: connection.execute(query, parameters).fetchone(),
+        )
+
+    def fetch_all(self, query: str, parameters: Tuple = ()) -> list:
+        return self.read(lambda connection: connection.execute(query, parameters).fetchall())
+
+    async def a_fetch_all(self, query: str, parameters: Tuple = ()) -> list:
+        return await self.a_read(
+            lambda connection: connection.execute(query, parameters).fetchall(),
+        )
+
+    def prefetch_values(self, followers: List[Follower]):
+        followers = [follower for follower in followers if not follower._values_complete]
+        if followers:
+            ids = json.dumps([follower.id for follower in followers])
+            self.set_values(followers, self.fetch_all(SELECT_BATCH_VALUES, (ids,)))
+
+    async def a_prefetch_values(self, followers: List[Follower]):
+        followers = [follower for follower in followers if not follower._values_complete]
+        if followers:
+            ids = json.dumps([follower.id for follower in followers])
+            self.set_values(followers, await self.a_fetch_all(SELECT_BATCH_VALUES, (ids,)))
+
+    @staticmethod
+    def set_values(followers: List[Follower], rows: Iterable[tuple]):
+        values = {follower.id: {} for follower in followers}
+        for follower_id, name, value in rows:
+            values[follower_id][name] = codec.loads(value)
+        for follower in followers:
+            follower._values = values[follower.id]
+            follower._values_complete = True
+
+    # Functions below run in the worker thread, so a value and its index are committed together.
+    # The version is checked first, a conflict raises before anything is written
+    @staticmethod
+    def update_follower(connection: sqlite3.Connection, follower: Follower, query: str,
+                        parameters: Tuple = ()):
+        if connection.execute(query, (*parameters, follower.id, follower.version)).rowcount != 1:
+            raise FollowerConflictException()
+        follower.version += 1
+
+    def save_value(self, connection: sqlite3.Connection, follower: Follower, name: str,
+                   value: Any):
+        self.update_follower(connection, follower, UPDATE_VERSION)
+        connection.execute(UPSERT_VALUE, (follower.id, name, json.dumps(value)))
+        if name in self.indexed_values:
+            connection.execute(DELETE_INDEX_VALUE, (follower.id, name))
+            index_value = dbdrivers.make_index_value(value)
+            if index_value is not None:
+                connection.execute(INSERT_INDEX_VALUE, (name, index_value, follower.id))
+
+    def remove_values(self, connection: sqlite3.Connection, follower: Follower, *names: str):
+        self.update_follower(connection, follower, UPDATE_VERSION)
+        if not names:
+            connection.execute(DELETE_VALUES, (follower.id,))
+            connection.execute(DELETE_INDEX_VALUES, (follower.id,))
+        for name in names:
+            connection.execute(DELETE_VALUE, (follower.id, name))
+            if name in self.indexed_values:
+                connection.execute(DELETE_INDEX_VALUE, (follower.id, name))
+
+    def rebuild_index(self, connection: sqlite3.Connection):
+        # Index is built again from values, so keys can be declared for existing followers
+        connection.execute(CLEAR_INDEX)
+        connection.execute(REINDEX, (json.dumps(sorted(self.indexed_values)),
+                                     dbdrivers.INDEX_VALUE_LENGTH))
+
+    def reindex_values(self):
+        self.call(self.rebuild_index)
+
+    async def a_reindex_values(self):
+        await self.a_call(self.rebuild_index)
+
+    def make_follower(self, row: Optional[tuple]) -> Optional[Follower]:
+        if row is None:
+            return None
+        id, bot, chat, dialog, next_step, version = row
+        return Follower(dbdriver=self, id=id, bot=bot, chat=chat, dialog=dialog,
+                        next_step=next_step, version=version)
+
+    @staticmethod
+    def select_or_insert_follower(connection: sqlite3.Connection, bot: str,
+                                  chat: str) -> tuple:
+        # The worker runs one query at a time, so nothing can get between select and insert
+        row = connection.execute(SELECT_FOLLOWER, (bot, chat)).fetchone()
+        if row is None:
+            connection.execute(INSERT_FOLLOWER, (datetime.now().isoformat(" "), bot, chat))
+            row = connection.execute(SELECT_FOLLOWER, (bot, chat)).fetchone()
+        return row
+
+    def insert_followers(self, connection: sqlite3.Connection, agent: Agent,
+                         rows: List[dbdrivers.ImportRow]):
+        # Followers which exist are overwritten and get the next version, their old values are
+        # removed. Every statement runs once for all rows of the batch
+        followers = {chat.id: (dialog, next_step, values)
+                     for chat, dialog, next_step, values in rows}
+        now = datetime.now().isoformat(" ")
+        connection.executemany(IMPORT_FOLLOWER, [
+            (now, agent.name, chat, dialog, next_step)
+            for chat, (dialog, next_step, _) in followers.items()
+        ])
+        ids = {chat: connection.execute(SELECT_FOLLOWER, (agent.name, chat)).fetchone()[0]
+               for chat in followers}
+        connection.executemany(DELETE_VALUES, [(id,) for id in ids.values()])
+        connection.executemany(DELETE_INDEX_VALUES, [(id,) for id in ids.values()])
+        value_rows = []
+        index_rows = []
+        for chat, (_, _, values) in followers.items():
+            for name, value in values.items():
+                value_rows.append((ids[chat], name, json.dumps(value)))
+                index_value = (dbdrivers.make_index_value(value)
+                               if name in self.indexed_values else None)
+                if index_value is not None:
+                    index_rows.append((name, index_value, ids[chat]))
+        connection.executemany(UPSERT_VALUE, value_rows)
+        connection.executemany(INSERT_INDEX_VALUE, index_rows)
+
+    def import_followers(self, agent: Agent, rows: Iterable[dbdrivers.ImportRow]):
+        rows = list(rows)
+        self.call(lambda connection: self.insert_followers(connection, agent, rows))
+
+    async def a_import_followers(self, agent: Agent, rows: Iterable[dbdrivers.ImportRow]):
+        rows = list(rows)
+        await self.a_call(lambda connection: self.insert_followers(connection, agent, rows))
+
+    def get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        return self.make_follower(self.fetch_one(SELECT_FOLLOWER, (agent.name, chat.id)))
+
+    async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        return self.make_follower(await self.a_fetch_one(SELECT_FOLLOWER, (agent.name, chat.id)))
+
+    def add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return self.get_or_create_follower(agent, chat)
+
+    async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return await self.a_get_or_create_follower(agent, chat)
+
+    # Known followers are read without waiting behind writes, only a missing one goes to the
+    # worker, which selects it again before inserting, so two first messages make one follower
+    def get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = self.get_follower(agent, chat)
+        if follower is None:
+            follower = self.make_follower(self.call(
+                lambda connection: self.select_or_insert_follower(connection, agent.name,
+                                                                  chat.id),
+            ))
+        return follower
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower = await self.a_get_follower(agent, chat)
+        if follower is None:
+            follower = self.make_follower(await self.a_call(
+                lambda connection: self.select_or_insert_follower(connection, agent.name,
+                                                                  chat.id),
+            ))
+        return follower
+
+    # Followers are read in batches ordered by id, each batch starts after the last id of the
+    # previous one, so a batch costs the same at any depth and only one batch is in memory
+    @staticmethod
+    def make_iter_query(agent: Optional[Agent], filter: Dict[str, Optional[str]],
+                        values: Dict[str, str], last_id: int, batch_size: int) -> Tuple[str, tuple]:
+        query = SELECT_FOLLOWERS
+        parameters = [last_id]
+        for name, value in values.items():
+            query += (" AND id IN (SELECT follower_id FROM botovod_follower_index "
+                      "WHERE name = ? AND value = ? AND follower_id > ?)")
+            parameters.extend((name, value, last_id))
+        if agent is not None:
+            query += " AND bot = ?"
+            parameters.append(agent.name)
+        for name, value in filter.items():
+            query += f" AND {name} IS ?"
+            parameters.append(value)
+        query += " ORDER BY id LIMIT ?"
+        parameters.append(batch_size)
+        return query, tuple(parameters)
+
+    def iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                       filter: Optional[Dict[str, Optional[str]]] = None,
+                       values: Optional[Dict[str, Any]] = None,
+                       after_id: int = 0) -> Iterator[Follower]:
+        filter = dbdrivers.check_filter(filter)
+        values = dbdrivers.check_values(self.indexed_values, values)
+        last_id = after_id
+        while True:
+            rows = self.fetch_all(*self.make_iter_query(agent, filter, values, last_id,
+                                                        batch_size))
+            for row in rows:
+                yield self.make_follower(row)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        filter = dbdrivers.check_filter(filter)
+        values = dbdrivers.check_values(self.indexed_values, values)
+        last_id = after_id
+        while True:
+            rows = await self.a_fetch_all(*self.make_iter_query(agent, filter, values, last_id,
+                                                                batch_size))
+            for row in rows:
+                yield self.make_follower(row)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+
+    def delete(self, follower: Follower):
+        self.execute(DELETE_FOLLOWER, (follower.id,))
+
+    async def a_delete(self, follower: Follower):
+        await self.a_execute(DELETE_FOLLOWER, (follower.id,))
+
+    # Functions below run in the worker thread, so partitions can't be created twice
+    def get_history_partitions(self, connection: sqlite3.Connection) -> Set[str]:
+        if self.history_partitions is None:
+            rows = connection.execute(SELECT_HISTORY_PARTITIONS, (HISTORY_PREFIX + "%",))
+            names = {name for name, in rows}
+            partitions = {name[len(HISTORY_PREFIX):] for name in names
+                          if name[len(HISTORY_PREFIX):].isdigit()}
+            # Partitions made before search was added get their index built once
+            for partition in partitions:
+                table = HISTORY_PREFIX + partition
+                if table + "_search" not in names:
+                    for statement in SQLITE_SEARCH:
+                        connection.execute(statement.format(table=table))
+                    connection.execute(SQLITE_SEARCH_REBUILD.format(table=table))
+            self.history_partitions = partitions
+        return self.history_partitions
+
+    def insert_history(self, connection: sqlite3.Connection, records: List[Record]):
+        partitions = {}
+        for follower_id, input, text, data, created_at in records:
+            partitions.setdefault(get_partition(created_at), []).append(
+                (follower_id, input, text, data, created_at.isoformat(" ")),
+            )
+        for partition, rows in partitions.items():
+            table = HISTORY_PREFIX + partition
+            existing = self.get_history_partitions(connection)
+            if partition not in existing:
+                for statement in CREATE_HISTORY + SQLITE_SEARCH:
+                    connection.execute(statement.format(table=table))
+                self.history_partitions = existing | {partition}
+            connection.executemany(INSERT_HISTORY.format(table=table), rows)
+
+    def select_history(self, connection: sqlite3.Connection, follower_id: int,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                       limit: Optional[int] = None) -> List[Message]:
+        messages = []
+        partitions = get_partitions(self.get_history_partitions(connection), after_date,
+                                    before_date)
+        for partition in reversed(partitions):
+            query = (f"SELECT text, data, input, created_at FROM {HISTORY_PREFIX + partition} "
+                     "WHERE follower_id = ?")
+            parameters = [follower_id]
+            if after_date is not None:
+                query += " AND created_at > ?"
+                parameters.append(after_date.isoformat(" "))
+            if before_date is not None:
+                query += " AND created_at < ?"
+                parameters.append(before_date.isoformat(" "))
+            if input is not None:
+                query += " AND input = ?"
+                parameters.append(input)
+            query += " ORDER BY created_at DESC, id DESC"
+            if limit is not None:
+                query += " LIMIT ?"
+                parameters.append(limit - len(messages))
+            messages.extend(
+                parse_record(text, data, bool(input), datetime.fromisoformat(created_at))
+                for text, data, input, created_at in connection.execute(query, parameters)
+            )
+            if limit is not None and len(messages) >= limit:
+                break
+        messages.reverse()
+        return messages
+
+    def delete_history(self, connection: sqlite3.Connection, follower_id: Optional[int] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None):
+        existing = self.get_history_partitions(connection)
+        for partition in get_partitions(existing, after_date, before_date):
+            table = HISTORY_PREFIX + partition
+            if (follower_id is None and after_date is None and before_date is not None and
+                    partition < get_partition(before_date)):
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+                connection.execute(SQLITE_SEARCH_DROP.format(table=table))
+                self.history_partitions = self.history_partitions - {partition}
+                continue
+            query = f"DELETE FROM {table} WHERE 1 = 1"
+            parameters = []
+            if follower_id is not None:
+                query += " AND follower_id = ?"
+                parameters.append(follower_id)
+            if after_date is not None:
+                query += " AND created_at > ?"
+                parameters.append(after_date.isoformat(" "))
+            if before_date is not None:
+                query += " AND created_at < ?"
+                parameters.append(before_date.isoformat(" "))
+            connection.execute(query, parameters)
+
+    def select_search_history(self, connection: sqlite3.Connection, query: str,
+                              follower_id: Optional[int] = None,
+                              after_date: Optional[datetime] = None,
+                              before_date: Optional[datetime] = None, limit: int = 20,
+                              cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        messages = []
+        last = None
+        query = make_sqlite_search_query(query)
+        if not query:
+            return messages, None
+        cursor_partition, cursor_id = parse_cursor(cursor)
+        partitions = get_partitions(self.get_history_partitions(connection), after_date,
+                                    before_date)
+        for partition in reversed(partitions):
+            if cursor_partition is not None and partition > cursor_partition:
+                continue
+            table = HISTORY_PREFIX + partition
+            statement = SEARCH_HISTORY.format(table=table)
+            parameters = [query]
+            if follower_id is not None:
+                statement += " AND m.follower_id = ?"
+                parameters.append(follower_id)
+            if after_date is not None:
+                statement += " AND m.created_at > ?"
+                parameters.append(after_date.isoformat(" "))
+            if before_date is not None:
+                statement += " AND m.created_at < ?"
+                parameters.append(before_date.isoformat(" "))
+            if partition == cursor_partition:
+                statement += f" AND {table}_search.rowid < ?"
+                parameters.append(cursor_id)
+            statement += f" ORDER BY {table}_search.rowid DESC LIMIT ?"
+            parameters.append(limit - len(messages))
+            for id, message_follower_id, text, data, input, created_at in connection.execute(
+                statement, parameters,
+            ):
+                messages.append(parse_record(text, data, bool(input),
+                                             datetime.fromisoformat(created_at),
+                                             follower_id=message_follower_id))
+                last = make_cursor(partition, id)
+            if len(messages) >= limit:
+                return messages, last
+        return messages, None
+
+    def write_history(self, records: List[Record]):
+        self.call(lambda connection: self.insert_history(connection, records))
+
+    def add_history(self, follower: Follower, message: Message, input: bool = True):
+        # Adding only puts the record into the buffer, so the async path uses it too
+        if self.history_writer is None:
+            with self.history_lock:
+                if self.history_writer is None:
+                    writer = HistoryWriter(write=self.write_history,
+                                           batch_size=self.history_batch_size,
+                                           interval=self.history_interval)
+                    writer.start()
+                    self.history_writer = writer
+        self.history_writer.add(make_record(follower.id, message, input))
+
+    def prepare_history_read(self):
+        # Partitions are found (and old ones indexed) by the worker, read connections can't write
+        if self.history_writer is not None:
+            self.history_writer.flush()
+        if self.history_partitions is None:
+            self.call(self.get_history_partitions)
+
+    def get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                    before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                    limit: Optional[int] = None) -> List[Message]:
+        self.prepare_history_read()
+        return self.read(lambda connection: self.select_history(
+            connection, follower.id, after_date=after_date, before_date=before_date,
+            input=input, limit=limit,
+        ))
+
+    async def a_get_history(self, follower: Follower, after_date: Optional[datetime] = None,
+                            before_date: Optional[datetime] = None, input: Optional[bool] = None,
+                            limit: Optional[int] = None) -> List[Message]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: self.get_history(follower, after_date=after_date, before_date=before_date,
+                                     input=input, limit=limit),
+        )
+
+    def remove_history(self, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None):
+        if self.history_writer is not None:
+            self.history_writer.flush()
+        self.call(lambda connection: self.delete_history(
+            connection, follower_id=None if follower is None else follower.id,
+            after_date=after_date, before_date=before_date,
+        ))
+
+    async def a_remove_history(self, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None):
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: self.remove_history(follower=follower, after_date=after_date,
+                                        before_date=before_date),
+        )
+
+    def clear_history(self, before_date: datetime):
+        self.remove_history(before_date=before_date)
+
+    async def a_clear_history(self, before_date: datetime):
+        await self.a_remove_history(before_date=before_date)
+
+    def search_history(self, query: str, follower: Optional[Follower] = None,
+                       after_date: Optional[datetime] = None,
+                       before_date: Optional[datetime] = None, limit: int = 20,
+                       cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        self.prepare_history_read()
+        return self.read(lambda connection: self.select_search_history(
+            connection, query, follower_id=None if follower is None else follower.id,
+            after_date=after_date, before_date=before_date, limit=limit, cursor=cursor,
+        ))
+
+    async def a_search_history(self, query: str, follower: Optional[Follower] = None,
+                               after_date: Optional[datetime] = None,
+                               before_date: Optional[datetime] = None, limit: int = 20,
+                               cursor: Optional[str] = None) -> Tuple[List[Message], Optional[str]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: self.search_history(query, follower=follower, after_date=after_date,
+                                        before_date=before_date, limit=limit, cursor=cursor),
+        )
@@ -1,9 +1,250 @@
+from __future__ import annotations
 from botovod import dbdrivers
+from botovod.agents import Agent, Chat
+from botovod.exceptions import FollowerConflictException
+import logging
+from tortoise import Tortoise, fields
+from tortoise.expressions import F, Subquery
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Union
 
 
-class Follower(dbdrivers.Follower):
-    pass
+logger = logging.getLogger(__name__)
+
+
+class Follower(dbdrivers.Follower, Model):
+    id = fields.IntField(pk=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    chat = fields.CharField(max_length=64)
+    bot = fields.CharField(max_length=64)
+    dialog = fields.CharField(max_length=64, null=True)
+    next_step = fields.CharField(max_length=64, null=True)
+    data = fields.JSONField(default=dict)
+    version = fields.IntField(default=0)
+
+    class Meta:
+        table = "botovod_followers"
+        unique_together = (("bot", "chat"),)
+
+    # Setters only change the object, changed columns are written by a_flush (called by the
+    # driver when the update is handled) in one UPDATE. The UPDATE compares and sets the version,
+    # a follower changed by another update since it was read is not overwritten
+    def mark_changed(self, *names: str):
+        if "_changed" not in self.__dict__:
+            self._changed = set()
+        self._changed.update(names)
+
+    def mark_value_changed(self, *names: str):
+        self.mark_changed("data")
+        if "_changed_values" not in self.__dict__:
+            self._changed_values = set()
+        self._changed_values.update(names)
+
+    async def a_flush(self, indexed_values: Iterable[str] = ()):
+        changed = self.__dict__.get("_changed")
+        if not changed:
+            return
+        self._changed = set()
+        names = [name for name in self.__dict__.get("_changed_values", ())
+                 if name in indexed_values]
+        self._changed_values = set()
+        if not names:
+            await self.a_update(changed)
+            return
+        async with in_transaction():
+            await self.a_update(changed)
+            await FollowerIndexValue.filter(follower_id=self.id, name__in=names).delete()
+            await FollowerIndexValue.bulk_create(make_index_values(self, names))
+
+    def discard_changes(self):
+        self._changed = set()
+        self._changed_values = set()
+
+    async def a_update(self, names: Iterable[str]):
+        updated = await Follower.filter(id=self.id, version=self.version).update(
+            version=F("version") + 1,
+            **{name: getattr(self, name) for name in names},
+        )
+        if not updated:
+            raise FollowerConflictException()
+        self.version += 1
+
+    async def a_get_chat(self) -> Chat:
+        return Chat(self.bot, self.chat)
+
+    async def a_get_dialog(self) -> Optional[str]:
+        return self.dialog
+
+    async def a_set_dialog(self, name: Optional[str] = None):
+        self.dialog = name
+        self.next_step = None if name is None else "start"
+        self.mark_changed("dialog", "next_step")
+
+    async def a_get_next_step(self) -> Optional[str]:
+        return self.next_step
+
+    async def a_set_next_step(self, next_step: Optional[str] = None):
+        self.next_step = next_step
+        self.mark_changed("next_step")
+
+    async def a_get_values(self) -> Dict[str, str]:
+        return self.data.copy()
+
+    async def a_get_value(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.data.get(name, default)
+
+    async def a_set_value(self, name: str, value: str):
+        self.data[name] = value
+        self.mark_value_changed(name)
+
+    async def a_delete_value(self, name: str):
+        if name in self.data:
+            del self.data[name]
+            self.mark_value_changed(name)
+
+    async def a_clear_values(self):
+        self.mark_value_changed(*self.data)
+        self.data = {}
+
+
+# Values of keys declared as indexed are copied here, the unique (name, value, follower) index
+# serves lookups by value
+class FollowerIndexValue(Model):
+    id = fields.IntField(pk=True)
+    follower = fields.ForeignKeyField("botovod.Follower", related_name="index_values",
+                                      on_delete=fields.CASCADE)
+    name = fields.CharField(max_length=64)
+    value = fields.CharField(max_length=dbdrivers.INDEX_VALUE_LENGTH)
+
+    class Meta:
+        table = "botovod_follower_index"
+        unique_together = (("name", "value", "follower"),)
+        indexes = (("follower", "name"),)
+
+
+def make_index_values(follower: Follower, names: Iterable[str]) -> List[FollowerIndexValue]:
+    index_values = []
+    for name in names:
+        if name in follower.data:
+            value = dbdrivers.make_index_value(follower.data[name])
+            if value is not None:
+                index_values.append(FollowerIndexValue(follower_id=follower.id, name=name,
+                                                       value=value))
+    return index_values
 
 
 class DBDriver(dbdrivers.DBDriver):
-    pass
+    def __init__(self):
+        self.indexed_values = frozenset()
+
+    async def a_connect(self, engine: str, database: str, host: Optional[Union[str, int]] = None,
+                        username: Optional[str] = None, password: Optional[str] = None,
+                        minsize: Optional[int] = None, maxsize: Optional[int] = None,
+                        modules: Optional[Dict[str, List[str]]] = None,
+                        indexed_values: Iterable[str] = ()):
+        # Tortoise is initialized once for the whole application, so models of the application
+        # can be passed in modules to be registered with botovod ones
+        await self.a_close()
+        self.indexed_values = frozenset(indexed_values)
+        dsn = f"{engine}://"
+        if username is not None and password is not None:
+            dsn += f"{username}:{password}@"
+        if host is not None:
+            dsn += f"{host}/"
+        dsn += database
+        pool_settings = []
+        if minsize is not None:
+            pool_settings.append(f"minsize={minsize}")
+        if maxsize is not None:
+            pool_settings.append(f"maxsize={maxsize}")
+        if pool_settings:
+            dsn += "?" + "&".join(pool_settings)
+
+        modules = {} if modules is None else modules.copy()
+        modules["botovod"] = [__name__]
+        await Tortoise.init(db_url=dsn, modules=modules)
+
+    async def a_close(self):
+        await Tortoise.close_connections()
+
+    async def a_finish(self, follower: Optional[Follower] = None):
+        if follower is not None:
+            await follower.a_flush(self.indexed_values)
+
+    async def a_discard(self, follower: Optional[Follower] = None):
+        if follower is not None:
+            follower.discard_changes()
+
+    async def a_get_follower(self, agent: Agent, chat: Chat) -> Optional[Follower]:
+        return await Follower.get_or_none(bot=agent.name, chat=chat.id)
+
+    async def a_add_follower(self, agent: Agent, chat: Chat) -> Follower:
+        return await Follower.create(bot=agent.name, chat=chat.id)
+
+    async def a_get_or_create_follower(self, agent: Agent, chat: Chat) -> Follower:
+        follower, _ = await Follower.get_or_create(bot=agent.name, chat=chat.id)
+        return follower
+
+    async def a_get_followers(self, agent: Agent,
+                              chats: Iterable[Chat]) -> List[Optional[Follower]]:
+        chats = list(chats)
+        followers = await Follower.filter(bot=agent.name, chat__in=[chat.id for chat in chats])
+        followers = {follower.chat: follower for follower in followers}
+        return [followers.get(chat.id) for chat in chats]
+
+    async def a_add_followers(self, agent: Agent, chats: Iterable[Chat]) -> List[Follower]:
+        chats = list(chats)
+        await Follower.bulk_create(
+            [Follower(bot=agent.name, chat=chat.id) for chat in chats],
+            ignore_conflicts=True,
+        )
+        # bulk_create doesn't give ids back on every backend, so followers are selected again
+        return await self.a_get_followers(agent, chats)
+
+    async def a_get_or_create_followers(self, agent: Agent,
+                                        chats: Iterable[Chat]) -> List[Follower]:
+        chats = list(chats)
+        followers = await self.a_get_followers(agent, chats)
+        missing = [chat for chat, follower in zip(chats, followers) if follower is None]
+        if not missing:
+            return followers
+        created = iter(await self.a_add_followers(agent, missing))
+        return [next(created) if follower is None else follower for follower in followers]
+
+    async def a_reindex_values(self, batch_size: int = 1000):
+        # Index is built again from values, so keys can be declared for existing followers
+        async with in_transaction():
+            await FollowerIndexValue.all().delete()
+            index_values = []
+            async for follower in self.a_iter_followers(batch_size=batch_size):
+                index_values.extend(make_index_values(follower, self.indexed_values))
+                if len(index_values) >= batch_size:
+                    await FollowerIndexValue.bulk_create(index_values)
+                    index_values = []
+            await FollowerIndexValue.bulk_create(index_values)
+
+    async def a_iter_followers(self, agent: Optional[Agent] = None, batch_size: int = 1000,
+                               filter: Optional[Dict[str, Optional[str]]] = None,
+                               values: Optional[Dict[str, Any]] = None,
+                               after_id: int = 0) -> AsyncIterator[Follower]:
+        # Batches are taken after the last id of the previous one, so every batch is as fast as
+        # the first one and only one batch is in memory
+        query = Follower.filter(**dbdrivers.check_filter(filter))
+        for name, value in dbdrivers.check_values(self.indexed_values, values).items():
+            query = query.filter(id__in=Subquery(
+                FollowerIndexValue.filter(name=name, value=value).values("follower_id"),
+            ))
+        if agent is not None:
+            query = query.filter(bot=agent.name)
+        last_id = after_id
+        while True:
+            followers = await query.filter(id__gt=last_id).order_by("id").limit(batch_size)
+            for follower in followers:
+                yield follower
+            if len(followers) < batch_size:
+                break
+            last_id = followers[-1].id
+
+    async def a_delete(self, follower: Follower):
+        await follower.delete()
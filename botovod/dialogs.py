@@ -1,24 +1,61 @@
-from typing import Callable, Iterator, Optional
+from functools import lru_cache
+import inspect
+from typing import Any, Callable, Dict, Iterator, Optional, Union
 
 from .agents import Agent, Attachment, Chat, Keyboard, Location, Message
+from .context import Context
 from .dbdrivers import Follower
 from .exceptions import HandlerNotPassed
 
 
+@lru_cache(maxsize=None)
+def init_takes_context(cls: type) -> bool:
+    # Subclasses written before the context override __init__(self, agent, chat, message,
+    # follower, **scope), they are still initialized that way
+    return list(inspect.signature(cls.__init__).parameters)[1:2] == ["context"]
+
+
 class Dialog:
-    def __init__(self, agent: Agent, chat: Chat, message: Message, follower: Follower, **scope):
-        self.agent = agent
-        self.chat = chat
-        self.message = message
-        self.follower = follower
-        self.scope = scope
-
-    def __new__(cls, agent: Agent, chat: Chat, message: Message, follower: Follower, **scope):
+    # Dialogs are handlers taking the context, the old call with agent, chat, message, follower
+    # and items is still taken, by the dialog and by its __init__
+    botovod_context = True
+
+    def __init__(self, context: Union[Context, Agent], chat: Optional[Chat] = None,
+                 message: Optional[Message] = None, follower: Optional[Follower] = None,
+                 **scope):
+        if not isinstance(context, Context):
+            # Old subclasses pass on what __new__ took out of the context it has already set
+            context = self.__dict__.get("context") or Context(context, chat, message, follower,
+                                                              items=scope)
+        self.context = context
+        self.agent = context.agent
+        self.chat = context.chat
+        self.message = context.message
+        self.follower = context.follower
+
+    def __new__(cls, context: Union[Context, Agent], chat: Optional[Chat] = None,
+                message: Optional[Message] = None, follower: Optional[Follower] = None, **scope):
+        if not isinstance(context, Context):
+            context = Context(context, chat, message, follower, items=scope)
         dialog = super().__new__(cls)
-        dialog.__init__(agent=agent, chat=chat, message=message, follower=follower, **scope)
+        dialog.context = context
+        if init_takes_context(cls):
+            dialog.__init__(context)
+        else:
+            dialog.__init__(context.agent, context.chat, context.message, context.follower,
+                            **context.items)
 
         return dialog.process()
 
+    # Scope is the items of the context, old subclasses may still set it in __init__
+    @property
+    def scope(self) -> Dict[str, Any]:
+        return self.context.items
+
+    @scope.setter
+    def scope(self, scope: Dict[str, Any]):
+        self.context.items = scope
+
     def process(self):
         dialog_name = self.follower.get_dialog()
         if dialog_name is not None and dialog_name != self.__class__.__name__:
@@ -47,6 +84,10 @@ class Dialog:
             keyboard=keyboard,
             **raw,
         )
+        if self.agent.botovod.history and self.follower is not None:
+            message = Message(text=text, images=images, audios=audios, documents=documents,
+                              videos=videos, locations=locations, **raw)
+            self.follower.add_history(message, input=False)
 
     def set_next_step(self, function: Callable):
         if hasattr(function, "__self__"):
@@ -58,7 +99,7 @@ class Dialog:
 
     def start_dialog(self, dialog_class: Callable):
         self.follower.set_dialog(dialog_class.__name__)
-        dialog_class(self.agent, self.chat, self.message, self.follower, **self.scope)
+        dialog_class(self.context)
 
     def start(self):
         raise NotImplementedError
@@ -84,7 +125,7 @@ class AsyncDialog(Dialog):
                     audios: Iterator[Attachment] = (), documents: Iterator[Attachment] = (),
                     videos: Iterator[Attachment] = (), locations: Iterator[Location] = (),
                     keyboard: Optional[Keyboard] = None, **raw):
-        return await self.agent.a_send_message(
+        result = await self.agent.a_send_message(
             chat=self.chat,
             text=text,
             images=images,
@@ -95,6 +136,11 @@ class AsyncDialog(Dialog):
             keyboard=keyboard,
             **raw,
         )
+        if self.agent.botovod.history and self.follower is not None:
+            message = Message(text=text, images=images, audios=audios, documents=documents,
+                              videos=videos, locations=locations, **raw)
+            await self.follower.a_add_history(message, input=False)
+        return result
 
     async def set_next_step(self, function: Callable):
         if hasattr(function, "__self__"):
@@ -105,7 +151,7 @@ class AsyncDialog(Dialog):
 
     async def start_dialog(self, dialog_class: Callable):
         await self.follower.a_set_dialog(dialog_class.__name__)
-        await dialog_class(self.agent, self.chat, self.message, self.follower, **self.scope)
+        await dialog_class(self.context)
 
     async def start(self):
         raise NotImplementedError
@@ -15,3 +15,8 @@ class AgentNotExistException(BotovodException):
 class HandlerNotPassed(BotovodException):
     def __init__(self):
         super().__init__("Handler not passed")
+
+
+class FollowerConflictException(BotovodException):
+    def __init__(self):
+        super().__init__("Follower was changed by another update")
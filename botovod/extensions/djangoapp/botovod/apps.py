@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class BotovodConfig(AppConfig):
+    name = "botovod.extensions.djangoapp.botovod"
+    label = "botovod"
+    verbose_name = "Botovod"
+    default_auto_field = "django.db.models.AutoField"
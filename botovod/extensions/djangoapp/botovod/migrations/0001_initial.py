@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Follower',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat', models.CharField(max_length=64)),
+                ('bot', models.CharField(max_length=64)),
+                ('dialog', models.CharField(max_length=64, null=True)),
+                ('next_step', models.CharField(max_length=64, null=True)),
+                ('data', models.JSONField(default=dict)),
+            ],
+            options={
+                'db_table': 'botovod_followers',
+                'constraints': [models.UniqueConstraint(fields=('bot', 'chat'), name='botovod_followers_bot_chat')],
+            },
+        ),
+    ]
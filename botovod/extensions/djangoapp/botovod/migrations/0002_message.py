@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botovod', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input', models.BooleanField()),
+                ('text', models.TextField(null=True)),
+                ('data', models.TextField()),
+                ('created_at', models.DateTimeField()),
+                ('follower', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='botovod.follower')),
+            ],
+            options={
+                'db_table': 'botovod_messages',
+                'indexes': [models.Index(fields=['follower', 'created_at'], name='botovod_messages_follower'), models.Index(fields=['created_at'], name='botovod_messages_created')],
+            },
+        ),
+    ]
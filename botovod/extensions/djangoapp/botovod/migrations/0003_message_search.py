@@ -0,0 +1,46 @@
+from django.db import migrations
+
+from botovod.dbdrivers.history import SEARCH_CONFIG, SQLITE_SEARCH, SQLITE_SEARCH_DROP
+
+
+TABLE = "botovod_messages"
+
+
+def create_search(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        for statement in SQLITE_SEARCH:
+            schema_editor.execute(statement.format(table=TABLE))
+        schema_editor.execute(
+            f"INSERT INTO {TABLE}_search ({TABLE}_search) VALUES ('rebuild')",
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE INDEX {TABLE}_search ON {TABLE} "
+            f"USING gin (to_tsvector('{SEARCH_CONFIG}'::regconfig, text))",
+        )
+    elif vendor == "mysql":
+        schema_editor.execute(f"CREATE FULLTEXT INDEX {TABLE}_search ON {TABLE} (text)")
+
+
+def drop_search(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {TABLE}_search_insert")
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {TABLE}_search_delete")
+        schema_editor.execute(SQLITE_SEARCH_DROP.format(table=TABLE))
+    elif vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {TABLE}_search")
+    elif vendor == "mysql":
+        schema_editor.execute(f"DROP INDEX {TABLE}_search ON {TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botovod', '0002_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search, drop_search),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botovod', '0003_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FollowerIndexValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('value', models.CharField(max_length=255)),
+                ('follower', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='index_values', to='botovod.follower')),
+            ],
+            options={
+                'db_table': 'botovod_follower_index',
+                'indexes': [models.Index(fields=['follower', 'name'], name='botovod_index_follower')],
+                'constraints': [models.UniqueConstraint(fields=('name', 'value', 'follower'), name='botovod_follower_index_value')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botovod', '0004_follower_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='follower',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
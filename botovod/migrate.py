@@ -0,0 +1,202 @@
+from __future__ import annotations
+import argparse
+import asyncio
+from botovod.agents import Agent, Chat
+from botovod.dbdrivers import DBDriver, Follower
+import importlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class Record(NamedTuple):
+    id: int
+    bot: str
+    chat: str
+    dialog: Optional[str]
+    next_step: Optional[str]
+    values: Dict[str, Any]
+
+
+def load_dbdriver(module: str) -> DBDriver:
+    # Driver is given by its module, e.g. "botovod.dbdrivers.sqlalchemy"
+    return importlib.import_module(module).DBDriver()
+
+
+def make_agent(bot: str) -> Agent:
+    # Drivers keep the bot of a follower as the agent name or the agent class name, so the agent
+    # standing for a bot has both
+    agent = type(bot, (Agent,), {})()
+    agent.name = bot
+    return agent
+
+
+class Checkpoint:
+    # Batches are finished by workers in any order, the checkpoint moves only over batches
+    # finished one after another from the start, so nothing before it is left uncopied
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.last_id = 0
+        self.copied = 0
+        self.next_number = 0
+        self.finished = {}
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            data = json.load(file)
+        self.last_id = data["last_id"]
+        self.copied = data["copied"]
+
+    def save(self):
+        if self.path is None:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"last_id": self.last_id, "copied": self.copied}, file)
+        os.replace(temp_path, self.path)
+
+    def finish(self, number: int, last_id: int, count: int) -> bool:
+        # Returns whether the checkpoint moved
+        self.finished[number] = (last_id, count)
+        if self.next_number not in self.finished:
+            return False
+        while self.next_number in self.finished:
+            last_id, count = self.finished.pop(self.next_number)
+            self.last_id = last_id
+            self.copied += count
+            self.next_number += 1
+        self.save()
+        return True
+
+
+class Migrator:
+    def __init__(self, source: DBDriver, target: DBDriver, batch_size: int = 1000,
+                 workers: int = 1, checkpoint: Optional[Checkpoint] = None):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = Checkpoint() if checkpoint is None else checkpoint
+        self.agents = {}
+
+    def get_agent(self, bot: str) -> Agent:
+        if bot not in self.agents:
+            self.agents[bot] = make_agent(bot)
+        return self.agents[bot]
+
+    async def a_run(self) -> int:
+        # Source is read by one task batch after batch, batches are written to the target by
+        # workers, the queue keeps at most one waiting batch per worker in memory
+        self.checkpoint.load()
+        queue = asyncio.Queue(maxsize=self.workers)
+        tasks = [asyncio.ensure_future(self.a_read(queue))]
+        tasks.extend(asyncio.ensure_future(self.a_work(queue)) for _ in range(self.workers))
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+        return self.checkpoint.copied
+
+    async def a_read(self, queue: asyncio.Queue):
+        number = 0
+        followers = []
+        async for follower in self.source.a_iter_followers(batch_size=self.batch_size,
+                                                           after_id=self.checkpoint.last_id):
+            followers.append(follower)
+            if len(followers) >= self.batch_size:
+                await queue.put((number, await self.a_make_batch(followers)))
+                number += 1
+                followers = []
+        if followers:
+            await queue.put((number, await self.a_make_batch(followers)))
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def a_make_batch(self, followers: List[Follower]) -> List[Record]:
+        # Values of the whole batch are read by one query instead of one query per follower
+        await self.source.a_prefetch_values(followers)
+        batch = []
+        for follower in followers:
+            chat = await follower.a_get_chat()
+            batch.append(Record(
+                id=follower.id,
+                bot=chat.agent,
+                chat=chat.id,
+                dialog=await follower.a_get_dialog(),
+                next_step=await follower.a_get_next_step(),
+                values=await follower.a_get_values(),
+            ))
+            await self.source.a_finish(follower)
+        return batch
+
+    async def a_work(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            number, batch = item
+            await self.a_write(batch)
+            if self.checkpoint.finish(number, batch[-1].id, len(batch)):
+                logger.info("Copied %d followers, last id %d", self.checkpoint.copied,
+                            self.checkpoint.last_id)
+
+    async def a_write(self, batch: Iterable[Record]):
+        # Followers of one bot are written by one bulk call, which overwrites followers copied
+        # before, so a batch which was copied partly is copied right on resume
+        bots = {}
+        for record in batch:
+            bots.setdefault(record.bot, []).append(record)
+        for bot, records in bots.items():
+            agent = self.get_agent(bot)
+            await self.target.a_import_followers(agent, [
+                (Chat(agent, record.chat), record.dialog, record.next_step, record.values)
+                for record in records
+            ])
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m botovod.migrate",
+                                     description="Copy followers from one dbdriver to another")
+    parser.add_argument("source", help="module of the source dbdriver")
+    parser.add_argument("target", help="module of the target dbdriver")
+    parser.add_argument("--source-settings", type=json.loads, default={},
+                        help="json with a_connect arguments of the source")
+    parser.add_argument("--target-settings", type=json.loads, default={},
+                        help="json with a_connect arguments of the target")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--checkpoint", help="file to resume the copy from")
+    return parser.parse_args(args)
+
+
+async def a_main(args: argparse.Namespace) -> int:
+    source = load_dbdriver(args.source)
+    target = load_dbdriver(args.target)
+    await source.a_connect(**args.source_settings)
+    try:
+        await target.a_connect(**args.target_settings)
+        try:
+            migrator = Migrator(source, target, batch_size=args.batch_size, workers=args.workers,
+                                checkpoint=Checkpoint(args.checkpoint))
+            return await migrator.a_run()
+        finally:
+            await target.a_close()
+    finally:
+        await source.a_close()
+
+
+def main(args: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    copied = asyncio.run(a_main(parse_args(args)))
+    logger.info("Done, %d followers copied", copied)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+from .imports import lazy_attributes
+
+
+__getattr__, __dir__ = lazy_attributes(__name__, {}, ("codec", "emoji", "handlers", "intents"))
@@ -0,0 +1,60 @@
+from __future__ import annotations
+import json
+import os
+from typing import Any, Callable, Optional, Union
+
+
+# JSON codec used across botovod. The fastest installed backend is taken (orjson, then ujson, then
+# the standard library), BOTOVOD_JSON can name one of them. Every backend writes compact utf-8
+# text, loads takes both str and bytes, so bodies can be passed on without decoding them first
+BACKENDS = ("orjson", "ujson", "json")
+
+
+def get_backend(name: Optional[str] = None) -> str:
+    names = BACKENDS if name is None else (name,)
+    for name in names:
+        if name == "json":
+            return name
+        try:
+            __import__(name)
+        except ImportError:
+            continue
+        return name
+    raise ValueError(f"JSON backend '{names[0]}' is not installed")
+
+
+BACKEND = get_backend(os.environ.get("BOTOVOD_JSON"))
+
+if BACKEND == "orjson":
+    import orjson
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumpb(value: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return dumpb(value, default=default).decode()
+
+elif BACKEND == "ujson":
+    import ujson
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return ujson.loads(data)
+
+    def dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return ujson.dumps(value, ensure_ascii=False, default=default)
+
+    def dumpb(value: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return dumps(value, default=default).encode()
+
+else:
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=default)
+
+    def dumpb(value: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        return dumps(value, default=default).encode()
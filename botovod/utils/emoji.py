@@ -1,3 +1,8 @@
+from __future__ import annotations
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
 GRINNING_FACE = "😀"
 GRINNING_FACE_WITH_BIG_EYES = "😃"
 GRINNING_FACE_WITH_SMILING_EYES = "😄"
@@ -1717,3 +1722,134 @@ FLAG_ZIMBABWE = "🇿🇼"
 FLAG_ENGLAND = "🏴󠁧󠁢󠁥󠁮󠁧󠁿"
 FLAG_SCOTLAND = "🏴󠁧󠁢󠁳󠁣󠁴󠁿"
 FLAG_WALES = "🏴󠁧󠁢󠁷󠁬󠁳󠁿"
+
+
+# Characters below U+1F000 which are shown as emoji by default (Emoji_Presentation), others there
+# (©, ™, arrows) are text unless the variation selector follows them
+EMOJI_PRESENTATION = frozenset(chr(code) for first, last in (
+    (0x231A, 0x231B), (0x23E9, 0x23EC), (0x23F0, 0x23F0), (0x23F3, 0x23F3), (0x25FD, 0x25FE),
+    (0x2614, 0x2615), (0x2648, 0x2653), (0x267F, 0x267F), (0x2693, 0x2693), (0x26A1, 0x26A1),
+    (0x26AA, 0x26AB), (0x26BD, 0x26BE), (0x26C4, 0x26C5), (0x26CE, 0x26CE), (0x26D4, 0x26D4),
+    (0x26EA, 0x26EA), (0x26F2, 0x26F3), (0x26F5, 0x26F5), (0x26FA, 0x26FA), (0x26FD, 0x26FD),
+    (0x2705, 0x2705), (0x270A, 0x270B), (0x2728, 0x2728), (0x274C, 0x274C), (0x274E, 0x274E),
+    (0x2753, 0x2755), (0x2757, 0x2757), (0x2795, 0x2797), (0x27B0, 0x27B0), (0x27BF, 0x27BF),
+    (0x2B1B, 0x2B1C), (0x2B50, 0x2B50), (0x2B55, 0x2B55),
+) for code in range(first, last + 1))
+SKIN_TONES = frozenset(chr(code) for code in range(0x1F3FB, 0x1F400))
+
+
+class EmojiIndex:
+    # Emoji of this module by name and by value, with a trie of values to find them in text. A
+    # trie node is a dict of next characters, the name of the emoji ending at the node is kept
+    # under None. Text-default symbols are emoji only with the variation selector (U+FE0F). Text
+    # often lacks it inside keycap and ZWJ sequences, so those are also added without it. Skin
+    # tones belong to the emoji they follow and are skipped by the walk
+    VARIATION_SELECTOR = "\ufe0f"
+    ZERO_WIDTH_JOINER = "\u200d"
+    KEYCAP = "\u20e3"
+
+    def __init__(self, emoji: Dict[str, str]):
+        self.by_name = dict(emoji)
+        self.by_value = {value: name for name, value in self.by_name.items()}
+        self.trie = {}
+        for value, name in self.by_value.items():
+            if self.is_text_default(value):
+                value += self.VARIATION_SELECTOR
+            self.add(value, name)
+        for value, name in self.by_value.items():
+            if self.ZERO_WIDTH_JOINER in value or self.KEYCAP in value:
+                self.add(value.replace(self.VARIATION_SELECTOR, ""), name)
+
+    @staticmethod
+    def is_text_default(value: str) -> bool:
+        return len(value) == 1 and value < "\U0001f000" and value not in EMOJI_PRESENTATION
+
+    def add(self, value: str, name: str):
+        if not value:
+            return
+        node = self.trie
+        for char in value:
+            node = node.setdefault(char, {})
+        node.setdefault(None, name)
+
+    def match(self, text: str, start: int) -> Optional[Tuple[int, str]]:
+        # End and name of the longest emoji starting at start
+        node = self.trie
+        found = None
+        for position in range(start, len(text)):
+            char = text[position]
+            if char in SKIN_TONES and position > start:
+                if found is not None and found[0] == position:
+                    found = (position + 1, found[1])
+                continue
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = (position + 1, node[None])
+        if found is not None and text.startswith(self.VARIATION_SELECTOR, found[0]):
+            found = (found[0] + 1, found[1])
+        return found
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int, str]]:
+        # Leftmost longest emoji as (start, end, name). No emoji is longer than a few characters,
+        # so the trie walk from every position keeps it one pass over the text
+        trie = self.trie
+        position = 0
+        length = len(text)
+        while position < length:
+            if text[position] in trie:
+                found = self.match(text, position)
+                if found is not None:
+                    end, name = found
+                    yield position, end, name
+                    position = end
+                    continue
+            position += 1
+
+
+@lru_cache(maxsize=1)
+def get_index() -> EmojiIndex:
+    # Built on the first call, so importing the module only defines the constants
+    return EmojiIndex({name: value for name, value in globals().items()
+                       if name.isupper() and isinstance(value, str)})
+
+
+def get_emoji(name: str) -> Optional[str]:
+    return get_index().by_name.get(name.upper())
+
+
+def get_name(value: str) -> Optional[str]:
+    index = get_index()
+    name = index.by_value.get(value)
+    if name is None:
+        found = index.match(value, 0)
+        if found is not None and found[0] == len(value):
+            name = found[1]
+    return name
+
+
+def finditer(text: str) -> Iterator[Tuple[int, int, str]]:
+    return get_index().finditer(text)
+
+
+def find_all(text: str) -> List[str]:
+    return [text[start:end] for start, end, _ in finditer(text)]
+
+
+def contains(text: str) -> bool:
+    return next(finditer(text), None) is not None
+
+
+def count(text: str) -> int:
+    return sum(1 for _ in finditer(text))
+
+
+def strip(text: str) -> str:
+    parts = []
+    last = 0
+    for start, end, _ in finditer(text):
+        parts.append(text[last:start])
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
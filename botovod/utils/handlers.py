@@ -3,9 +3,7 @@ import re
 from typing import Callable, Optional
 
 from botovod.agents import Agent, Chat, Message
-from botovod.agents.telegram import TelegramAgent, TelegramCallback
 from botovod.dbdrivers import Follower
-from botovod.dialogs import AsyncDialog, Dialog
 from botovod.exceptions import HandlerNotPassed
 
 
@@ -194,6 +192,9 @@ def only_agent(name: str, is_dialog: bool = False):
                 raise HandlerNotPassed
             return func(agent, chat, message, follower, *args, **kwargs)
 
+        # Botovod leaves the handler out of the handlers of other agents
+        func_wrapper.botovod_agent = name
+
         @wraps(func)
         def dialog_wrapper(self, *args, **kwargs):
             if self.agent.name != name:
@@ -230,6 +231,9 @@ def only_chat(chat: Chat, cls: type = Agent, is_dialog: bool=False):
 
 
 def only_telegram_callback(is_dialog: bool = False):
+    # Telegram agent is imported only by handlers which check for it
+    from botovod.agents.telegram import TelegramAgent, TelegramCallback
+
     def decorator(func: Callable):
         @wraps(func)
         def func_wrapper(agent: Agent, chat: Chat, message: Message,
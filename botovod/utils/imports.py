@@ -0,0 +1,28 @@
+from __future__ import annotations
+import importlib
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+def lazy_attributes(package: str, attributes: Dict[str, str],
+                    submodules: Iterable[str] = ()) -> Tuple[Callable[[str], Any],
+                                                             Callable[[], List[str]]]:
+    # Module __getattr__ and __dir__ (PEP 562) of a package which imports its attributes on the
+    # first access. attributes maps a name to the module it lives in, relative to the package
+    submodules = frozenset(submodules)
+
+    def __getattr__(name: str) -> Any:
+        if name in attributes:
+            value = getattr(importlib.import_module(attributes[name], package), name)
+        elif name in submodules:
+            value = importlib.import_module(f"{package}.{name}")
+        else:
+            raise AttributeError(f"module '{package}' has no attribute '{name}'")
+        # Kept in the package, so __getattr__ isn't called for the name again
+        setattr(sys.modules[package], name, value)
+        return value
+
+    def __dir__() -> List[str]:
+        return sorted(set(vars(sys.modules[package])) | set(attributes) | submodules)
+
+    return __getattr__, __dir__
@@ -0,0 +1,186 @@
+from __future__ import annotations
+from collections import Counter
+from threading import Lock
+from typing import Callable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from botovod.agents import Chat, Message
+from botovod.context import Context, adapt_handler
+from botovod.exceptions import HandlerNotPassed
+
+
+class IntentMatch(NamedTuple):
+    name: str
+    score: float
+    handler: Callable
+
+
+def split_ngrams(text: str, ngrams: Tuple[int, int]) -> List[str]:
+    # Character n-grams of the lowered text with spaces squeezed, the padding gives word edges
+    # n-grams of their own
+    text = " " + " ".join(text.lower().split()) + " "
+    return [text[start:start + size] for size in range(ngrams[0], ngrams[1] + 1)
+            for start in range(len(text) - size + 1)]
+
+
+class IntentIndex:
+    # TF-IDF matrix of example phrases over character n-grams, kept by column (n-gram) as a
+    # sparse matrix: postings of column c are rows[indptr[c]:indptr[c + 1]] with their values.
+    # Rows are L2 normalized, so a product with a normalized query is the cosine similarity.
+    # Rows of an intent go one after another from starts[intent]
+    def __init__(self, intents: Sequence[Tuple[str, Callable, Tuple[str, ...]]],
+                 ngrams: Tuple[int, int]):
+        self.ngrams = ngrams
+        self.intents = tuple((name, handler) for name, handler, _ in intents)
+        self.vocabulary = {}
+        rows = []
+        columns = []
+        counts = []
+        starts = []
+        row = 0
+        for name, _, examples in intents:
+            if not examples:
+                raise ValueError(f"Intent '{name}' has no examples")
+            starts.append(row)
+            for example in examples:
+                for ngram, count in Counter(split_ngrams(example, ngrams)).items():
+                    rows.append(row)
+                    columns.append(self.vocabulary.setdefault(ngram, len(self.vocabulary)))
+                    counts.append(count)
+                row += 1
+        self.row_count = row
+        self.starts = np.array(starts, dtype=np.intp)
+
+        rows = np.array(rows, dtype=np.intp)
+        columns = np.array(columns, dtype=np.intp)
+        frequencies = np.bincount(columns, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + self.row_count) / (1 + frequencies)) + 1
+        # N-grams missing from the examples still make a query longer, they get the top idf
+        self.unknown_idf = np.log(1 + self.row_count) + 1
+        values = (1 + np.log(np.array(counts, dtype=np.float64))) * self.idf[columns]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=self.row_count))
+        values /= norms[rows]
+
+        order = np.argsort(columns, kind="stable")
+        self.rows = rows[order]
+        self.values = values[order]
+        self.indptr = np.concatenate(([0], np.cumsum(frequencies)))
+
+    def score(self, texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # Best intent of every text and its score. Postings of all n-grams of all texts are
+        # summed by one bincount into a texts x rows matrix, the best row of an intent is its
+        # score
+        queries = []
+        columns = []
+        weights = []
+        for number, text in enumerate(texts):
+            counts = Counter(split_ngrams(text, self.ngrams))
+            known = [(self.vocabulary[ngram], count) for ngram, count in counts.items()
+                     if ngram in self.vocabulary]
+            if not known:
+                continue
+            text_columns = np.array([column for column, _ in known], dtype=np.intp)
+            text_weights = (1 + np.log(np.array([count for _, count in known], dtype=np.float64)))
+            text_weights *= self.idf[text_columns]
+            unknown = [count for ngram, count in counts.items() if ngram not in self.vocabulary]
+            unknown = (1 + np.log(np.array(unknown, dtype=np.float64))) * self.unknown_idf
+            text_weights /= np.sqrt((text_weights ** 2).sum() + (unknown ** 2).sum())
+            queries.append(np.full(len(known), number, dtype=np.intp))
+            columns.append(text_columns)
+            weights.append(text_weights)
+
+        scores = np.zeros((len(texts), self.row_count))
+        if columns:
+            queries = np.concatenate(queries)
+            columns = np.concatenate(columns)
+            weights = np.concatenate(weights)
+            starts = self.indptr[columns]
+            lengths = self.indptr[columns + 1] - starts
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+            cells = self.rows[positions] + np.repeat(queries * self.row_count, lengths)
+            values = self.values[positions] * np.repeat(weights, lengths)
+            scores = np.bincount(cells, weights=values, minlength=len(texts) * self.row_count)
+            scores = scores.reshape(len(texts), self.row_count)
+        intent_scores = np.maximum.reduceat(scores, self.starts, axis=1)
+        best = intent_scores.argmax(axis=1)
+        return best, intent_scores[np.arange(len(texts)), best]
+
+
+class IntentRouter:
+    # Handler routing free text to the intent with the most similar example phrase. The matrix is
+    # built on the first use after intents are changed, the matched intent is put into the context
+    # as "intent"
+    botovod_context = True
+
+    def __init__(self, threshold: float = 0.5, ngrams: Tuple[int, int] = (2, 4)):
+        self.threshold = threshold
+        self.ngrams = ngrams
+        self.intents = []
+        self.index = None
+        self.lock = Lock()
+
+    def add_intent(self, handler: Callable, examples: Iterable[str], name: Optional[str] = None):
+        with self.lock:
+            name = handler.__name__ if name is None else name
+            self.intents.append((name, adapt_handler(handler), tuple(examples)))
+            self.index = None
+
+    def intent(self, *examples: str, name: Optional[str] = None) -> Callable:
+        def decorator(handler: Callable) -> Callable:
+            self.add_intent(handler, examples, name=name)
+            return handler
+
+        return decorator
+
+    def build(self) -> Optional[IntentIndex]:
+        with self.lock:
+            if self.index is None and self.intents:
+                self.index = IntentIndex(self.intents, self.ngrams)
+            return self.index
+
+    def match(self, text: str) -> Optional[IntentMatch]:
+        return self.match_many([text])[0]
+
+    def match_many(self, texts: Sequence[str]) -> List[Optional[IntentMatch]]:
+        index = self.index or self.build()
+        if index is None or not texts:
+            return [None] * len(texts)
+        best, scores = index.score(texts)
+        matches = []
+        for number, score in zip(best.tolist(), scores.tolist()):
+            if score < self.threshold:
+                matches.append(None)
+            else:
+                name, handler = index.intents[number]
+                matches.append(IntentMatch(name=name, score=score, handler=handler))
+        return matches
+
+    def botovod_prepare(self,
+                        messages: Sequence[Tuple[Chat, Message]]) -> List[Optional[IntentMatch]]:
+        # Called by the agent with all messages of a request, they are scored in one batch and
+        # the match of a message is handed back to the router in its context
+        texts = [message.text for _, message in messages if message.text]
+        matches = iter(self.match_many(texts))
+        return [next(matches) if message.text else None for _, message in messages]
+
+    def get_match(self, context: Context) -> IntentMatch:
+        text = context.message.text
+        if not text:
+            raise HandlerNotPassed
+        match = context.prepared.get(self, False)
+        if match is False:
+            match = self.match(text)
+        if match is None:
+            raise HandlerNotPassed
+        context["intent"] = match
+        return match
+
+    def __call__(self, context: Context):
+        return self.get_match(context).handler(context)
+
+
+class AsyncIntentRouter(IntentRouter):
+    async def __call__(self, context: Context):
+        return await self.get_match(context).handler(context)
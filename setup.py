@@ -16,4 +16,5 @@ setup(
     
     packages = find_packages(),
     install_requires = ["aiofiles", "aiohttp", "requests"],
+    extras_require = {"intents": ["numpy"]},
 )
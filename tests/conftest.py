@@ -0,0 +1,10 @@
+import pytest
+
+from botovod.agents import Agent
+
+
+@pytest.fixture
+def agent() -> Agent:
+    agent = Agent()
+    agent.name = "test"
+    return agent
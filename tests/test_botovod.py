@@ -0,0 +1,205 @@
+import asyncio
+from threading import Thread
+
+import pytest
+
+from botovod import Botovod
+from botovod.agents import Agent, Chat, Keyboard, KeyboardButton, Message
+from botovod.agents.telegram import (TelegramAgent, TelegramCallback, TelegramInlineKeyboard,
+                                     TelegramInlineKeyboardButton)
+from botovod.botovod import AsyncHandlerGroup, HandlerGroup
+from botovod.context import Context
+from botovod.exceptions import HandlerNotPassed
+from botovod.utils.handlers import only_agent
+
+
+def test_get_button_handler():
+    botovod = Botovod()
+    assert botovod.get_button_handler(Message(text="Yes")) is None
+
+    def yes(context):
+        return "yes"
+
+    def no(agent, chat, message, follower, **items):
+        return "no"
+
+    botovod.add_keyboard(Keyboard([[KeyboardButton("Yes", handler=yes),
+                                    KeyboardButton("No", handler=no)],
+                                   [KeyboardButton("Skip")]]))
+    assert botovod.get_button_handler(Message(text="Yes")) is yes
+    assert botovod.get_button_handler(Message(text="Skip")) is None
+    assert botovod.get_button_handler(Message(text="Maybe")) is None
+    # Handlers not taking the context are adapted to it
+    handler = botovod.get_button_handler(Message(text="No"))
+    assert handler(Context(None, Chat("bot", "1"), Message(text="No"))) == "no"
+
+    botovod.add_buttons(KeyboardButton("Yes", handler=no))
+    assert botovod.get_button_handler(Message(text="Yes")) is not yes
+    botovod.remove_buttons(KeyboardButton("Yes"))
+    assert botovod.get_button_handler(Message(text="Yes")) is None
+
+
+def test_button_handler_goes_first():
+    def common(context):
+        return "common"
+
+    def yes(context):
+        return "yes"
+
+    botovod = Botovod()
+    agent = Agent()
+    botovod.add_agent("bot", agent)
+    botovod.add_handler(common)
+    botovod.add_buttons(KeyboardButton("Yes", handler=yes))
+
+    assert agent.get_handlers(Message(text="Yes")) == (yes, common)
+    assert agent.get_handlers(Message(text="No")) == (common,)
+
+
+def test_dynamic_keyboards_are_bounded():
+    botovod = Botovod(max_buttons=100)
+    agent = TelegramAgent(token="token")
+    botovod.add_agent("telegram", agent)
+
+    def open_item(context):
+        return context.message.text
+
+    def send(number):
+        agent.render_keyboard(TelegramInlineKeyboard([[
+            TelegramInlineKeyboardButton(f"Item {number}", data=f"item:{number}",
+                                         handler=open_item),
+        ]]))
+
+    def press(number):
+        return TelegramCallback(id=str(number), user={}, data=f"item:{number}")
+
+    threads = [Thread(target=lambda start=start: [send(number) for number in
+                                                  range(start, 5000, 4)])
+               for start in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(botovod._buttons) == 100
+
+    for number in range(5000, 5100):
+        send(number)
+    assert botovod.get_button_handler(press(4999)) is None
+    assert botovod.get_button_handler(press(5099)) is open_item
+    # A pressed button is kept over buttons added before it
+    assert botovod.get_button_handler(press(5000)) is open_item
+    send(5100)
+    assert botovod.get_button_handler(press(5000)) is open_item
+    assert botovod.get_button_handler(press(5001)) is None
+
+
+def make_text_handler(text):
+    def handler(context):
+        if context.message.text != text:
+            raise HandlerNotPassed
+        return text
+
+    return handler
+
+
+def test_handler_group_reorders():
+    first, second, third = (make_text_handler(text) for text in ("a", "b", "c"))
+    group = HandlerGroup(first, second, third, reorder_every=4)
+
+    def call(text):
+        return group(Context(None, Chat("bot", "1"), Message(text=text)))
+
+    assert [call(text) for text in ("c", "c", "b")] == ["c", "c", "b"]
+    assert [index for index, _ in group.order] == [0, 1, 2]
+    assert group.hits == [0, 1, 2]
+    # The fourth hit moves the handlers matching most often first and halves the counts
+    assert call("c") == "c"
+    assert [index for index, _ in group.order] == [2, 1, 0]
+    assert group.hits == [0, 0, 1]
+    assert group.count == 0
+
+    assert [call(text) for text in ("a", "b", "c")] == ["a", "b", "c"]
+    with pytest.raises(HandlerNotPassed):
+        call("d")
+
+
+def test_handler_group_order_is_stable():
+    # Handlers hit as often keep the order they were given in
+    handlers = [make_text_handler(text) for text in ("a", "b", "c")]
+    group = HandlerGroup(*handlers, reorder_every=3)
+    for text in ("c", "b", "a"):
+        group(Context(None, Chat("bot", "1"), Message(text=text)))
+    assert [index for index, _ in group.order] == [0, 1, 2]
+
+
+def test_async_handler_group():
+    def make_async_handler(text):
+        async def handler(context):
+            if context.message.text != text:
+                raise HandlerNotPassed
+            return text
+
+        return handler
+
+    group = AsyncHandlerGroup(*(make_async_handler(text) for text in ("a", "b")),
+                              reorder_every=2)
+
+    async def run():
+        results = []
+        for text in ("b", "b", "a", "b"):
+            results.append(await group(Context(None, Chat("bot", "1"), Message(text=text))))
+        with pytest.raises(HandlerNotPassed):
+            await group(Context(None, Chat("bot", "1"), Message(text="c")))
+        return results
+
+    assert asyncio.run(run()) == ["b", "b", "a", "b"]
+    assert [index for index, _ in group.order] == [1, 0]
+
+
+def test_handlers_copy_on_write():
+    def first(context):
+        pass
+
+    def second(context):
+        pass
+
+    botovod = Botovod()
+    botovod.add_handlers(first, second)
+    handlers = botovod.handlers
+    assert handlers == [first, second]
+    # The list is a copy, it doesn't change the handlers of Botovod
+    handlers.append(first)
+    assert botovod.handlers == [first, second]
+
+    # An update keeps the handlers it started with while they are changed
+    snapshot = botovod.get_handlers()
+    botovod.remove_handler(first)
+    assert botovod.handlers == [second]
+    assert len(snapshot) == 2
+    assert len(botovod.get_handlers()) == 1
+    botovod.set_handlers([first])
+    assert botovod.handlers == [first]
+    botovod.clear_handlers()
+    assert botovod.handlers == []
+    assert botovod.get_handlers() == ()
+
+
+def test_handlers_of_agent():
+    @only_agent("telegram")
+    def telegram(agent, chat, message, follower, **items):
+        return "telegram"
+
+    def common(context):
+        return "common"
+
+    botovod = Botovod()
+    botovod.add_handlers(telegram, common)
+
+    assert botovod.get_handlers("vk") == (common,)
+    assert botovod.get_handlers() == (common,)
+    handlers = botovod.get_handlers("telegram")
+    assert len(handlers) == 2 and handlers[1] is common
+    # Handlers not taking the context are adapted to it
+    agent = Agent()
+    agent.name = "telegram"
+    assert handlers[0](Context(agent, Chat("bot", "1"), Message(text="hi"))) == "telegram"
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from botovod import Botovod
+from botovod.agents import Agent, Chat, Message
+from botovod.dbdrivers.sqlite import DBDriver
+from botovod.exceptions import FollowerConflictException
+
+
+class ListAgent(Agent):
+    def __init__(self, messages):
+        super().__init__()
+        self.messages = messages
+
+    def parser(self, headers, body):
+        return self.messages
+
+    def responser(self, headers, body):
+        return 200, {}, ""
+
+    async def a_parser(self, headers, body):
+        return self.messages
+
+    async def a_responser(self, headers, body):
+        return 200, {}, ""
+
+
+@pytest.fixture
+def dbdriver(tmp_path):
+    dbdriver = DBDriver()
+    dbdriver.connect(str(tmp_path / "botovod.db"))
+    yield dbdriver
+    dbdriver.close()
+
+
+def test_stale_follower_conflicts(dbdriver, agent):
+    chat = Chat(agent, "1")
+    first = dbdriver.get_or_create_follower(agent, chat)
+    second = dbdriver.get_follower(agent, chat)
+
+    first.set_value("city", "Kazan")
+    with pytest.raises(FollowerConflictException):
+        second.set_value("city", "Moscow")
+    with pytest.raises(FollowerConflictException):
+        second.set_dialog("order")
+
+    follower = dbdriver.get_follower(agent, chat)
+    assert follower.get_dialog() is None
+    assert follower.get_values() == {"city": "Kazan"}
+    follower.set_dialog("order")
+
+
+def test_conflicting_update_is_handled_again(dbdriver):
+    chat = Chat("bot", "1")
+    agent = ListAgent([(chat, Message(text="hi"))])
+    botovod = Botovod(dbdriver, conflict_retries=2)
+    botovod.add_agent("bot", agent)
+    calls = []
+
+    def handler(context):
+        calls.append(context.follower.version)
+        if len(calls) == 1:
+            # Another update writes the follower after this one has read it
+            dbdriver.get_follower(agent, chat).set_value("city", "Kazan")
+        context.follower.set_value("count", len(calls))
+
+    botovod.add_handler(handler)
+    agent.listen({}, "")
+
+    assert len(calls) == 2
+    assert calls[1] > calls[0]
+    assert dbdriver.get_follower(agent, chat).get_values() == {"city": "Kazan", "count": 2}
+
+
+def test_conflicts_over_retries_raise(dbdriver):
+    chat = Chat("bot", "1")
+    agent = ListAgent([(chat, Message(text="hi"))])
+    botovod = Botovod(dbdriver, conflict_retries=1)
+    botovod.add_agent("bot", agent)
+
+    def handler(context):
+        dbdriver.get_follower(agent, chat).set_value("city", "Kazan")
+        context.follower.set_value("count", 1)
+
+    botovod.add_handler(handler)
+    with pytest.raises(FollowerConflictException):
+        agent.listen({}, "")
+
+
+def test_failed_handler_discards_changes(tmp_path):
+    tortoise = pytest.importorskip("botovod.dbdrivers.tortoise")
+    chat = Chat("bot", "1")
+    agent = ListAgent([(chat, Message(text="hi"))])
+    dbdriver = tortoise.DBDriver()
+    calls = []
+
+    async def handler(context):
+        calls.append(1)
+        await context.follower.a_set_value("city", "Moscow")
+        # Another update writes the follower, so flushing the change above would conflict
+        other = await dbdriver.a_get_follower(agent, chat)
+        await other.a_set_value("city", "Kazan")
+        await dbdriver.a_finish(other)
+        raise ValueError
+
+    async def run():
+        await dbdriver.a_connect("sqlite", str(tmp_path / "botovod.db"))
+        try:
+            await Tortoise.generate_schemas()
+            botovod = Botovod(dbdriver)
+            botovod.add_agent("bot", agent)
+            botovod.add_handler(handler)
+            with pytest.raises(ValueError):
+                await agent.a_listen({}, "")
+            follower = await dbdriver.a_get_follower(agent, chat)
+            return await follower.a_get_values()
+        finally:
+            await dbdriver.a_close()
+
+    Tortoise = pytest.importorskip("tortoise").Tortoise
+    assert asyncio.run(run()) == {"city": "Kazan"}
+    assert calls == [1]
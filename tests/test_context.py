@@ -0,0 +1,123 @@
+from botovod import Botovod
+from botovod.agents import Agent, Chat, Message
+from botovod.context import Context, adapt_handler, takes_context
+from botovod.dbdrivers.memory import DBDriver
+from botovod.dialogs import Dialog
+from botovod.exceptions import HandlerNotPassed
+
+
+class ListAgent(Agent):
+    def __init__(self, messages):
+        super().__init__()
+        self.messages = messages
+
+    def parser(self, headers, body):
+        return self.messages
+
+    def responser(self, headers, body):
+        return 200, {}, ""
+
+
+def test_context():
+    items = {"lang": "en"}
+    context = Context(None, Chat("bot", "1"), Message(text="hi"), items=items)
+
+    assert context["lang"] == "en"
+    assert context.get("missing", 1) == 1
+    assert "lang" in context and "missing" not in context
+    # Locals shadow items and never change the items of Botovod
+    context["lang"] = "ru"
+    assert context["lang"] == context.get("lang") == "ru"
+    assert items == {"lang": "en"}
+    assert context.items is items
+
+
+def test_takes_context():
+    def new(context):
+        pass
+
+    def old(agent, chat, message, follower, **items):
+        pass
+
+    class Marked:
+        botovod_context = True
+
+        def __call__(self, message):
+            pass
+
+    assert takes_context(new)
+    assert not takes_context(old)
+    assert takes_context(Marked())
+    assert not takes_context(print)
+
+
+def test_adapt_handler():
+    def new(context):
+        return context
+
+    def old(agent, chat, message, follower, lang=None):
+        return agent, chat, message, follower, lang
+
+    context = Context("agent", "chat", "message", "follower", items={"lang": "en"})
+    assert adapt_handler(new) is new
+    assert adapt_handler(old)(context) == ("agent", "chat", "message", "follower", "en")
+    assert adapt_handler(old).__name__ == "old"
+
+
+class OldDialog(Dialog):
+    # Written before the context: its own __init__ and scope set by itself
+    def __init__(self, agent, chat, message, follower, **scope):
+        super().__init__(agent, chat, message, follower, **scope)
+        self.scope = dict(scope, greeting="hello")
+
+    def start(self):
+        self.follower.set_value("reply", f"{self.scope['greeting']} {self.scope['name']}")
+        self.set_next_step(self.again)
+
+    def again(self):
+        self.follower.set_value("reply", f"again {self.context['name']}")
+
+
+class NewDialog(Dialog):
+    def __init__(self, context):
+        super().__init__(context)
+        self.lang = context.get("lang", "en")
+
+    def start(self):
+        self.follower.set_value("lang", self.lang)
+
+
+def test_old_handlers_and_dialogs():
+    dbdriver = DBDriver()
+    dbdriver.connect()
+    chat = Chat("bot", "1")
+    agent = ListAgent([(chat, Message(text="hi"))])
+    botovod = Botovod(dbdriver)
+    botovod.add_agent("bot", agent)
+    botovod["name"] = "Ann"
+    calls = []
+
+    def old_handler(agent, chat, message, follower, **items):
+        calls.append((message.text, follower.id, items))
+        raise HandlerNotPassed
+
+    botovod.add_handlers(old_handler, OldDialog)
+    agent.listen({}, "")
+    follower = dbdriver.get_follower(agent, chat)
+    assert calls == [("hi", follower.id, {"name": "Ann"})]
+    assert follower.get_value("reply") == "hello Ann"
+    assert follower.get_next_step() == "again"
+
+    agent.listen({}, "")
+    assert follower.get_value("reply") == "again Ann"
+    # Scope set by the dialog is its own, the items of Botovod are the same
+    assert botovod.items == {"name": "Ann"}
+
+    follower.set_dialog(None)
+    botovod.set_handlers([NewDialog])
+    agent.listen({}, "", lang="ru")
+    assert follower.get_value("lang") == "ru"
+    # The old call of a dialog is still taken
+    follower.set_dialog(None)
+    NewDialog(agent, chat, Message(text="hi"), follower, lang="de")
+    assert follower.get_value("lang") == "de"
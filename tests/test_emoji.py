@@ -0,0 +1,56 @@
+from botovod.utils import emoji
+
+
+def test_finditer():
+    index = emoji.get_index()
+    text = "hi " + emoji.GRINNING_FACE + emoji.THINKING_FACE + " there " + emoji.GRINNING_FACE
+    assert list(index.finditer(text)) == [(3, 4, "GRINNING_FACE"), (4, 5, "THINKING_FACE"),
+                                          (12, 13, "GRINNING_FACE")]
+    assert list(index.finditer("no emoji here")) == []
+    assert list(index.finditer("")) == []
+
+
+def test_finditer_longest_match():
+    index = emoji.EmojiIndex({"MAN": "\U0001f468",
+                              "MAN_TECHNOLOGIST": "\U0001f468\u200d\U0001f4bb"})
+    assert list(index.finditer("a\U0001f468\u200d\U0001f4bbb")) == [(1, 4, "MAN_TECHNOLOGIST")]
+    assert list(index.finditer("\U0001f468\u200d")) == [(0, 1, "MAN")]
+
+
+def test_variation_selector():
+    # The selector is taken into the match when present, keycap and ZWJ sequences are found
+    # without it too
+    assert list(emoji.finditer(emoji.KEYCAP_1)) == [(0, 3, "KEYCAP_1")]
+    assert list(emoji.finditer("1\u20e3")) == [(0, 2, "KEYCAP_1")]
+    without = emoji.RAINBOW_FLAG.replace("\ufe0f", "")
+    assert list(emoji.finditer(without)) == [(0, len(without), "RAINBOW_FLAG")]
+    assert list(emoji.finditer(emoji.THUMBS_UP + "\ufe0f")) == [(0, 2, "THUMBS_UP")]
+
+
+def test_text_default_symbols():
+    # ©, ™ and arrows are plain text unless the variation selector makes them emoji
+    assert not emoji.contains("(c) \u00a9 2020 Acme\u2122, a \u2194 b, 1 2 #")
+    assert list(emoji.finditer("\u00a9\ufe0f")) == [(0, 2, "COPYRIGHT")]
+    assert emoji.strip("Acme\u2122\ufe0f") == "Acme"
+    # Emoji shown as emoji by default don't need it
+    assert emoji.find_all("\u26bd\u2b50") == ["\u26bd", "\u2b50"]
+    assert emoji.get_name("\u00a9") == "COPYRIGHT"
+
+
+def test_skin_tones():
+    thumbs_up = emoji.THUMBS_UP + "\U0001f3fd"
+    assert list(emoji.finditer(thumbs_up)) == [(0, 2, "THUMBS_UP")]
+    assert emoji.find_all("ok " + thumbs_up) == [thumbs_up]
+    assert emoji.strip("ok " + thumbs_up + "!") == "ok !"
+    assert emoji.get_name(thumbs_up) == "THUMBS_UP"
+    technologist = "\U0001f469\U0001f3ff\u200d\U0001f4bb"
+    assert list(emoji.finditer(technologist)) == [(0, 4, "WOMAN_TECHNOLOGIST")]
+
+
+def test_helpers():
+    text = "a" + emoji.GRINNING_FACE + "b"
+    assert emoji.get_emoji("GRINNING_FACE") == emoji.GRINNING_FACE
+    assert emoji.get_name(emoji.GRINNING_FACE) == "GRINNING_FACE"
+    assert emoji.contains(text)
+    assert emoji.count(text) == 1
+    assert emoji.strip(text) == "ab"
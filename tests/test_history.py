@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from botovod.agents import Chat, Message
+from botovod.dbdrivers import memory, sqlite
+from botovod.dbdrivers.history import AsyncHistoryWriter, HistoryWriter, make_record
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def dbdriver(request, tmp_path):
+    if request.param == "sqlite":
+        dbdriver = sqlite.DBDriver()
+        dbdriver.connect(str(tmp_path / "botovod.db"), history_interval=60.0)
+    else:
+        dbdriver = memory.DBDriver()
+        dbdriver.connect()
+    yield dbdriver
+    dbdriver.close()
+
+
+def search_all(dbdriver, query, limit, **kwargs):
+    pages = []
+    cursor = None
+    while True:
+        messages, cursor = dbdriver.search_history(query, limit=limit, cursor=cursor, **kwargs)
+        pages.append([message.text for message in messages])
+        if cursor is None:
+            return pages
+
+
+def test_history(dbdriver, agent):
+    follower = dbdriver.add_follower(agent, Chat(agent, "1"))
+    middle = None
+    for number in range(4):
+        follower.add_history(Message(text=f"message {number}"), input=number % 2 == 0)
+        if number == 1:
+            middle = datetime.now()
+
+    messages = follower.get_history()
+    assert [message.text for message in messages] == [f"message {number}" for number in range(4)]
+    assert [message.input for message in messages] == [True, False, True, False]
+    texts = [message.text for message in follower.get_history(input=True, limit=1)]
+    assert texts == ["message 2"]
+    texts = [message.text for message in follower.get_history(after_date=middle)]
+    assert texts == ["message 2", "message 3"]
+
+
+def test_search_cursor(dbdriver, agent):
+    first = dbdriver.add_follower(agent, Chat(agent, "1"))
+    second = dbdriver.add_follower(agent, Chat(agent, "2"))
+    for number in range(5):
+        first.add_history(Message(text=f"order pizza {number}"))
+        second.add_history(Message(text=f"order sushi {number}"))
+    first.add_history(Message(text="hello"))
+
+    # Pages go newest first and the last one has no cursor
+    pages = search_all(dbdriver, "order", limit=4)
+    assert [len(page) for page in pages] == [4, 4, 2]
+    texts = [text for page in pages for text in page]
+    assert texts[:2] == ["order sushi 4", "order pizza 4"]
+    assert sorted(texts) == sorted([f"order pizza {number}" for number in range(5)] +
+                                   [f"order sushi {number}" for number in range(5)])
+
+    pages = search_all(dbdriver, "ORDER pizza", limit=2, follower=first)
+    assert pages == [["order pizza 4", "order pizza 3"], ["order pizza 2", "order pizza 1"],
+                     ["order pizza 0"]]
+    messages, _ = dbdriver.search_history("pizza", limit=1)
+    assert messages[0].follower_id == first.id
+    assert dbdriver.search_history("nothing") == ([], None)
+    assert dbdriver.search_history(" ") == ([], None)
+
+
+def test_remove_history(dbdriver, agent):
+    first = dbdriver.add_follower(agent, Chat(agent, "1"))
+    second = dbdriver.add_follower(agent, Chat(agent, "2"))
+    first.add_history(Message(text="order"))
+    second.add_history(Message(text="order"))
+
+    dbdriver.remove_history(follower=first)
+    assert first.get_history() == []
+    assert [message.text for message in second.get_history()] == ["order"]
+    messages, _ = dbdriver.search_history("order")
+    assert [message.follower_id for message in messages] == [second.id]
+
+
+def test_failed_write_keeps_records():
+    written = []
+    failures = [RuntimeError("database is locked")]
+
+    def write(records):
+        if failures:
+            raise failures.pop()
+        written.extend(records)
+
+    writer = HistoryWriter(write=write, interval=60.0)
+    writer.add(make_record(1, Message(text="first")))
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    writer.add(make_record(1, Message(text="second")))
+    writer.flush()
+    assert [text for _, _, text, _, _ in written] == ["first", "second"]
+
+
+def test_async_failed_write_keeps_records():
+    written = []
+    failures = [RuntimeError("connection is lost")]
+
+    async def write(records):
+        if failures:
+            raise failures.pop()
+        written.extend(records)
+
+    async def run():
+        writer = AsyncHistoryWriter(write=write, interval=60.0)
+        writer.add(make_record(1, Message(text="first")))
+        with pytest.raises(RuntimeError):
+            await writer.flush()
+        writer.add(make_record(1, Message(text="second")))
+        await writer.stop()
+
+    asyncio.run(run())
+    assert [text for _, _, text, _, _ in written] == ["first", "second"]
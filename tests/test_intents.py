@@ -0,0 +1,73 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from botovod.agents import Chat, Message
+from botovod.context import Context
+from botovod.exceptions import HandlerNotPassed
+from botovod.utils.intents import IntentIndex, IntentRouter, split_ngrams
+
+
+def greet(context):
+    return "greet"
+
+
+def leave(context):
+    return "leave"
+
+
+INTENTS = [
+    ("greet", greet, ("hello there", "good morning")),
+    ("leave", leave, ("goodbye", "see you later")),
+]
+
+
+def test_split_ngrams():
+    assert split_ngrams("Hi  You", (2, 3)) == [" h", "hi", "i ", " y", "yo", "ou", "u ",
+                                                " hi", "hi ", "i y", " yo", "you", "ou "]
+
+
+def test_score():
+    index = IntentIndex(INTENTS, (2, 4))
+    best, scores = index.score(["hello there", "see you later!", "xyz", ""])
+
+    assert best[:2].tolist() == [0, 1]
+    assert scores[0] == pytest.approx(1.0)
+    assert 0.5 < scores[1] < 1.0
+    assert scores[2:].tolist() == [0.0, 0.0]
+    # Scores of a batch are the scores of texts one by one
+    for number, text in enumerate(["hello there", "see you later!"]):
+        _, score = index.score([text])
+        assert score[0] == pytest.approx(scores[number])
+
+
+def test_intent_without_examples():
+    with pytest.raises(ValueError):
+        IntentIndex([("empty", greet, ())], (2, 4))
+
+
+def test_router():
+    router = IntentRouter(threshold=0.3)
+    for name, handler, examples in INTENTS:
+        router.add_intent(handler, examples, name=name)
+
+    context = Context(None, Chat("bot", "1"), Message(text="good morning!"))
+    assert router(context) == "greet"
+    assert context["intent"].name == "greet"
+    with pytest.raises(HandlerNotPassed):
+        router(Context(None, Chat("bot", "1"), Message(text="qwerty")))
+    with pytest.raises(HandlerNotPassed):
+        router(Context(None, Chat("bot", "1"), Message()))
+
+
+def test_prepared_matches():
+    router = IntentRouter(threshold=0.3)
+    for name, handler, examples in INTENTS:
+        router.add_intent(handler, examples, name=name)
+    messages = [(Chat("bot", "1"), Message(text="goodbye")), (Chat("bot", "1"), Message())]
+
+    matches = router.botovod_prepare(messages)
+    assert [match and match.name for match in matches] == ["leave", None]
+    # The context carries the match prepared for its message, the router doesn't match again
+    context = Context(None, *messages[0], prepared={router: matches[0]._replace(handler=greet)})
+    assert router(context) == "greet"
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from botovod.agents import Chat
+from botovod.dbdrivers.memory import DBDriver, get_journal_path
+
+
+@pytest.fixture
+def dbdriver(tmp_path):
+    dbdriver = DBDriver()
+    dbdriver.connect(str(tmp_path), fsync_interval=0.01)
+    yield dbdriver
+    dbdriver.close()
+
+
+def crash(dbdriver: DBDriver):
+    # Journal is written out, but nothing is compacted, as if the process was killed
+    dbdriver.journal.stop()
+    dbdriver.journal = None
+
+
+def test_follower(dbdriver, agent):
+    chat = Chat(agent, "1")
+    follower = dbdriver.get_or_create_follower(agent, chat)
+    assert dbdriver.get_or_create_follower(agent, chat) is follower
+
+    follower.set_dialog("order")
+    follower.set_value("city", "Kazan")
+    follower.set_value("items", [1, 2])
+    follower.delete_value("items")
+    dbdriver.finish(follower)
+
+    assert follower.get_dialog() == "order"
+    assert follower.get_next_step() == "start"
+    assert follower.get_values() == {"city": "Kazan"}
+    dbdriver.delete(follower)
+    assert dbdriver.get_follower(agent, chat) is None
+
+
+def test_reopen_from_snapshot(tmp_path, dbdriver, agent):
+    follower = dbdriver.add_follower(agent, Chat(agent, "1"))
+    follower.set_value("city", "Kazan")
+    dbdriver.close()
+
+    dbdriver.connect(str(tmp_path))
+    assert dbdriver.get_follower(agent, Chat(agent, "1")).get_values() == {"city": "Kazan"}
+    assert dbdriver.add_follower(agent, Chat(agent, "2")).id > follower.id
+
+
+def test_recover_broken_journal(tmp_path, dbdriver, agent):
+    follower = dbdriver.add_follower(agent, Chat(agent, "1"))
+    follower.set_value("city", "Kazan")
+    dbdriver.finish(follower)
+    crash(dbdriver)
+    path = get_journal_path(str(tmp_path), dbdriver.generation)
+    size = os.path.getsize(path)
+    with open(path, "ab") as file:
+        file.write(b'["set_value", 1, "ci')
+
+    dbdriver.connect(str(tmp_path))
+    assert os.path.getsize(path) == size
+    follower = dbdriver.get_follower(agent, Chat(agent, "1"))
+    assert follower.get_values() == {"city": "Kazan"}
+
+    # Records written after recovery are read back, not glued to the broken tail
+    follower.set_value("street", "Main")
+    dbdriver.finish(follower)
+    crash(dbdriver)
+    dbdriver.connect(str(tmp_path))
+    follower = dbdriver.get_follower(agent, Chat(agent, "1"))
+    assert follower.get_values() == {"city": "Kazan", "street": "Main"}
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from botovod.agents import Chat
+from botovod.dbdrivers import memory, sqlite
+from botovod.migrate import Migrator, make_agent
+
+
+@pytest.fixture
+def source(tmp_path):
+    dbdriver = sqlite.DBDriver()
+    dbdriver.connect(str(tmp_path / "botovod.db"))
+    yield dbdriver
+    dbdriver.close()
+
+
+@pytest.fixture
+def target(tmp_path):
+    dbdriver = memory.DBDriver()
+    dbdriver.connect(str(tmp_path / "memory"))
+    yield dbdriver
+    dbdriver.close()
+
+
+def test_migrate(source, target, agent):
+    for number in range(5):
+        follower = source.get_or_create_follower(agent, Chat(agent, str(number)))
+        follower.set_dialog("order")
+        if number:
+            follower.set_value("number", number)
+            follower.set_value("items", [number] * number)
+
+    # Values of a batch are read by one query, not by one query per follower
+    queries = []
+    fetch_all = source.a_fetch_all
+
+    async def a_fetch_all(query, parameters=()):
+        queries.append(query)
+        return await fetch_all(query, parameters)
+
+    source.a_fetch_all = a_fetch_all
+    migrator = Migrator(source, target, batch_size=2, workers=2)
+    assert asyncio.run(migrator.a_run()) == 5
+    assert sqlite.SELECT_VALUES not in queries
+    assert queries.count(sqlite.SELECT_BATCH_VALUES) == 3
+
+    bot = make_agent(agent.name)
+    for number in range(5):
+        follower = target.get_follower(bot, Chat(bot, str(number)))
+        assert follower.get_dialog() == "order"
+        assert follower.get_next_step() == "start"
+        if number:
+            assert follower.get_values() == {"number": number, "items": [number] * number}
+        else:
+            assert follower.get_values() == {}
+
+
+def test_prefetch_values(source, agent):
+    followers = []
+    for number in range(3):
+        follower = source.get_or_create_follower(agent, Chat(agent, str(number)))
+        follower.set_value("number", number)
+        followers.append(source.get_follower(agent, Chat(agent, str(number))))
+
+    source.prefetch_values(followers)
+    source.fetch_all = None
+    assert [follower.get_values() for follower in followers] == [
+        {"number": 0}, {"number": 1}, {"number": 2},
+    ]
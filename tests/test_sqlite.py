@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from botovod.agents import Chat
+from botovod.dbdrivers.sqlite import DBDriver, make_read_uri
+
+
+@pytest.fixture
+def dbdriver(tmp_path):
+    dbdriver = DBDriver()
+    dbdriver.connect(str(tmp_path / "botovod.db"), history_interval=60.0,
+                     indexed_values=("city",))
+    yield dbdriver
+    dbdriver.close()
+
+
+def test_follower(dbdriver, agent):
+    chat = Chat(agent, "1")
+    assert dbdriver.get_follower(agent, chat) is None
+    follower = dbdriver.get_or_create_follower(agent, chat)
+    assert dbdriver.get_or_create_follower(agent, chat).id == follower.id
+
+    follower.set_dialog("order")
+    follower.set_next_step("address")
+    follower.set_value("city", "Moscow")
+    follower.set_value("items", [1, 2])
+    follower.delete_value("items")
+
+    # Reads go through the read connections, so they see what the worker committed
+    follower = dbdriver.get_follower(agent, chat)
+    assert follower.get_dialog() == "order"
+    assert follower.get_next_step() == "address"
+    assert follower.get_values() == {"city": "Moscow"}
+    assert follower.get_value("items", "none") == "none"
+
+    follower.clear_values()
+    assert dbdriver.get_follower(agent, chat).get_values() == {}
+    dbdriver.delete(follower)
+    assert dbdriver.get_follower(agent, chat) is None
+
+
+def test_iter_followers(dbdriver, agent):
+    for number in range(5):
+        follower = dbdriver.add_follower(agent, Chat(agent, str(number)))
+        follower.set_value("city", "Moscow" if number % 2 else "Kazan")
+
+    chats = [follower.chat for follower in dbdriver.iter_followers(agent, batch_size=2)]
+    assert chats == ["0", "1", "2", "3", "4"]
+    chats = [follower.chat for follower in dbdriver.iter_followers(values={"city": "Moscow"})]
+    assert chats == ["1", "3"]
+
+
+def test_import_followers(dbdriver, agent):
+    follower = dbdriver.add_follower(agent, Chat(agent, "1"))
+    follower.set_value("old", True)
+
+    dbdriver.import_followers(agent, [
+        (Chat(agent, "1"), "order", "address", {"city": "Kazan"}),
+        (Chat(agent, "2"), None, None, {}),
+    ])
+
+    follower = dbdriver.get_follower(agent, Chat(agent, "1"))
+    assert (follower.get_dialog(), follower.get_next_step()) == ("order", "address")
+    assert follower.get_values() == {"city": "Kazan"}
+    assert dbdriver.get_follower(agent, Chat(agent, "2")).get_values() == {}
+    chats = [follower.chat for follower in dbdriver.iter_followers(values={"city": "Kazan"})]
+    assert chats == ["1"]
+
+
+def test_failed_write_is_rolled_back(dbdriver, agent):
+    # Every write runs in its own savepoint, a failed one leaves the rest of the batch alone
+    follower = dbdriver.add_follower(agent, Chat(agent, "1"))
+
+    def fail(connection):
+        connection.execute("UPDATE botovod_followers SET dialog = 'broken'")
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        dbdriver.call(fail)
+    follower.set_value("city", "Kazan")
+
+    follower = dbdriver.get_follower(agent, Chat(agent, "1"))
+    assert follower.get_dialog() is None
+    assert follower.get_values() == {"city": "Kazan"}
+
+
+def test_read_uri(tmp_path):
+    path = str(tmp_path / "botovod.db")
+    assert make_read_uri(path) == f"file:{path}?mode=ro"
+    assert (make_read_uri(f"file:{path}?cache=shared&mode=rwc") ==
+            f"file:{path}?cache=shared&mode=ro")
+    assert make_read_uri(":memory:") is None
+    assert make_read_uri("file::memory:?cache=shared") is None
+    assert make_read_uri("file:botovod?mode=memory&cache=shared") is None
+
+
+def test_uri_database(tmp_path, agent):
+    # Writes of the worker and reads of the readers go to the same file
+    dbdriver = DBDriver()
+    dbdriver.connect(f"file:{tmp_path / 'botovod.db'}?cache=private")
+    try:
+        assert dbdriver.readers is not None
+        follower = dbdriver.get_or_create_follower(agent, Chat(agent, "1"))
+        follower.set_value("city", "Kazan")
+        assert dbdriver.get_follower(agent, Chat(agent, "1")).get_values() == {"city": "Kazan"}
+    finally:
+        dbdriver.close()
+    assert os.path.exists(tmp_path / "botovod.db")
+
+
+def test_known_follower_is_read_without_worker(dbdriver, agent):
+    follower = dbdriver.get_or_create_follower(agent, Chat(agent, "1"))
+    calls = []
+    call = dbdriver.call
+    dbdriver.call = lambda function: calls.append(function) or call(function)
+
+    assert dbdriver.get_or_create_follower(agent, Chat(agent, "1")).id == follower.id
+    assert calls == []
+    dbdriver.get_or_create_follower(agent, Chat(agent, "2"))
+    assert len(calls) == 1
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+
+from botovod.agents.telegram import (TelegramAgent, TelegramChat, TelegramChatView,
+                                     TelegramMessage, TelegramMessageView, TelegramUser,
+                                     TelegramUserView)
+
+CHAT = {"id": 5, "type": "private", "username": "ann", "first_name": "Ann"}
+USER = {"id": 7, "is_bot": False, "first_name": "Ann", "language_code": "en"}
+MESSAGES = [
+    {"message_id": 1, "date": 1600000000, "chat": CHAT, "text": "hi"},
+    {"message_id": 2, "date": 1600000001, "chat": CHAT,
+     "photo": [{"file_id": "small", "file_path": "photos/1.jpg"},
+               {"file_id": "big", "file_path": "photos/2.jpg", "file_size": 10}],
+     "document": {"file_id": "doc", "file_path": "docs/1.pdf"},
+     "location": {"latitude": 1.5, "longitude": 2.5},
+     "contact": {"phone_number": "123", "first_name": "Bob"}},
+]
+
+
+@pytest.fixture
+def agent():
+    return TelegramAgent(token="token")
+
+
+def attachments(entities):
+    return [(entity.url, entity.raw) for entity in entities]
+
+
+def assert_same_message(view, message):
+    assert view.text == message.text
+    assert view.raw == message.raw
+    assert view.datetime == message.datetime
+    for name in ("images", "audios", "videos", "documents"):
+        assert attachments(getattr(view, name)) == attachments(getattr(message, name))
+    assert ([(location.latitude, location.longitude) for location in view.locations] ==
+            [(location.latitude, location.longitude) for location in message.locations])
+    assert (view.contact and view.contact.render()) == (message.contact and
+                                                        message.contact.render())
+    assert view.chat.id == message.chat.id
+    assert view.chat.raw == message.chat.raw
+    assert view.render() == message.render()
+
+
+@pytest.mark.parametrize("data", MESSAGES)
+def test_message_view(agent, data):
+    assert_same_message(TelegramMessageView.parse(data, agent=agent),
+                        TelegramMessage.parse(data, agent=agent))
+
+
+@pytest.mark.parametrize("data", MESSAGES)
+def test_async_message_view(agent, data):
+    async def parse():
+        return (await TelegramMessageView.a_parse(data, agent=agent),
+                await TelegramMessage.a_parse(data, agent=agent))
+
+    assert_same_message(*asyncio.run(parse()))
+
+
+def test_message_view_is_lazy(agent):
+    view = TelegramMessageView.parse(MESSAGES[1], agent=agent)
+    assert view.text is None
+    # Fields not read yet are not built
+    for name in ("_images", "_documents", "_locations", "_chat", "_raw"):
+        with pytest.raises(AttributeError):
+            getattr(TelegramMessageView, name).__get__(view)
+    assert view.images[0].raw["id"] == "big"
+    assert view.images is view.images
+
+
+def test_message_view_chat(agent):
+    view = TelegramMessageView.parse(MESSAGES[0], agent=agent)
+    assert view.chat is view.chat
+    assert view.chat.agent is agent
+    assert isinstance(view.chat, TelegramChat)
+
+
+def test_chat_and_user_views(agent):
+    chat = TelegramChatView(agent=agent, data=CHAT)
+    parsed = TelegramChat.parse(agent=agent, data=CHAT)
+    assert (chat.id, chat.raw, chat.username) == (parsed.id, parsed.raw, parsed.username)
+    assert chat.render() == parsed.render()
+
+    user = TelegramUserView(agent=agent, data=USER)
+    parsed = TelegramUser.parse(agent=agent, data=USER)
+    assert (user.id, user.raw, user.first_name) == (parsed.id, parsed.raw, parsed.first_name)
+    assert user.render() == parsed.render()
+
+
+def test_parser(agent):
+    update = {"update_id": 1, "message": MESSAGES[0],
+              "callback_query": {"id": "9", "from": USER, "data": "item:1"}}
+    (chat, message), (user, callback) = agent.parser({}, json.dumps(update))
+    assert (chat.id, message.text) == ("5", "hi")
+    assert (user.id, callback.get_button_key()) == ("7", ("callback", "item:1"))
+    # Updates seen before are skipped
+    assert agent.parser({}, json.dumps(update)) == []
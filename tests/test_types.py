@@ -0,0 +1,67 @@
+import copy
+import pickle
+
+import pytest
+
+from botovod.agents import Attachment, Chat, Location, Message
+from botovod.agents.types import Entity, lazy
+
+
+def test_entity_fields():
+    message = Message(text="hi", id=1)
+    assert message.text == "hi"
+    assert message.images == ()
+    # Fields not declared by the type are kept in raw and read as attributes
+    assert message.raw == {"id": 1}
+    assert message.id == 1
+    with pytest.raises(AttributeError):
+        message.missing
+
+
+def test_entity_slots():
+    # Every class of an entity declares slots, so fields don't live in a dict
+    for entity in (Chat("bot", "1"), Message(text="hi"), Attachment(url="url"),
+                   Location(latitude=1.0, longitude=2.0)):
+        assert all("__slots__" in vars(cls) for cls in type(entity).__mro__[:-1])
+        assert not entity.__dict__
+    message = Message(text="hi")
+    # Attributes set by user code still work
+    message.handled = True
+    assert message.handled is True
+    assert message.__dict__ == {"handled": True}
+
+
+def test_entity_copy():
+    message = Message(text="hi", images=(Attachment(url="url"),), id=1)
+    message.handled = True
+    for copied in (pickle.loads(pickle.dumps(message)), copy.deepcopy(message),
+                   copy.copy(message)):
+        assert copied.text == "hi"
+        assert copied.images[0].url == "url"
+        assert copied.raw == {"id": 1}
+        assert copied.handled is True
+
+
+class Lazy(Entity):
+    __slots__ = ("data", "calls", "_size")
+
+    def __init__(self, data):
+        self.data = data
+        self.calls = 0
+
+    @lazy
+    def size(self):
+        self.calls += 1
+        return len(self.data)
+
+
+def test_lazy():
+    entity = Lazy("abc")
+    assert entity.calls == 0
+    assert entity.size == 3
+    assert entity.size == 3
+    assert entity.calls == 1
+    entity.size = 10
+    assert entity.size == 10
+    assert entity.calls == 1
+    assert isinstance(Lazy.size, lazy)